@@ -0,0 +1,3 @@
+"""
+Chat Application Benchmarks
+"""
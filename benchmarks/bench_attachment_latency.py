@@ -0,0 +1,116 @@
+"""
+Chat latency during an attachment download.
+Streams a large attachment to a socketpair client while chat messages are
+sent to the same connection, and reports chat delivery latency with and
+without the transfer in flight.
+
+Usage: python -m benchmarks.bench_attachment_latency [size_mb]
+"""
+
+import os
+import select
+import socket
+import sys
+import tempfile
+import threading
+import time
+from src.attachments import Download
+from src.connection import Connection
+from src.protocol import HEADER_LENGTH, decode_header, encode_message
+
+CHAT_INTERVAL = 0.005
+DEFAULT_SIZE_MB = 256
+
+
+def read_frames(client_side, latencies, totals):
+    # Client side: parse every frame, timing chat messages on arrival.
+
+    reader = client_side.makefile('rb')
+    while True:
+        user_header = reader.read(HEADER_LENGTH)
+        if not user_header:
+            return
+        username = reader.read(decode_header(user_header))
+        message = reader.read(decode_header(reader.read(HEADER_LENGTH)))
+        if username == b'Bob':
+            latencies.append(time.perf_counter() - float(message))
+        else:
+            totals[0] += len(message)
+
+
+def run_case(path: str, size: int, duration: float = None):
+
+    server_side, client_side = socket.socketpair()
+    server_side.setblocking(False)
+    latencies = []
+    totals = [0]
+    reader = threading.Thread(target=read_frames, args=(client_side, latencies, totals), daemon=True)
+    reader.start()
+
+    backlog = set()
+    connection = Connection(server_side, b'5         ', b'Alice', backlog=backlog)
+    if path is not None:
+        connection.add_stream(Download('1', path, size))
+
+    start = time.perf_counter()
+    next_chat = start
+    while True:
+        now = time.perf_counter()
+        if path is None and now - start > duration:
+            break
+        if path is not None and connection.streams is None:
+            break
+
+        if now >= next_chat:
+            user_header, user_data = encode_message('Bob')
+            msg_header, msg_data = encode_message(repr(now))
+            connection.send(user_header + user_data + msg_header + msg_data)
+            next_chat = now + CHAT_INTERVAL
+
+        # Same shape as the server loop: only wait for writability when
+        # there is queued output
+        write_list = [server_side] if connection in backlog else []
+        _, writable, _ = select.select([], write_list, [], max(0.0, next_chat - time.perf_counter()))
+        if writable:
+            connection.flush()
+
+    elapsed = time.perf_counter() - start
+    server_side.shutdown(socket.SHUT_WR)
+    reader.join()
+    connection.close()
+    server_side.close()
+    client_side.close()
+    return sorted(latencies), totals[0], elapsed
+
+
+def percentile(values, fraction: float) -> float:
+
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1e6
+
+
+def run():
+
+    size = int(float(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SIZE_MB) * 1024 * 1024
+    spool = tempfile.NamedTemporaryFile(delete=False)
+    try:
+        # A sparse file: sendfile reads zeros without touching the disk
+        spool.truncate(size)
+        spool.close()
+
+        loaded, transferred, elapsed = run_case(spool.name, size)
+        idle, _, _ = run_case(None, 0, elapsed)
+
+        print(f'{size // (1024 * 1024)} MB attachment, chat every {CHAT_INTERVAL * 1000:.0f} ms')
+        print(f'transfer: {transferred / elapsed / 1e6:.0f} MB/s in {elapsed:.2f}s')
+        print(f'{"case":>16} {"messages":>9} {"p50 us":>9} {"p99 us":>9} {"max us":>9}')
+        for name, latencies in (('idle', idle), ('during transfer', loaded)):
+            print(
+                f'{name:>16} {len(latencies):>9} {percentile(latencies, 0.5):>9.0f} '
+                f'{percentile(latencies, 0.99):>9.0f} {latencies[-1] * 1e6:>9.0f}'
+            )
+    finally:
+        os.unlink(spool.name)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,88 @@
+"""
+Per-connection memory benchmark.
+Uses tracemalloc to report Python-side bytes per idle and per active
+Connection at 10k and 50k connections, next to the old dict state.
+Kernel socket buffers are not included.
+
+Usage: python -m benchmarks.bench_connection_memory
+"""
+
+import gc
+import tracemalloc
+from src.connection import Connection
+from src.protocol import encode_message
+
+CONNECTION_COUNTS = [10000, 50000]
+PENDING_INPUT = 200
+PENDING_OUTPUT = 1024
+
+
+class FakeSocket:
+    # Stands in for the socket object, which both layouts hold, so one
+    # instance is shared and kept out of the measurement.
+
+    __slots__ = ()
+
+    def send(self, data):
+        return 0
+
+
+SOCKET = FakeSocket()
+
+
+def received_username(i: int) -> tuple:
+    # Fresh bytes objects, as produced by recv() for each client
+    header, data = encode_message(f'user{i}')
+    return bytes(bytearray(header)), bytes(bytearray(data))
+
+
+def build_dicts(count: int, active: bool) -> dict:
+    # The old {'header', 'data'} state, which had no buffers of its own.
+
+    client_dict = {}
+    for i in range(count):
+        header, data = received_username(i)
+        client_dict[i] = {'header': header, 'data': data}
+    return client_dict
+
+
+def build_connections(count: int, active: bool) -> dict:
+
+    client_dict = {}
+    for i in range(count):
+        header, data = received_username(i)
+        connection = Connection(SOCKET, header, data)
+        if active:
+            connection.recv_buffer = bytearray(PENDING_INPUT)
+            connection.send(bytes(PENDING_OUTPUT))
+        client_dict[i] = connection
+    return client_dict
+
+
+def bytes_per_connection(build, count: int, active: bool) -> float:
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    client_dict = build(count, active)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    total = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    del client_dict
+    return total / count
+
+
+def run():
+
+    print(f'{"connections":>12} {"dict idle":>10} {"idle":>8} {"active":>8}   (bytes per connection)')
+    for count in CONNECTION_COUNTS:
+        legacy = bytes_per_connection(build_dicts, count, False)
+        idle = bytes_per_connection(build_connections, count, False)
+        active = bytes_per_connection(build_connections, count, True)
+        print(f'{count:>12} {legacy:>10.0f} {idle:>8.0f} {active:>8.0f}')
+    print(f'active = {PENDING_INPUT} B partial frame and {PENDING_OUTPUT} B unsent output buffered')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,90 @@
+"""
+Mixed TCP/WebSocket fanout benchmark.
+Times broadcast_message to socketpair recipients at several TCP/WebSocket
+mixes, against re-encoding the WebSocket frame for every recipient.
+
+Usage: python -m benchmarks.bench_fanout
+"""
+
+import socket
+import time
+from src.connection import Connection
+from src.message_handler import broadcast_message
+from src.protocol import encode_message
+from src.websocket import WEBSOCKET, encode_chat_frame
+
+RECIPIENTS = 200
+MESSAGES = 50
+ROUNDS = 10
+WEBSOCKET_SHARES = [0.0, 0.5, 1.0]
+
+
+def make_clients(count: int, websocket_share: float):
+
+    client_dict = {}
+    peers = []
+    websocket_count = int(count * websocket_share)
+    for i in range(count):
+        server_side, client_side = socket.socketpair()
+        client_side.setblocking(False)
+        transport = WEBSOCKET if i < websocket_count else None
+        client_dict[server_side] = Connection(server_side, b'3         ', b'Bob', transport=transport)
+        peers.append(client_side)
+    return client_dict, peers
+
+
+def drain(peers):
+
+    for peer in peers:
+        try:
+            while peer.recv(65536):
+                pass
+        except BlockingIOError:
+            pass
+
+
+def naive_broadcast(sender_socket, client_dict, user_header, user_data, msg_header, msg_data):
+
+    for client_socket, client_info in client_dict.items():
+        if client_socket == sender_socket:
+            continue
+        if client_info.transport == WEBSOCKET:
+            client_info.send(encode_chat_frame(user_data, msg_data))
+        else:
+            client_info.send(user_header + user_data + msg_header + msg_data)
+
+
+def time_broadcast(broadcast, client_dict, peers, parts) -> float:
+
+    elapsed = 0.0
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        for _ in range(MESSAGES):
+            broadcast(None, client_dict, *parts)
+        elapsed += time.perf_counter() - start
+        drain(peers)
+    return elapsed / (ROUNDS * MESSAGES) * 1e6
+
+
+def run():
+
+    user_header, user_data = encode_message('Alice')
+    msg_header, msg_data = encode_message('Hello everyone, 世界 ' * 5)
+    parts = (user_header, user_data, msg_header, msg_data)
+
+    print(f'{RECIPIENTS} recipients, {len(msg_data)} byte message')
+    print(f'{"ws share":>10} {"encode once us":>16} {"per recipient us":>18}')
+
+    for share in WEBSOCKET_SHARES:
+        client_dict, peers = make_clients(RECIPIENTS, share)
+        try:
+            shared = time_broadcast(broadcast_message, client_dict, peers, parts)
+            naive = time_broadcast(naive_broadcast, client_dict, peers, parts)
+            print(f'{share:>10.0%} {shared:>16.1f} {naive:>18.1f}')
+        finally:
+            for sock in list(client_dict) + peers:
+                sock.close()
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,274 @@
+"""
+Protocol and handler micro-benchmarks.
+Times the hot functions in src/protocol.py and src/message_handler.py per
+call, across payload sizes, ASCII and multibyte UTF-8, and fanout sizes.
+Results can be saved as baselines and checked against them. Checks compare
+each case's cost relative to a fixed calibration workload timed alongside
+it, so they hold up on other machines and on noisy shared hosts.
+
+Usage: python -m benchmarks.bench_micro [--save] [--check] [--tolerance 0.3] [--filter NAME]
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+from src.connection import Connection
+from src.message_handler import receive_message, broadcast_message
+from src.protocol import encode_message, decode_header, decode_message, create_full_message
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), 'baselines.json')
+# Slower than baseline by more than this fraction counts as a regression
+DEFAULT_TOLERANCE = 0.3
+# A case over tolerance is timed again this many times before it fails
+CONFIRM_RUNS = 2
+
+PAYLOAD_SIZES = [10, 1000, 100000, 1000000]
+FANOUT_SIZES = [1, 10, 100, 1000]
+SOCKETPAIR_FANOUT_SIZES = [10, 100]
+# Each timing run lasts at least this long. Runs of a case and of the
+# calibration workload alternate REPEATS times; the median ratio is kept.
+MIN_RUN_TIME = 0.002
+REPEATS = 50
+
+
+def payload(size: int, charset: str) -> str:
+    # A string that encodes to about size bytes
+
+    if charset == 'ascii':
+        return 'x' * size
+    # Three bytes per character in UTF-8
+    return '世' * max(1, size // 3)
+
+
+class FakeSocket:
+    # In-memory socket: recv replays one frame, send accepts everything.
+
+    __slots__ = ('chunks', 'position')
+
+    def __init__(self, chunks=()):
+        self.chunks = list(chunks)
+        self.position = 0
+
+    def recv(self, size: int) -> bytes:
+        chunk = self.chunks[self.position]
+        self.position = (self.position + 1) % len(self.chunks)
+        return chunk
+
+    def send(self, data) -> int:
+        return len(data)
+
+
+def loop_count(func) -> int:
+    # Calls per run, doubled until a run is long enough to time.
+
+    number = 1
+    while True:
+        if time_runs(func, number) * number >= MIN_RUN_TIME:
+            return number
+        number *= 2
+
+
+def time_runs(func, number: int) -> float:
+
+    start = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - start) / number
+
+
+def calibration_workload():
+    # Fixed interpreter and allocation work, timed next to every case so
+    # that machine speed cancels out of the comparison.
+
+    total = 0
+    for i in range(100):
+        total += i
+    return bytes(4096).decode('utf-8'), total
+
+
+def time_call(func) -> tuple:
+    # Returns (nanoseconds per call, cost relative to the calibration
+    # workload). Speed on a shared host changes from second to second, so
+    # short runs of the two alternate and the medians are kept.
+
+    number = loop_count(func)
+    calibration_number = loop_count(calibration_workload)
+    timings = []
+    ratios = []
+    for _ in range(REPEATS):
+        elapsed = time_runs(func, number)
+        timings.append(elapsed)
+        ratios.append(elapsed / time_runs(calibration_workload, calibration_number))
+
+    timings.sort()
+    ratios.sort()
+    return timings[REPEATS // 2] * 1e9, ratios[REPEATS // 2]
+
+
+def size_label(size: int) -> str:
+
+    if size >= 1000000:
+        return f'{size // 1000000}MB'
+    if size >= 1000:
+        return f'{size // 1000}KB'
+    return f'{size}B'
+
+
+def protocol_cases():
+
+    for charset in ('ascii', 'utf8'):
+        for size in PAYLOAD_SIZES:
+            message = payload(size, charset)
+            header, data = encode_message(message)
+            label = f'{charset}/{size_label(size)}'
+
+            yield f'encode_message/{label}', lambda message=message: encode_message(message)
+            yield f'decode_message/{label}', lambda data=data: decode_message(data)
+            yield (
+                f'create_full_message/{label}',
+                lambda message=message: create_full_message('Alice', message)
+            )
+
+            sock = FakeSocket([header, data])
+            yield f'receive_message/{label}', lambda sock=sock: receive_message(sock)
+
+    header = encode_message('x' * 1000)[0]
+    yield 'decode_header', lambda: decode_header(header)
+
+
+def broadcast_cases():
+
+    user_header, user_data = encode_message('Alice')
+    msg_header, msg_data = encode_message('Hello everyone, 世界 ' * 5)
+    parts = (user_header, user_data, msg_header, msg_data)
+
+    for fanout in FANOUT_SIZES:
+        client_dict = {}
+        for i in range(fanout):
+            sock = FakeSocket()
+            client_dict[sock] = Connection(sock, b'', f'user{i}'.encode('utf-8'))
+        yield (
+            f'broadcast_message/fake/{fanout}',
+            lambda client_dict=client_dict: broadcast_message(None, client_dict, *parts)
+        )
+
+
+def socketpair_broadcast_cases():
+    # Real sockets: each call drains the receiving ends so the kernel
+    # buffers never fill. Sockets are closed by the caller.
+
+    user_header, user_data = encode_message('Alice')
+    msg_header, msg_data = encode_message('Hello everyone, 世界 ' * 5)
+    parts = (user_header, user_data, msg_header, msg_data)
+
+    for fanout in SOCKETPAIR_FANOUT_SIZES:
+        client_dict = {}
+        peers = []
+        for i in range(fanout):
+            server_side, client_side = socket.socketpair()
+            server_side.setblocking(False)
+            client_side.setblocking(False)
+            client_dict[server_side] = Connection(server_side, b'', f'user{i}'.encode('utf-8'))
+            peers.append(client_side)
+
+        def call(client_dict=client_dict, peers=peers):
+            broadcast_message(None, client_dict, *parts)
+            for peer in peers:
+                peer.recv(65536)
+
+        yield f'broadcast_message/socketpair/{fanout}', call, list(client_dict) + peers
+
+
+def all_cases():
+
+    cases = [(name, func, []) for name, func in protocol_cases()]
+    cases += [(name, func, []) for name, func in broadcast_cases()]
+    cases += list(socketpair_broadcast_cases())
+    return cases
+
+
+def run_cases(name_filter: str = None, baselines: dict = None, tolerance: float = DEFAULT_TOLERANCE) -> dict:
+    # Returns {name: {'ns': ..., 'relative': ...}}. With baselines, a case
+    # over tolerance is re-timed and keeps its best result.
+
+    baselines = baselines or {}
+    results = {}
+
+    for name, func, sockets in all_cases():
+        if name_filter is None or name_filter in name:
+            ns, relative = time_call(func)
+            baseline = baselines.get(name)
+            for _ in range(CONFIRM_RUNS):
+                if baseline is None or relative <= baseline['relative'] * (1 + tolerance):
+                    break
+                ns, retimed = time_call(func)
+                relative = min(relative, retimed)
+            results[name] = {'ns': round(ns, 1), 'relative': round(relative, 4)}
+            print(f'{name:<42} {ns:>14.1f} ns {relative:>12.4f}x')
+        for sock in sockets:
+            sock.close()
+    return results
+
+
+def load_baselines(path: str = BASELINE_FILE) -> dict:
+
+    if not os.path.exists(path):
+        return {}
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def save_baselines(results: dict, path: str = BASELINE_FILE):
+
+    baselines = load_baselines(path)
+    baselines.update(results)
+    with open(path, 'w') as baseline_file:
+        json.dump(baselines, baseline_file, indent=2, sort_keys=True)
+        baseline_file.write('\n')
+
+
+def find_regressions(results: dict, baselines: dict, tolerance: float) -> list:
+    # Returns [(name, baseline, current)] relative costs for every case
+    # slower than its baseline by more than the tolerance. Cases with no
+    # baseline pass.
+
+    regressions = []
+    for name, result in results.items():
+        baseline = baselines.get(name)
+        if baseline is not None and result['relative'] > baseline['relative'] * (1 + tolerance):
+            regressions.append((name, baseline['relative'], result['relative']))
+    return regressions
+
+
+def main(argv=None) -> int:
+
+    parser = argparse.ArgumentParser(description='Protocol and handler micro-benchmarks')
+    parser.add_argument('--save', action='store_true', help='store results as the new baselines')
+    parser.add_argument('--check', action='store_true', help='fail if any case regressed')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--filter', help='only run cases whose name contains this')
+    parser.add_argument('--baselines', default=BASELINE_FILE)
+    args = parser.parse_args(argv)
+
+    baselines = load_baselines(args.baselines) if args.check else None
+    results = run_cases(args.filter, baselines, args.tolerance)
+
+    if args.save:
+        save_baselines(results, args.baselines)
+        print(f'Saved {len(results)} baselines to {args.baselines}')
+
+    if args.check:
+        regressions = find_regressions(results, baselines, args.tolerance)
+        for name, baseline, current in regressions:
+            print(f'REGRESSION {name}: {baseline:.4f}x -> {current:.4f}x ({current / baseline - 1:+.0%})')
+        if regressions:
+            return 1
+        print(f'No regressions beyond {args.tolerance:.0%}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
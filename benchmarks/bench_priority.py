@@ -0,0 +1,100 @@
+"""
+Control-frame latency under a replay flood.
+Queues a large history replay to one socketpair client, then sends presence
+frames to it every few milliseconds, and reports how long the presence
+frames take to arrive with priority scheduling and with plain FIFO.
+
+Usage: python -m benchmarks.bench_priority
+"""
+
+import select
+import socket
+import threading
+import time
+from src.connection import Connection
+from src.protocol import HEADER_LENGTH, decode_header, encode_message
+from src.scheduler import CONTROL, BULK, CHAT
+
+REPLAY_FRAMES = 150000
+REPLAY_LINE = 'Alice > an old message being replayed from history ' * 10
+CONTROL_INTERVAL = 0.002
+
+
+def read_frames(client_side, latencies):
+    # Client side: time every presence frame on arrival.
+
+    reader = client_side.makefile('rb')
+    while True:
+        user_header = reader.read(HEADER_LENGTH)
+        if not user_header:
+            return
+        username = reader.read(decode_header(user_header))
+        message = reader.read(decode_header(reader.read(HEADER_LENGTH)))
+        if username == b'@presence':
+            latencies.append(time.perf_counter() - float(message))
+
+
+def encode_frame(username: str, message: str) -> bytes:
+
+    user_header, user_data = encode_message(username)
+    msg_header, msg_data = encode_message(message)
+    return user_header + user_data + msg_header + msg_data
+
+
+def run_case(control_priority: int, replay_priority: int):
+
+    server_side, client_side = socket.socketpair()
+    server_side.setblocking(False)
+    latencies = []
+    reader = threading.Thread(target=read_frames, args=(client_side, latencies), daemon=True)
+    reader.start()
+
+    backlog = set()
+    connection = Connection(server_side, b'5         ', b'Alice', backlog=backlog)
+    replay = encode_frame('@history', REPLAY_LINE)
+
+    start = time.perf_counter()
+    for _ in range(REPLAY_FRAMES):
+        connection.send(replay, replay_priority)
+
+    next_control = start
+    while connection in backlog:
+        now = time.perf_counter()
+        if now >= next_control:
+            connection.send(encode_frame('@presence', repr(now)), control_priority)
+            next_control = now + CONTROL_INTERVAL
+
+        _, writable, _ = select.select([], [server_side], [], max(0.0, next_control - time.perf_counter()))
+        if writable:
+            connection.flush()
+
+    elapsed = time.perf_counter() - start
+    server_side.shutdown(socket.SHUT_WR)
+    reader.join()
+    connection.close()
+    server_side.close()
+    client_side.close()
+    return sorted(latencies), elapsed
+
+
+def percentile(values, fraction: float) -> float:
+
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1e3
+
+
+def run():
+
+    size = REPLAY_FRAMES * len(encode_frame('@history', REPLAY_LINE))
+    print(f'{REPLAY_FRAMES} replay frames ({size / 1e6:.0f} MB), presence every {CONTROL_INTERVAL * 1000:.0f} ms')
+    print(f'{"scheduling":>12} {"frames":>7} {"p50 ms":>8} {"p99 ms":>8} {"max ms":>8} {"replay s":>9}')
+
+    for name, control_priority, replay_priority in (('priority', CONTROL, BULK), ('fifo', CHAT, CHAT)):
+        latencies, elapsed = run_case(control_priority, replay_priority)
+        print(
+            f'{name:>12} {len(latencies):>7} {percentile(latencies, 0.5):>8.2f} '
+            f'{percentile(latencies, 0.99):>8.2f} {latencies[-1] * 1e3:>8.2f} {elapsed:>9.2f}'
+        )
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,58 @@
+"""
+Sampling profiler overhead benchmark.
+Times a broadcast workload with the profiler off and at several sample
+intervals.
+
+Usage: python -m benchmarks.bench_profiler
+"""
+
+import tempfile
+import threading
+import time
+from src.connection import Connection
+from src.message_handler import broadcast_message
+from src.profiler import SamplingProfiler
+from src.protocol import encode_message
+
+RECIPIENTS = 100
+MESSAGES = 1000000
+INTERVALS = [0.01, 0.005, 0.001]
+
+
+class NullSocket:
+
+    def send(self, data):
+        return len(data)
+
+
+def workload() -> float:
+
+    sockets = [NullSocket() for _ in range(RECIPIENTS)]
+    client_dict = {sock: Connection(sock, b'3         ', b'Bob') for sock in sockets}
+    user_header, user_data = encode_message('Alice')
+    msg_header, msg_data = encode_message('Hello everyone')
+
+    start = time.perf_counter()
+    for _ in range(MESSAGES // RECIPIENTS):
+        broadcast_message(None, client_dict, user_header, user_data, msg_header, msg_data)
+    return time.perf_counter() - start
+
+
+def run():
+
+    baseline = min(workload() for _ in range(3))
+    print(f'{"interval":>10} {"seconds":>10} {"slowdown":>10} {"samples":>10}')
+    print(f'{"off":>10} {baseline:>10.3f} {"":>10} {"":>10}')
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        for interval in INTERVALS:
+            profiler = SamplingProfiler(interval=interval, output_dir=output_dir)
+            profiler.start(threading.get_ident())
+            elapsed = min(workload() for _ in range(3))
+            profiler.stop(wait=True)
+            slowdown = elapsed / baseline - 1
+            print(f'{interval * 1000:>8.0f}ms {elapsed:>10.3f} {slowdown:>10.1%} {profiler.samples:>10}')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,119 @@
+"""
+Loopback TCP vs Unix domain socket benchmark.
+Starts a server listening on both, then times messages relayed from one
+client to another over each transport: one at a time for latency, and as a
+pipelined burst for throughput.
+
+Usage: python -m benchmarks.bench_transport
+"""
+
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from src.protocol import HEADER_LENGTH, decode_header, encode_message
+
+LATENCY_MESSAGES = 5000
+BURST_MESSAGES = 50000
+MESSAGE = 'status: all systems nominal ' * 4
+
+
+def free_port() -> int:
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def connect(address, username: str):
+
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    for _ in range(100):
+        try:
+            client = socket.socket(family, socket.SOCK_STREAM)
+            client.connect(address)
+            break
+        except (ConnectionRefusedError, FileNotFoundError):
+            client.close()
+            time.sleep(0.05)
+    if family == socket.AF_INET:
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    client.sendall(b''.join(encode_message(username)))
+    return client
+
+
+def read_frame(reader):
+
+    username = reader.read(decode_header(reader.read(HEADER_LENGTH)))
+    return username, reader.read(decode_header(reader.read(HEADER_LENGTH)))
+
+
+def skip_presence(reader):
+    # The receiver gets a roster snapshot and diffs as clients arrive;
+    # a marker message shows where the benchmark traffic starts.
+
+    while read_frame(reader)[1] != b'ready':
+        pass
+
+
+def run_case(address):
+
+    sender = connect(address, 'Sender')
+    receiver = connect(address, 'Receiver')
+    reader = receiver.makefile('rb')
+    frame = b''.join(encode_message(MESSAGE))
+    try:
+        time.sleep(0.5)
+        sender.sendall(b''.join(encode_message('ready')))
+        skip_presence(reader)
+
+        latencies = []
+        for _ in range(LATENCY_MESSAGES):
+            start = time.perf_counter()
+            sender.sendall(frame)
+            read_frame(reader)
+            latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        sender.sendall(frame * BURST_MESSAGES)
+        for _ in range(BURST_MESSAGES):
+            read_frame(reader)
+        elapsed = time.perf_counter() - start
+    finally:
+        sender.close()
+        receiver.close()
+
+    latencies.sort()
+    return latencies, BURST_MESSAGES / elapsed
+
+
+def run():
+
+    port = free_port()
+    path = os.path.join(tempfile.mkdtemp(), 'chat.sock')
+    env = dict(
+        os.environ,
+        CHAT_SERVER_PORT=str(port),
+        CHAT_WS_PORT=str(free_port()),
+        CHAT_SERVER_SOCKET=path
+    )
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'src.server'], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        print(f'{len(MESSAGE)} byte messages relayed through the server')
+        print(f'{"transport":>10} {"p50 us":>8} {"p99 us":>8} {"burst msg/s":>12}')
+        for name, address in (('tcp', ('127.0.0.1', port)), ('unix', path)):
+            latencies, rate = run_case(address)
+            p50 = latencies[len(latencies) // 2] * 1e6
+            p99 = latencies[int(len(latencies) * 0.99)] * 1e6
+            print(f'{name:>10} {p50:>8.1f} {p99:>8.1f} {rate:>12.0f}')
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    run()
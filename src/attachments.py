@@ -0,0 +1,240 @@
+"""
+Chat Attachments
+Chunked file transfer. Uploads are spooled to disk chunk by chunk and
+downloads are streamed from the spool file with os.sendfile.
+"""
+
+import itertools
+import os
+import tempfile
+import time
+from collections import deque
+from src.protocol import DEFAULT_ROOM, encode_header, encode_message
+from src.websocket import WEBSOCKET, OP_BINARY, encode_frame_header
+
+SPOOL_DIR = os.getenv('CHAT_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'chat-spool'))
+MAX_ATTACHMENT_SIZE = int(os.getenv('CHAT_MAX_ATTACHMENT_SIZE', str(1024 * 1024 * 1024)))
+# Seconds a finished attachment stays fetchable before its spool file
+# is deleted
+ATTACHMENT_TTL = float(os.getenv('CHAT_ATTACHMENT_TTL', '3600'))
+# Small enough that a chat frame never waits behind more than one chunk
+CHUNK_SIZE = 16 * 1024
+
+ATTACH_COMMAND = '/attach '
+FETCH_COMMAND = '/fetch '
+# Download chunks are sent as messages from '@file:<id>'. Upload chunks
+# carry the same tag and a newline ahead of their data, so the server
+# can tell them from chat sent while the upload is running.
+FILE_USER_PREFIX = '@file:'
+_UPLOAD_TAG = FILE_USER_PREFIX.encode('ascii')
+
+
+class Upload:
+
+    def __init__(self, attachment_id: str, name: str, size: int, path: str, room: str = DEFAULT_ROOM):
+        self.attachment_id = attachment_id
+        self.name = name
+        self.size = size
+        self.path = path
+        # Only members of this room are told about it or may fetch it
+        self.room = room
+        self.received = 0
+        self.file = open(path, 'wb')
+
+    def write(self, data: bytes) -> bool:
+        # Returns True once the whole attachment has arrived.
+        data = data[:self.size - self.received]
+        self.file.write(data)
+        self.received += len(data)
+        if self.received < self.size:
+            return False
+        self.file.close()
+        return True
+
+    def abort(self):
+        self.file.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class Download:
+    # Streams one spooled attachment to one client, a chunk frame at a
+    # time. A frame that is partly written must be finished before
+    # anything else goes out on the socket.
+
+    def __init__(self, attachment_id: str, path: str, size: int, transport: str = None):
+        self.attachment_id = attachment_id
+        self.size = size
+        self.transport = transport
+        self.offset = 0
+        self.fd = os.open(path, os.O_RDONLY)
+        self.prefix = b''
+        self.frame_remaining = 0
+        user_header, user_data = encode_message(FILE_USER_PREFIX + attachment_id)
+        self.user_prefix = user_header + user_data
+
+    @property
+    def in_frame(self) -> bool:
+        return bool(self.prefix) or self.frame_remaining > 0
+
+    @property
+    def done(self) -> bool:
+        return self.offset >= self.size and not self.in_frame
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _start_frame(self):
+        length = min(CHUNK_SIZE, self.size - self.offset)
+        if self.transport == WEBSOCKET:
+            self.prefix = encode_frame_header(length, OP_BINARY)
+        else:
+            self.prefix = self.user_prefix + encode_header(length)
+        self.frame_remaining = length
+
+    def send_chunk(self, sock) -> bool:
+        # Writes at most one chunk frame. Returns True when the frame is
+        # complete, False when the socket would block part way through.
+        if not self.in_frame:
+            if self.offset >= self.size:
+                return True
+            self._start_frame()
+
+        try:
+            while self.prefix:
+                sent = sock.send(self.prefix)
+                self.prefix = self.prefix[sent:]
+
+            while self.frame_remaining:
+                sent = os.sendfile(sock.fileno(), self.fd, self.offset, self.frame_remaining)
+                if sent == 0:
+                    raise ConnectionError('attachment file truncated')
+                self.offset += sent
+                self.frame_remaining -= sent
+        except (BlockingIOError, InterruptedError):
+            return False
+
+        return True
+
+
+class AttachmentStore:
+
+    def __init__(self, spool_dir: str = SPOOL_DIR, ttl: float = ATTACHMENT_TTL, clock=time.monotonic):
+        self.spool_dir = spool_dir
+        self.ttl = ttl
+        self.clock = clock
+        os.makedirs(spool_dir, exist_ok=True)
+        self.uploads = {}
+        self.attachments = {}
+        # (expires, attachment_id) in completion order, so oldest first
+        self.expiry = deque()
+        self._ids = itertools.count(1)
+        self._remove_stale()
+
+    def _remove_stale(self):
+        # Spool files are named <pid>-<id>. Files of servers that are no
+        # longer running are left over from a crash or restart; the spool
+        # may be shared with other live servers, whose files are kept.
+        for name in os.listdir(self.spool_dir):
+            pid = name.partition('-')[0]
+            if not pid.isdigit():
+                continue
+            try:
+                os.kill(int(pid), 0)
+                continue
+            except ProcessLookupError:
+                pass
+            except PermissionError:
+                continue
+            try:
+                os.unlink(os.path.join(self.spool_dir, name))
+            except OSError:
+                pass
+
+    def begin_upload(self, client_socket, name: str, size: int, room: str = DEFAULT_ROOM) -> Upload:
+
+        if size <= 0 or size > MAX_ATTACHMENT_SIZE:
+            raise ValueError(f'attachment size must be between 1 and {MAX_ATTACHMENT_SIZE} bytes')
+
+        self.abort_upload(client_socket)
+        attachment_id = str(next(self._ids))
+        path = os.path.join(self.spool_dir, f'{os.getpid()}-{attachment_id}')
+        upload = self.uploads[client_socket] = Upload(attachment_id, name, size, path, room)
+        return upload
+
+    def write_chunk(self, client_socket, attachment_id: str, data: bytes):
+        # Returns the finished Upload once its last chunk is written.
+        # Chunks for an upload that is no longer open are dropped.
+
+        upload = self.uploads.get(client_socket)
+        if upload is None or upload.attachment_id != attachment_id:
+            return None
+        if not upload.write(data):
+            return None
+
+        del self.uploads[client_socket]
+        self.attachments[upload.attachment_id] = upload
+        self.expiry.append((self.clock() + self.ttl, upload.attachment_id))
+        return upload
+
+    def abort_upload(self, client_socket):
+        upload = self.uploads.pop(client_socket, None)
+        if upload is not None:
+            upload.abort()
+
+    def timeout(self):
+        # Seconds until the next attachment expires, or None.
+
+        if not self.expiry:
+            return None
+        return max(0.0, self.expiry[0][0] - self.clock())
+
+    def expire(self):
+        # Deletes attachments past their TTL. Downloads already running
+        # keep their open descriptor and finish normally.
+
+        now = self.clock()
+        while self.expiry and self.expiry[0][0] <= now:
+            _, attachment_id = self.expiry.popleft()
+            upload = self.attachments.pop(attachment_id)
+            try:
+                os.unlink(upload.path)
+            except OSError:
+                pass
+
+    def open_download(self, attachment_id: str, room: str, transport: str = None) -> Download:
+        # Attachments in other rooms are reported as missing, so their ids
+        # cannot be probed from outside.
+
+        upload = self.attachments.get(attachment_id)
+        if upload is None or upload.room != room:
+            return None
+        return Download(attachment_id, upload.path, upload.size, transport)
+
+
+def encode_upload_chunk(attachment_id: str, data: bytes) -> bytes:
+
+    tag = f'{FILE_USER_PREFIX}{attachment_id}\n'.encode('ascii')
+    return encode_header(len(tag) + len(data)) + tag + data
+
+
+def parse_upload_chunk(data: bytes):
+    # '@file:<id>\n<data>' -> (id, data), or None for any other message.
+
+    if not data.startswith(_UPLOAD_TAG):
+        return None
+    end = data.find(b'\n', len(_UPLOAD_TAG))
+    if end < 0:
+        return None
+    return data[len(_UPLOAD_TAG):end].decode('ascii', 'replace'), data[end + 1:]
+
+
+def parse_attach_command(content: str) -> tuple:
+    # '/attach <size> <name>' -> (size, name)
+
+    size, _, name = content[len(ATTACH_COMMAND):].strip().partition(' ')
+    return int(size), name.strip() or 'attachment'
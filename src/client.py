@@ -4,73 +4,312 @@ Connects to chat server and handles sending/receiving messages.
 """
 
 import socket
-import errno
+import json
+import queue
+import select
 import sys
 import threading
+import time
+from collections import deque
 from src.protocol import HEADER_LENGTH, encode_message, decode_message, decode_header
+from src.attachments import ATTACH_COMMAND, CHUNK_SIZE, FILE_USER_PREFIX, encode_upload_chunk
 
 # Server configuration
 import os
 HOST = os.getenv('CHAT_SERVER_HOST', '127.0.0.1')
 PORT = int(os.getenv('CHAT_SERVER_PORT', '1234'))
+# Set to the server's CHAT_SERVER_SOCKET path to connect over AF_UNIX
+SERVER_SOCKET = os.getenv('CHAT_SERVER_SOCKET')
+DOWNLOAD_DIR = os.getenv('CHAT_DOWNLOAD_DIR', 'downloads')
 
+# Display limits for busy rooms
+RENDER_RATE = 30  # Redraws per second at most
+SCROLLBACK_LINES = int(os.getenv('CHAT_SCROLLBACK', '1000'))
+RECV_SIZE = 65536
+# Bytes read per wakeup before rendering, so a flood cannot starve redraws
+MAX_DRAIN = 1 << 20
 
-def receive_messages(client_socket):
+# Downloads announced by the server, keyed by attachment id
+downloads = {}
+# The server's answer to an /attach request: the upload id, or None
+upload_replies = queue.Queue()
+# Held while an attachment is being sent; the server takes one at a time
+upload_lock = threading.Lock()
+# Chat and upload chunks are sent from different threads; each frame is
+# written whole under this lock
+send_lock = threading.Lock()
+
+
+def send_all(client_socket, data: bytes):
+
+    view = memoryview(data)
+    with send_lock:
+        while view:
+            try:
+                sent = client_socket.send(view)
+            except BlockingIOError:
+                select.select([], [client_socket], [])
+                continue
+            view = view[sent:]
+
+
+def handle_file_notice(message_str: str):
+    # '@file' notices announce uploads being accepted and downloads starting
+
+    if message_str.startswith('Ready for '):
+        upload_replies.put(message_str.rpartition(' as ')[2])
+    elif message_str.startswith('Upload refused'):
+        upload_replies.put(None)
+    elif message_str.startswith('Sending '):
+        attachment_id, size, name = message_str[len('Sending '):].split(' ', 2)
+        os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+        path = os.path.join(DOWNLOAD_DIR, os.path.basename(name) or attachment_id)
+        downloads[attachment_id] = [open(path, 'wb'), int(size), path]
+
+
+def format_presence(message_str: str) -> str:
+    # Snapshots list the roster; diffs list what changed
+
+    update = json.loads(message_str)
+    if 'members' in update:
+        return f"In {update['room']}: {', '.join(update['members'])}"
+
+    parts = [f'{name} joined' for name in update['joined']]
+    parts += [f'{name} left' for name in update['left']]
+    parts += [f'{name} is typing' for name in update['typing']]
+    return ', '.join(parts)
+
+
+def save_chunk(attachment_id: str, data: bytes):
+
+    download = downloads.get(attachment_id)
+    if download is None:
+        return
+    download[0].write(data)
+    download[1] -= len(data)
+    if download[1] <= 0:
+        download[0].close()
+        del downloads[attachment_id]
+        return f'Saved {download[2]}'
+
+
+class FrameReader:
+    # Splits the received byte stream into (username, message) frames.
+    # A partial frame stays buffered until the rest arrives.
+
+    __slots__ = ('buffer',)
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> list:
+
+        self.buffer += data
+        frames = []
+        offset = 0
+        while len(self.buffer) - offset >= HEADER_LENGTH:
+            user_length = decode_header(self.buffer[offset:offset + HEADER_LENGTH])
+            msg_start = offset + HEADER_LENGTH + user_length
+            if len(self.buffer) < msg_start + HEADER_LENGTH:
+                break
+            msg_length = decode_header(self.buffer[msg_start:msg_start + HEADER_LENGTH])
+            end = msg_start + HEADER_LENGTH + msg_length
+            if len(self.buffer) < end:
+                break
+            frames.append((
+                bytes(self.buffer[offset + HEADER_LENGTH:msg_start]),
+                bytes(self.buffer[msg_start + HEADER_LENGTH:end])
+            ))
+            offset = end
+        del self.buffer[:offset]
+        return frames
+
+
+class Renderer:
+    # Collects display lines and writes them out in one buffered write, at
+    # most rate times a second. Only the last scrollback lines are kept;
+    # a burst larger than that is summarised rather than printed.
+
+    def __init__(self, out=None, rate: int = RENDER_RATE, scrollback: int = SCROLLBACK_LINES,
+                 clock=time.monotonic):
+        self.out = out
+        self.interval = 1 / rate
+        self.clock = clock
+        self.lines = deque(maxlen=scrollback)
+        self.unrendered = 0
+        self.next_render = 0.0
+
+    def add(self, line: str):
+        self.lines.append(line)
+        self.unrendered += 1
+
+    def timeout(self):
+        # Seconds until pending lines may be drawn, or None when idle.
+
+        if not self.unrendered:
+            return None
+        return max(0.0, self.next_render - self.clock())
+
+    def render(self, force: bool = False) -> bool:
+
+        now = self.clock()
+        if not self.unrendered or (not force and now < self.next_render):
+            return False
+
+        shown = min(self.unrendered, len(self.lines))
+        parts = []
+        if self.unrendered > shown:
+            parts.append(f'\n... {self.unrendered - shown} earlier messages not shown\n')
+        parts.extend(f'\n{line}\n' for line in list(self.lines)[-shown:])
+        out = self.out or sys.stdout
+        out.write(''.join(parts))
+        out.flush()
+
+        self.unrendered = 0
+        self.next_render = now + self.interval
+        return True
+
+
+def read_available(client_socket) -> tuple:
+    # Reads everything the socket has ready, up to MAX_DRAIN bytes.
+    # Returns (data, closed).
+
+    chunks = []
+    total = 0
+    while total < MAX_DRAIN:
+        try:
+            chunk = client_socket.recv(RECV_SIZE)
+        except BlockingIOError:
+            break
+        if not chunk:
+            return b''.join(chunks), True
+        chunks.append(chunk)
+        total += len(chunk)
+    return b''.join(chunks), False
+
+
+def format_frame(username: bytes, message: bytes):
+    # Returns the line to display for a frame, or None.
+
+    username_str = decode_message(username)
+
+    # Attachment chunks are raw file data
+    if username_str.startswith(FILE_USER_PREFIX):
+        return save_chunk(username_str[len(FILE_USER_PREFIX):], message)
+
+    message_str = decode_message(message)
+    if username_str == '@file':
+        handle_file_notice(message_str)
+    elif username_str == '@presence':
+        message_str = format_presence(message_str)
+        if not message_str:
+            return None
+    return f'{username_str} > {message_str}'
+
+
+def receive_messages(client_socket, renderer=None):
+    # Sleeps in select until data arrives or a held-back redraw is due,
+    # then drains every complete frame and draws them together.
+
+    renderer = renderer or Renderer()
+    reader = FrameReader()
 
     while True:
         try:
-            # Receive username header
-            user_header = client_socket.recv(HEADER_LENGTH)
-            
-            # Server closed connection
-            if not len(user_header):
-                print('\nConnection closed by server')
-                sys.exit()
-            
-            # Get username
-            user_length = decode_header(user_header)
-            username = client_socket.recv(user_length)
-            username_str = decode_message(username)
-            
-            # Get message header
-            msg_header = client_socket.recv(HEADER_LENGTH)
-            msg_length = decode_header(msg_header)
-            message = client_socket.recv(msg_length)
-            message_str = decode_message(message)
-            
-            # Display message
-            print(f'\n{username_str} > {message_str}')
-            print('', end='', flush=True)  # Re-prompt for input
-            
-        except IOError as e:
-            # No more messages to receive
-            if e.errno != errno.EAGAIN and e.errno != errno.EWOULDBLOCK:
-                print(f'\nReceiving error: {str(e)}')
-                sys.exit()
-            continue
-            
+            readable, _, _ = select.select([client_socket], [], [], renderer.timeout())
+            if readable:
+                data, closed = read_available(client_socket)
+                for username, message in reader.feed(data):
+                    # One malformed frame must not stop the receive thread
+                    try:
+                        line = format_frame(username, message)
+                    except (ValueError, KeyError, TypeError, OSError) as e:
+                        line = f'Could not display message: {e}'
+                    if line:
+                        renderer.add(line)
+
+                # Server closed connection
+                if closed:
+                    renderer.add('Connection closed by server')
+                    renderer.render(force=True)
+                    return
+
+            renderer.render()
+
+        except OSError as e:
+            renderer.render(force=True)
+            print(f'\nReceiving error: {str(e)}')
+            return
+
         except Exception as e:
+            renderer.render(force=True)
             print(f'\nError: {str(e)}')
-            sys.exit()
+            return
 
 
 def send_message_to_server(client_socket, message: str):
 
     msg_header, msg_data = encode_message(message)
-    client_socket.send(msg_header + msg_data)
+    send_all(client_socket, msg_header + msg_data)
+
+
+def send_attachment(client_socket, path: str):
+    # Announce the file, wait for the server to accept it, then stream it
+    # in chunks so the whole file is never held in memory. Runs on its
+    # own thread; chat typed meanwhile goes out between chunks.
+
+    try:
+        size = os.path.getsize(path)
+    except OSError as e:
+        print(f'Cannot attach {path}: {e.strerror}')
+        return
+
+    if not upload_lock.acquire(blocking=False):
+        print('An upload is already in progress')
+        return
+
+    try:
+        # Drop any answer that arrived after an earlier request timed out
+        while not upload_replies.empty():
+            upload_replies.get_nowait()
+
+        send_message_to_server(client_socket, f'{ATTACH_COMMAND}{size} {os.path.basename(path)}')
+        try:
+            attachment_id = upload_replies.get(timeout=5)
+        except queue.Empty:
+            attachment_id = None
+        if attachment_id is None:
+            print('Upload not accepted by server')
+            return
+
+        with open(path, 'rb') as attachment:
+            while True:
+                chunk = attachment.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                send_all(client_socket, encode_upload_chunk(attachment_id, chunk))
+    finally:
+        upload_lock.release()
 
 
-def connect_to_server(username: str):
+def connect_to_server(username: str, socket_path: str = None):
 
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client_socket.connect((HOST, PORT))
+    socket_path = socket_path or SERVER_SOCKET
+    if socket_path:
+        client_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client_socket.connect(socket_path)
+        target = socket_path
+    else:
+        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client_socket.connect((HOST, PORT))
+        target = f'{HOST}:{PORT}'
     client_socket.setblocking(False)
     
     # Send username to server
     user_header, user_data = encode_message(username)
     client_socket.send(user_header + user_data)
     
-    print(f'Connected to {HOST}:{PORT} as {username}')
+    print(f'Connected to {target} as {username}')
     
     return client_socket
 
@@ -87,8 +326,8 @@ def run_client():
     # Connect to server
     try:
         client_socket = connect_to_server(username)
-    except ConnectionRefusedError:
-        print(f'Could not connect to server at {HOST}:{PORT}')
+    except (ConnectionRefusedError, FileNotFoundError):
+        print(f'Could not connect to server at {SERVER_SOCKET or f"{HOST}:{PORT}"}')
         print('Make sure the server is running.')
         sys.exit()
     except Exception as e:
@@ -111,7 +350,13 @@ def run_client():
         while True:
             message = input('')
             
-            if message:
+            if message.startswith(ATTACH_COMMAND):
+                threading.Thread(
+                    target=send_attachment,
+                    args=(client_socket, message[len(ATTACH_COMMAND):].strip()),
+                    daemon=True
+                ).start()
+            elif message:
                 send_message_to_server(client_socket, message)
                 
     except KeyboardInterrupt:
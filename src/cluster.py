@@ -0,0 +1,392 @@
+"""
+Chat Cluster
+Links several server nodes into a mesh over persistent TCP peer links.
+Each node relays broadcasts in batches, and only to peers that have
+members in the message's room.
+"""
+
+import errno
+import os
+import socket
+import time
+from src.protocol import HEADER_LENGTH, encode_header, decode_header
+
+CLUSTER_PORT = int(os.getenv('CHAT_CLUSTER_PORT', '0'))
+# Comma separated host:port list of the other nodes' cluster ports
+CLUSTER_PEERS = os.getenv('CHAT_CLUSTER_PEERS', '')
+# Name this node gives itself in HELLO frames and logs
+CLUSTER_ADVERTISE = os.getenv('CHAT_CLUSTER_ADVERTISE', '')
+
+RECONNECT_INTERVAL = 2.0
+MAX_BATCH_BYTES = 256 * 1024
+# Output a peer may fall behind by before its link is dropped
+MAX_PEER_BUFFER = 8 * 1024 * 1024
+RECV_SIZE = 65536
+
+# Peer frame kinds, sent as the first payload byte. The dialing node sends
+# HELLO and BATCH frames; the accepting node answers on the same socket
+# with INTEREST frames listing the rooms it has members in.
+KIND_HELLO = b'H'
+KIND_INTEREST = b'I'
+KIND_BATCH = b'B'
+
+
+def parse_peer_list(value: str) -> list:
+
+    peers = []
+    for entry in value.split(','):
+        entry = entry.strip()
+        if entry:
+            host, _, port = entry.rpartition(':')
+            peers.append((host, int(port)))
+    return peers
+
+
+def format_address(address) -> str:
+
+    return f'{address[0]}:{address[1]}'
+
+
+def encode_peer_frame(kind: bytes, payload: bytes) -> bytes:
+
+    return encode_header(len(payload) + 1) + kind + payload
+
+
+def encode_relay_record(room: str, user_header, user_data, msg_header, msg_data) -> bytes:
+
+    room_data = room.encode('utf-8')
+    return encode_header(len(room_data)) + room_data + user_header + user_data + msg_header + msg_data
+
+
+def decode_relay_records(batch: bytes):
+    # Yields (room, user_header, user_data, msg_header, msg_data).
+
+    offset = 0
+    while offset < len(batch):
+        parts = []
+        for _ in range(3):
+            header = batch[offset:offset + HEADER_LENGTH]
+            length = decode_header(header)
+            offset += HEADER_LENGTH
+            parts.append((header, batch[offset:offset + length]))
+            offset += length
+        room = parts[0][1].decode('utf-8')
+        yield room, parts[1][0], parts[1][1], parts[2][0], parts[2][1]
+
+
+class PeerChannel:
+    # Non-blocking peer socket. Frames queue in `outbox` and go out as the
+    # socket takes them, so a slow peer never stalls the server loop.
+
+    def __init__(self, sock=None, node_id: str = None):
+        self.sock = sock
+        self.node_id = node_id
+        self.connecting = False
+        self.inbox = bytearray()
+        self.outbox = bytearray()
+
+    def wants_write(self) -> bool:
+        return self.connecting or bool(self.outbox)
+
+    def queue(self, frame: bytes) -> bool:
+        # Returns False once the link should be dropped.
+        self.outbox += frame
+        if len(self.outbox) > MAX_PEER_BUFFER:
+            print(f'Cluster peer {self.node_id} fell {len(self.outbox)} bytes behind')
+            return False
+        return self.write()
+
+    def write(self) -> bool:
+        if self.connecting:
+            return True
+        while self.outbox:
+            try:
+                sent = self.sock.send(self.outbox)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                print(f'Cluster send error to {self.node_id}: {e}')
+                return False
+            del self.outbox[:sent]
+        return True
+
+    def read_frames(self) -> tuple:
+        # Returns ([(kind, payload)], closed) for everything received so
+        # far. A partial frame stays in `inbox` for the next call.
+        closed = False
+        try:
+            while True:
+                chunk = self.sock.recv(RECV_SIZE)
+                if not chunk:
+                    closed = True
+                    break
+                self.inbox += chunk
+                if len(chunk) < RECV_SIZE:
+                    break
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            print(f'Cluster link error: {e}')
+            closed = True
+
+        frames = []
+        offset = 0
+        try:
+            while len(self.inbox) - offset >= HEADER_LENGTH:
+                end = offset + HEADER_LENGTH + decode_header(self.inbox[offset:offset + HEADER_LENGTH])
+                if len(self.inbox) < end:
+                    break
+                body = bytes(self.inbox[offset + HEADER_LENGTH:end])
+                frames.append((body[:1], body[1:]))
+                offset = end
+        except ValueError as e:
+            print(f'Cluster link error: {e}')
+            closed = True
+        del self.inbox[:offset]
+        return frames, closed
+
+
+class PeerLink(PeerChannel):
+    # Outbound link to one peer. Relayed records queue up in `pending`
+    # and go out as a single batch frame on flush(). The peer's room
+    # interest arrives on this same socket.
+
+    def __init__(self, address):
+        super().__init__(node_id=format_address(address))
+        self.address = address
+        self.interest = set()
+        self.pending = []
+        self.pending_bytes = 0
+        self.next_attempt = 0.0
+
+    def connect(self, node_id: str) -> bool:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            error = sock.connect_ex(self.address)
+        except OSError as e:
+            error = e.errno
+        if error not in (0, errno.EINPROGRESS):
+            sock.close()
+            self.next_attempt = time.monotonic() + RECONNECT_INTERVAL
+            return False
+
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        self.connecting = error != 0
+        self.queue(encode_peer_frame(KIND_HELLO, node_id.encode('utf-8')))
+        if not self.connecting:
+            print(f'Cluster link up to {self.node_id}')
+        return True
+
+    def finish_connect(self) -> bool:
+        # Called when the socket turns writable during connect.
+        error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self.close(quiet=True)
+            return False
+        self.connecting = False
+        print(f'Cluster link up to {self.node_id}')
+        return self.write()
+
+    def close(self, quiet: bool = False):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            if not quiet and not self.connecting:
+                print(f'Cluster link down to {self.node_id}')
+        self.connecting = False
+        self.inbox = bytearray()
+        self.outbox = bytearray()
+        self.interest = set()
+        self.pending = []
+        self.pending_bytes = 0
+        self.next_attempt = time.monotonic() + RECONNECT_INTERVAL
+
+    def flush(self):
+        if self.sock is None or not self.pending:
+            return
+        batch = b''.join(self.pending)
+        self.pending = []
+        self.pending_bytes = 0
+        if not self.queue(encode_peer_frame(KIND_BATCH, batch)):
+            self.close()
+
+
+class ClusterNode:
+
+    def __init__(self, deliver, host: str = '0.0.0.0', port: int = CLUSTER_PORT, node_id: str = None):
+        # deliver(room, user_header, user_data, msg_header, msg_data) hands
+        # relayed messages to local clients.
+        self.deliver = deliver
+        self.host = host
+        self.port = port
+        self.node_id = node_id
+        self.listen_socket = None
+        self.links = {}
+        self.inbound = {}
+        self.room_members = {}
+
+    def start(self):
+        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_socket.bind((self.host, self.port))
+        self.listen_socket.listen()
+        self.listen_socket.setblocking(False)
+        self.port = self.listen_socket.getsockname()[1]
+        if not self.node_id:
+            self.node_id = format_address((socket.gethostname(), self.port))
+        print(f'Cluster node {self.node_id} listening on {self.host}:{self.port}')
+
+    def stop(self):
+        for link in self.links.values():
+            link.close(quiet=True)
+        for sock in list(self.inbound):
+            sock.close()
+        self.inbound.clear()
+        if self.listen_socket is not None:
+            self.listen_socket.close()
+            self.listen_socket = None
+
+    def add_peer(self, address):
+        link = PeerLink(address)
+        self.links[link.node_id] = link
+        link.connect(self.node_id)
+
+    def sockets(self) -> list:
+        # Sockets the server loop should select on for reading.
+        sockets = [self.listen_socket]
+        sockets.extend(self.inbound)
+        sockets.extend(link.sock for link in self.links.values() if link.sock is not None)
+        return sockets
+
+    def write_sockets(self) -> list:
+        # Sockets with output waiting or a connect in progress.
+        channels = list(self.inbound.values()) + list(self.links.values())
+        return [channel.sock for channel in channels if channel.sock is not None and channel.wants_write()]
+
+    def owns(self, sock) -> bool:
+        if sock is self.listen_socket or sock in self.inbound:
+            return True
+        return self._link_for(sock) is not None
+
+    def _link_for(self, sock):
+        for link in self.links.values():
+            if link.sock is sock:
+                return link
+        return None
+
+    def _drop_inbound(self, sock):
+        channel = self.inbound.pop(sock, None)
+        if channel is not None:
+            sock.close()
+
+    def handle_readable(self, sock):
+        if sock is self.listen_socket:
+            try:
+                peer_socket, _ = self.listen_socket.accept()
+            except BlockingIOError:
+                return
+            peer_socket.setblocking(False)
+            channel = self.inbound[peer_socket] = PeerChannel(peer_socket)
+            # Tell the dialer which rooms to relay here
+            if not channel.queue(self._interest_frame()):
+                self._drop_inbound(peer_socket)
+            return
+
+        if sock in self.inbound:
+            self._handle_inbound(sock)
+            return
+
+        link = self._link_for(sock)
+        if link is None:
+            return
+        frames, closed = link.read_frames()
+        for kind, payload in frames:
+            if kind == KIND_INTEREST:
+                rooms = payload.decode('utf-8')
+                link.interest = set(rooms.split('\n')) if rooms else set()
+        if closed:
+            link.close()
+
+    def handle_writable(self, sock):
+        if sock in self.inbound:
+            if not self.inbound[sock].write():
+                self._drop_inbound(sock)
+            return
+
+        link = self._link_for(sock)
+        if link is None:
+            return
+        if link.connecting:
+            link.finish_connect()
+        elif not link.write():
+            link.close()
+
+    def _handle_inbound(self, sock):
+        channel = self.inbound[sock]
+        frames, closed = channel.read_frames()
+
+        for kind, payload in frames:
+            if kind == KIND_HELLO:
+                channel.node_id = payload.decode('utf-8')
+            elif kind == KIND_BATCH:
+                for record in decode_relay_records(payload):
+                    self.deliver(*record)
+
+        if closed:
+            self._drop_inbound(sock)
+
+    def member_joined(self, room: str):
+        count = self.room_members.get(room, 0)
+        self.room_members[room] = count + 1
+        if count == 0:
+            self._announce_interest()
+
+    def member_left(self, room: str):
+        count = self.room_members.get(room, 0) - 1
+        if count > 0:
+            self.room_members[room] = count
+            return
+        self.room_members.pop(room, None)
+        self._announce_interest()
+
+    def _interest_frame(self) -> bytes:
+        return encode_peer_frame(KIND_INTEREST, '\n'.join(self.room_members).encode('utf-8'))
+
+    def _announce_interest(self):
+        frame = self._interest_frame()
+        for sock, channel in list(self.inbound.items()):
+            if not channel.queue(frame):
+                self._drop_inbound(sock)
+
+    def relay(self, room: str, user_header, user_data, msg_header, msg_data):
+        record = None
+        for link in self.links.values():
+            if link.sock is None or room not in link.interest:
+                continue
+            # Encode once, then share the record between peer batches
+            if record is None:
+                record = encode_relay_record(room, user_header, user_data, msg_header, msg_data)
+            link.pending.append(record)
+            link.pending_bytes += len(record)
+            if link.pending_bytes >= MAX_BATCH_BYTES:
+                link.flush()
+
+    def timeout(self):
+        # Seconds until the next peer redial is due, or None when all
+        # links are up. Used as the server loop's select timeout.
+        pending = [link.next_attempt for link in self.links.values() if link.sock is None]
+        if not pending:
+            return None
+        return max(0.0, min(pending) - time.monotonic())
+
+    def flush(self):
+        # Called once per loop iteration: sends batches and redials peers.
+        now = time.monotonic()
+        for link in self.links.values():
+            if link.sock is None:
+                if now >= link.next_attempt:
+                    link.connect(self.node_id)
+                continue
+            link.flush()
@@ -0,0 +1,330 @@
+"""
+Connection State
+Compact per-client state with lazily allocated receive/send buffers.
+"""
+
+import os
+import socket
+from collections import deque
+from src.protocol import DEFAULT_ROOM, decode_message, encode_header, split_frames
+from src.websocket import (
+    WEBSOCKET,
+    OP_CLOSE,
+    OP_PING,
+    OP_PONG,
+    CLOSE_TOO_BIG,
+    MAX_PAYLOAD_SIZE,
+    FrameError,
+    encode_close,
+    encode_frame,
+    parse_frame
+)
+from src.scheduler import CONTROL, CHAT, OutboundQueue
+
+RECV_SIZE = 65536
+# Most bytes taken off the priority queue per socket write
+SEND_BATCH = 16384
+# Output a client may fall behind by before it is disconnected
+MAX_QUEUED_BYTES = int(os.getenv('CHAT_MAX_QUEUED_BYTES', str(8 * 1024 * 1024)))
+
+_usernames = {}
+_username_refs = {}
+# Username headers only depend on the length, so there are few of them
+_headers = {}
+
+
+def intern_username(value: bytes) -> bytes:
+    # Returns the shared copy of a username, so reconnects and clients
+    # with the same name do not each hold their own bytes.
+
+    canonical = _usernames.get(value)
+    if canonical is None:
+        canonical = _usernames[value] = value
+        _username_refs[value] = 0
+    _username_refs[value] += 1
+    return canonical
+
+
+def release_username(value: bytes):
+
+    count = _username_refs.get(value)
+    if count is None:
+        return
+    if count > 1:
+        _username_refs[value] = count - 1
+        return
+    del _username_refs[value]
+    del _usernames[value]
+
+
+def username_header(length: int) -> bytes:
+
+    header = _headers.get(length)
+    if header is None:
+        header = _headers[length] = encode_header(length)
+    return header
+
+
+class Connection:
+    # Replaces the {'header': ..., 'data': ...} dict kept per client.
+
+    __slots__ = (
+        'sock', 'data', 'room', 'transport',
+        'recv_buffer', 'send_buffer', 'fragments', 'backlog', 'streams', 'queue', 'dropped'
+    )
+
+    def __init__(self, sock, header: bytes, data: bytes, transport: str = None, backlog: set = None):
+        # The header is rebuilt from the username length on demand
+        self.sock = sock
+        self.data = intern_username(data)
+        self.room = DEFAULT_ROOM
+        self.transport = transport
+        self.recv_buffer = None
+        self.send_buffer = None
+        self.fragments = None
+        self.backlog = backlog
+        self.streams = None
+        self.queue = None
+        self.dropped = False
+
+    @property
+    def header(self) -> bytes:
+        return username_header(len(self.data))
+
+    def close(self):
+        release_username(self.data)
+        self.recv_buffer = None
+        self.send_buffer = None
+        self.queue = None
+        self.fragments = None
+        if self.streams is not None:
+            for stream in self.streams:
+                stream.close()
+            self.streams = None
+        if self.backlog is not None:
+            self.backlog.discard(self)
+
+    def read_messages(self):
+        # Reads what the socket has and returns the complete messages as
+        # {'header', 'data'} dicts, or False when the peer has gone.
+        try:
+            chunk = self.sock.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return []
+        except socket.error as e:
+            print(f"Socket error: {e}")
+            return False
+
+        if not chunk:
+            return False
+
+        # Parse straight from the chunk while no partial frame is pending
+        if self.recv_buffer is None:
+            buffer = chunk
+        else:
+            self.recv_buffer += chunk
+            buffer = self.recv_buffer
+
+        if self.transport == WEBSOCKET:
+            messages, consumed = self._parse_websocket(buffer)
+            if messages is False:
+                return False
+        else:
+            frames, consumed = split_frames(buffer)
+            messages = [{'header': header, 'data': data} for header, data in frames]
+
+        # Release the buffer once idle; otherwise keep only the partial
+        # frame, in a buffer sized to it
+        if consumed == len(buffer):
+            self.recv_buffer = None
+        elif buffer is chunk or consumed:
+            self.recv_buffer = bytearray(buffer[consumed:])
+        return messages
+
+    def _parse_websocket(self, buffer):
+        # Oversized or unmasked frames close the connection with a status
+        # code, before more than their header is buffered.
+        messages = []
+        offset = 0
+        while True:
+            try:
+                frame = parse_frame(memoryview(buffer)[offset:], MAX_PAYLOAD_SIZE, require_mask=True)
+                if self.fragments is not None and frame is not None:
+                    if sum(map(len, self.fragments)) + len(frame[2]) > MAX_PAYLOAD_SIZE:
+                        raise FrameError(CLOSE_TOO_BIG, 'message too big')
+            except FrameError as e:
+                print(f'WebSocket protocol error: {e}')
+                self.send(encode_close(e.code), CONTROL)
+                return False, offset
+            if frame is None:
+                break
+            fin, opcode, payload, consumed = frame
+            offset += consumed
+
+            if opcode == OP_CLOSE:
+                self.send(encode_frame(payload[:2], OP_CLOSE), CONTROL)
+                return False, offset
+            if opcode == OP_PING:
+                self.send(encode_frame(payload, OP_PONG), CONTROL)
+                continue
+            if opcode == OP_PONG:
+                continue
+
+            if not fin:
+                if self.fragments is None:
+                    self.fragments = []
+                self.fragments.append(payload)
+                continue
+            if self.fragments is not None:
+                self.fragments.append(payload)
+                payload = b''.join(self.fragments)
+                self.fragments = None
+            messages.append({'header': encode_header(len(payload)), 'data': payload})
+        return messages, offset
+
+    def send(self, data: bytes, priority: int = CHAT):
+        # Sends immediately when nothing is waiting. Otherwise the frame is
+        # queued at its priority until the socket is writable again.
+        if self.dropped:
+            return
+
+        idle = self.send_buffer is None and self.queue is None
+        # Never write into the middle of a half-sent attachment chunk
+        if idle and not (self.streams is not None and self.streams[0].in_frame):
+            try:
+                sent = self.sock.send(data)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except socket.error as e:
+                print(f"Socket error: {e}")
+                return
+
+            # The unsent tail of a frame must go out before anything else
+            if sent < len(data):
+                self.send_buffer = bytearray(data[sent:])
+                if self.backlog is not None:
+                    self.backlog.add(self)
+            return
+
+        if self.queue is None:
+            self.queue = OutboundQueue()
+        self.queue.push(data, priority)
+        pending = self.queue.queued_bytes + (len(self.send_buffer) if self.send_buffer is not None else 0)
+        if pending > MAX_QUEUED_BYTES:
+            self._drop(pending)
+            return
+        if self.backlog is not None:
+            self.backlog.add(self)
+
+    def _drop(self, pending: int):
+        # A client that stops reading would otherwise hold every frame sent
+        # to it. Its output is discarded and the socket shut down, which
+        # makes it readable; the loop then removes the client as it would
+        # any closed connection.
+        print(f'Client {decode_message(self.data)} fell {pending} bytes behind, disconnecting')
+        self.dropped = True
+        self.queue = None
+        self.send_buffer = None
+        if self.streams is not None:
+            for stream in self.streams:
+                stream.close()
+            self.streams = None
+        if self.backlog is not None:
+            self.backlog.discard(self)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def add_stream(self, stream):
+        # Queues an attachment download. Its chunks are bulk output, sent
+        # after any queued bulk frames.
+        if self.streams is None:
+            self.streams = deque()
+        self.streams.append(stream)
+        if self.backlog is not None:
+            self.backlog.add(self)
+
+    def flush(self) -> bool:
+        # Called when the socket is writable. Returns True once drained.
+        # A frame already on the wire is finished first; after that the
+        # queue decides, and at most one new attachment chunk is sent.
+        if self.streams is not None and self.streams[0].in_frame:
+            if not self._send_chunk():
+                return False
+
+        while True:
+            if self.send_buffer is None and not self._fill_send_buffer():
+                break
+
+            if self.send_buffer is None:
+                # The queue picked an attachment chunk
+                if not self._send_chunk():
+                    return False
+                break
+
+            try:
+                sent = self.sock.send(self.send_buffer)
+            except (BlockingIOError, InterruptedError):
+                return False
+            except socket.error as e:
+                print(f"Socket error: {e}")
+                sent = len(self.send_buffer)
+
+            if sent < len(self.send_buffer):
+                del self.send_buffer[:sent]
+                return False
+
+            # Release the buffer entirely once it is written
+            self.send_buffer = None
+
+        if self.queue is not None or self.streams is not None:
+            return False
+        if self.backlog is not None:
+            self.backlog.discard(self)
+        return True
+
+    def _fill_send_buffer(self) -> bool:
+        # Moves frames from the queue into the send buffer in priority
+        # order, up to SEND_BATCH bytes so a later control frame is never
+        # stuck behind much. Returns False when nothing is waiting.
+        if self.queue is None:
+            return self.streams is not None
+
+        batch = None
+        while batch is None or len(batch) < SEND_BATCH:
+            priority = self.queue.next_level(self.streams is not None)
+            data = None if priority is None else self.queue.pop(priority)
+            if data is None:
+                break
+            if batch is None:
+                batch = bytearray(data)
+            else:
+                batch += data
+
+        if not self.queue:
+            self.queue = None
+        self.send_buffer = batch
+        return batch is not None or self.streams is not None
+
+    def _send_chunk(self) -> bool:
+        # Returns False when the socket would block part way through a chunk.
+        stream = self.streams[0]
+        try:
+            complete = stream.send_chunk(self.sock)
+        except (socket.error, ConnectionError) as e:
+            # The connection is going away; drop every pending download
+            print(f"Socket error: {e}")
+            for pending in self.streams:
+                pending.close()
+            self.streams = None
+            return True
+
+        if not complete:
+            return False
+        if stream.done:
+            stream.close()
+            self.streams.popleft()
+            if not self.streams:
+                self.streams = None
+        return True
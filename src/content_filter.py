@@ -0,0 +1,177 @@
+"""
+Content Filter
+Message filter pipeline with a multi-pattern (Aho-Corasick) matcher.
+"""
+
+import os
+import threading
+from collections import deque
+
+RELOAD_INTERVAL = 5.0
+
+
+class AhoCorasick:
+    # Matches every pattern in a single pass over the message bytes.
+    # Matching is ASCII case-insensitive.
+
+    def __init__(self, patterns):
+        self.patterns = []
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [None]
+
+        for pattern in patterns:
+            if isinstance(pattern, str):
+                pattern = pattern.encode('utf-8')
+            pattern = pattern.lower()
+            if pattern:
+                self._insert(pattern)
+
+        self._build_failure_links()
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def _insert(self, pattern: bytes):
+        state = 0
+        for byte in pattern:
+            next_state = self._goto[state].get(byte)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][byte] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(None)
+            state = next_state
+
+        if self._out[state] is None:
+            self._out[state] = len(self.patterns)
+            self.patterns.append(pattern)
+
+    def _build_failure_links(self):
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+
+        pending = deque(goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for byte, next_state in goto[state].items():
+                pending.append(next_state)
+
+                fallback = fail[state]
+                while fallback and byte not in goto[fallback]:
+                    fallback = fail[fallback]
+                fail[next_state] = goto[fallback].get(byte, 0)
+
+                # A state also reports anything its failure state matches
+                if out[next_state] is None:
+                    out[next_state] = out[fail[next_state]]
+
+    def search(self, data: bytes):
+        # Returns the first pattern found in data, or None.
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+
+        state = 0
+        for byte in data.lower():
+            while state and byte not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(byte, 0)
+            if out[state] is not None:
+                return self.patterns[out[state]]
+        return None
+
+
+def load_patterns(path: str) -> list:
+    # One pattern per line; blank lines and '#' comments are ignored.
+
+    with open(path, 'rb') as pattern_file:
+        patterns = []
+        for line in pattern_file:
+            line = line.strip()
+            if line and not line.startswith(b'#'):
+                patterns.append(line)
+        return patterns
+
+
+class PatternFilter:
+    # Filter stage that rejects messages containing any blocked pattern.
+
+    def __init__(self, patterns=()):
+        self.matcher = AhoCorasick(patterns)
+
+    def __call__(self, username: bytes, data: bytes):
+        # Read the reference once so a concurrent reload swaps atomically
+        match = self.matcher.search(data)
+        if match is not None:
+            return f'blocked term "{match.decode("utf-8", "replace")}"'
+        return None
+
+    def load(self, path: str):
+        self.matcher = AhoCorasick(load_patterns(path))
+
+
+class FilterPipeline:
+    # Ordered filter stages run between receive_message and
+    # broadcast_message. A stage returns a reason string to reject.
+
+    def __init__(self, stages=None):
+        self.stages = list(stages or [])
+
+    def add_stage(self, stage):
+        self.stages.append(stage)
+
+    def check(self, username: bytes, data: bytes):
+        for stage in self.stages:
+            reason = stage(username, data)
+            if reason:
+                return reason
+        return None
+
+
+class FilterReloader:
+    # Watches a pattern file and rebuilds the automaton in a background
+    # thread, so large pattern lists never stall the server loop.
+
+    def __init__(self, pattern_filter: PatternFilter, path: str, interval: float = RELOAD_INTERVAL):
+        self.pattern_filter = pattern_filter
+        self.path = path
+        self.interval = interval
+        self._mtime = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.check_for_changes()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def check_for_changes(self) -> bool:
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            print(f'Filter reload error: {e}')
+            return False
+
+        if mtime == self._mtime:
+            return False
+
+        self.pattern_filter.load(self.path)
+        self._mtime = mtime
+        print(f'Loaded {len(self.pattern_filter.matcher)} filter patterns from {self.path}')
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.check_for_changes()
+            except Exception as e:
+                print(f'Filter reload error: {e}')
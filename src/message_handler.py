@@ -1,5 +1,7 @@
 import socket
-from src.protocol import HEADER_LENGTH, decode_header, decode_message
+from src.protocol import HEADER_LENGTH, decode_header, decode_message, encode_message
+from src.websocket import WEBSOCKET, encode_chat_frame
+from src.scheduler import classify
 
 
 def receive_message(client_socket):
@@ -27,11 +29,60 @@ def send_message(client_socket, header: bytes, data: bytes):
     client_socket.send(header + data)
 
 
-def broadcast_message(sender_socket, client_dict, user_header, user_data, msg_header, msg_data):
+def send_notice(client_socket, client_info, username: str, message: str):
+    # Send a server-generated message in the client's own wire format.
+    # The Connection queues whatever the socket cannot take right away.
 
+    user_header, user_data = encode_message(username)
+    msg_header, msg_data = encode_message(message)
+    priority = classify(username)
+
+    if client_info.transport == WEBSOCKET:
+        client_info.send(encode_chat_frame(user_data, msg_data), priority)
+    else:
+        client_info.send(user_header + user_data + msg_header + msg_data, priority)
+
+
+def broadcast_message(sender_socket, client_dict, user_header, user_data, msg_header, msg_data, room=None):
+
+    # Each wire format is encoded at most once, not once per recipient
     full_message = user_header + user_data + msg_header + msg_data
+    websocket_frame = None
     
-    for client_socket in client_dict:
+    for client_socket, client_info in client_dict.items():
         # Don't send back to sender
-        if client_socket != sender_socket:
-            send_message(client_socket, full_message, b'')
+        if client_socket == sender_socket:
+            continue
+
+        # Only deliver to members of the room, when one is given
+        if room is not None and client_info.room != room:
+            continue
+
+        if client_info.transport == WEBSOCKET:
+            if websocket_frame is None:
+                websocket_frame = encode_chat_frame(user_data, msg_data)
+            client_info.send(websocket_frame)
+        else:
+            client_info.send(full_message)
+
+
+def broadcast_notice(client_dict, room: str, username: str, message: str):
+    # Server-generated message to every member of a room, encoded once
+    # per wire format.
+
+    user_header, user_data = encode_message(username)
+    msg_header, msg_data = encode_message(message)
+    priority = classify(username)
+    full_message = user_header + user_data + msg_header + msg_data
+    websocket_frame = None
+
+    for client_info in client_dict.values():
+        if client_info.room != room:
+            continue
+
+        if client_info.transport == WEBSOCKET:
+            if websocket_frame is None:
+                websocket_frame = encode_chat_frame(user_data, msg_data)
+            client_info.send(websocket_frame, priority)
+        else:
+            client_info.send(full_message, priority)
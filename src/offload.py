@@ -0,0 +1,124 @@
+"""
+Offload Stage
+Runs a per-message handler in a bounded thread pool and hands results back
+to the server loop through a wakeup pipe, in per-sender order.
+"""
+
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+OFFLOAD_WORKERS = int(os.getenv('CHAT_OFFLOAD_WORKERS', '4'))
+# Handler calls queued or running before submit() makes the loop wait for one
+MAX_PENDING = int(os.getenv('CHAT_OFFLOAD_QUEUE', '1024'))
+# Recent task latencies kept for percentiles
+LATENCY_SAMPLES = 1000
+
+
+class OffloadTask:
+
+    __slots__ = ('key', 'args', 'context', 'submitted', 'finished', 'result', 'error')
+
+    def __init__(self, key, args: tuple, context):
+        self.key = key
+        self.args = args
+        self.context = context
+        self.submitted = time.monotonic()
+        self.finished = None
+        self.result = None
+        self.error = None
+
+
+class OffloadStage:
+    # handler must be a pure function of its arguments: it runs on a
+    # worker thread and must not touch server state. Tasks with the same
+    # key are handed back in submission order, even when a later one
+    # finishes first.
+
+    def __init__(self, handler, workers: int = OFFLOAD_WORKERS, max_pending: int = MAX_PENDING):
+        self.handler = handler
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='offload')
+        self.wakeup_fd, self._wakeup_write = os.pipe()
+        os.set_blocking(self.wakeup_fd, False)
+        os.set_blocking(self._wakeup_write, False)
+        self.pending = 0
+        self.in_flight = set()
+        self.by_key = {}
+        self.ready_keys = deque()
+        self.completed_count = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.max_latency = 0.0
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        os.close(self.wakeup_fd)
+        os.close(self._wakeup_write)
+
+    def submit(self, key, args: tuple, context=None):
+        # Called from the loop. When the pool is full the loop waits for a
+        # handler to finish; its result stays queued for completed(), so
+        # pool work stays bounded and no message is dropped.
+        if len(self.in_flight) >= self.max_pending:
+            self.in_flight = {future for future in self.in_flight if not future.done()}
+            if len(self.in_flight) >= self.max_pending:
+                _, self.in_flight = wait(self.in_flight, return_when=FIRST_COMPLETED)
+
+        task = OffloadTask(key, args, context)
+        queue = self.by_key.get(key)
+        if queue is None:
+            queue = self.by_key[key] = deque()
+        queue.append(task)
+        self.pending += 1
+        self.in_flight.add(self.executor.submit(self._run, task))
+
+    def _run(self, task: OffloadTask):
+        # Worker thread
+        try:
+            task.result = self.handler(*task.args)
+        except Exception as e:
+            task.error = e
+        task.finished = time.monotonic()
+        self.ready_keys.append(task.key)
+        try:
+            os.write(self._wakeup_write, b'\0')
+        except BlockingIOError:
+            # The pipe already holds unread wakeups
+            pass
+
+    def _drain_wakeups(self):
+        try:
+            while os.read(self.wakeup_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def completed(self):
+        # Called from the loop once wakeup_fd is readable. Yields finished
+        # tasks as (key, context, result, error), oldest first per key.
+        self._drain_wakeups()
+        while self.ready_keys:
+            key = self.ready_keys.popleft()
+            queue = self.by_key.get(key)
+            while queue and queue[0].finished is not None:
+                task = queue.popleft()
+                self.pending -= 1
+                self.completed_count += 1
+                latency = task.finished - task.submitted
+                self.latencies.append(latency)
+                self.max_latency = max(self.max_latency, latency)
+                yield task.key, task.context, task.result, task.error
+            if queue is not None and not queue:
+                del self.by_key[key]
+
+    def stats(self) -> dict:
+
+        latencies = sorted(self.latencies)
+        return {
+            'depth': self.pending,
+            'completed': self.completed_count,
+            'p50_ms': latencies[len(latencies) // 2] * 1e3 if latencies else 0.0,
+            'p99_ms': latencies[int(len(latencies) * 0.99)] * 1e3 if latencies else 0.0,
+            'max_ms': self.max_latency * 1e3
+        }
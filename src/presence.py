@@ -0,0 +1,154 @@
+"""
+Chat Presence
+Versioned per-room rosters with typing indicators. Changes are collected
+and sent as one diff per room after a short debounce interval.
+"""
+
+import json
+import os
+import time
+
+PRESENCE_USER = '@presence'
+TYPING_COMMAND = '/typing'
+DEBOUNCE_INTERVAL = float(os.getenv('CHAT_PRESENCE_DEBOUNCE', '0.25'))
+# A typing indicator lapses unless /typing is sent again
+TYPING_TTL = 5.0
+
+
+class Roster:
+    # Current state of a room next to the state last sent to its members.
+    # The diff between the two is what the next broadcast carries.
+
+    __slots__ = ('members', 'typing', 'published', 'published_typing', 'version')
+
+    def __init__(self):
+        self.members = {}
+        self.typing = {}
+        self.published = set()
+        self.published_typing = set()
+        self.version = 0
+
+    def snapshot(self, room: str) -> str:
+        # The state as of the last published version, so every later diff
+        # applies to it exactly. Changes not yet published, the new
+        # member's own join included, arrive with the next diff.
+        return json.dumps({
+            'room': room,
+            'version': self.version,
+            'members': sorted(self.published),
+            'typing': sorted(self.published_typing)
+        })
+
+    def diff(self, room: str):
+        # Returns the diff frame, or None when nothing visible changed.
+        members = set(self.members)
+        typing = set(self.typing)
+        changes = {
+            'joined': sorted(members - self.published),
+            'left': sorted(self.published - members),
+            'typing': sorted(typing - self.published_typing),
+            'idle': sorted(self.published_typing - typing)
+        }
+        if not any(changes.values()):
+            return None
+
+        self.version += 1
+        self.published = members
+        self.published_typing = typing
+        return json.dumps({'room': room, 'version': self.version, **changes})
+
+
+class PresenceTracker:
+
+    def __init__(self, interval: float = DEBOUNCE_INTERVAL, clock=time.monotonic):
+        self.interval = interval
+        self.clock = clock
+        self.rooms = {}
+        self.dirty = set()
+        self.deadline = None
+        # Only rooms with someone typing need checking for expiry
+        self.typing_rooms = set()
+
+    def _touch(self, room: str):
+        self.dirty.add(room)
+        if self.deadline is None:
+            self.deadline = self.clock() + self.interval
+
+    def joined(self, room: str, username: str) -> str:
+        # Returns the snapshot to send to the new member.
+
+        roster = self.rooms.get(room)
+        if roster is None:
+            roster = self.rooms[room] = Roster()
+        roster.members[username] = roster.members.get(username, 0) + 1
+        self._touch(room)
+        return roster.snapshot(room)
+
+    def left(self, room: str, username: str):
+
+        roster = self.rooms.get(room)
+        if roster is None or username not in roster.members:
+            return
+
+        # The same name may be connected more than once
+        roster.members[username] -= 1
+        if roster.members[username] == 0:
+            del roster.members[username]
+            roster.typing.pop(username, None)
+        self._touch(room)
+
+    def typing(self, room: str, username: str):
+
+        roster = self.rooms.get(room)
+        if roster is None or username not in roster.members:
+            return
+        roster.typing[username] = self.clock() + TYPING_TTL
+        self.typing_rooms.add(room)
+        self._touch(room)
+
+    def idle(self, room: str, username: str):
+
+        roster = self.rooms.get(room)
+        if roster is not None and roster.typing.pop(username, None) is not None:
+            self._touch(room)
+
+    def timeout(self):
+        # Seconds until the next diff or typing expiry is due, or None.
+
+        due = [self.deadline] if self.deadline is not None else []
+        for room in self.typing_rooms:
+            due.extend(self.rooms[room].typing.values())
+        if not due:
+            return None
+        return max(0.0, min(due) - self.clock())
+
+    def flush(self) -> list:
+        # Returns [(room, diff)] once the debounce interval has passed.
+
+        now = self.clock()
+        for room in list(self.typing_rooms):
+            roster = self.rooms[room]
+            expired = [username for username, expires in roster.typing.items() if expires <= now]
+            for username in expired:
+                del roster.typing[username]
+            if expired:
+                self._touch(room)
+            if not roster.typing:
+                self.typing_rooms.discard(room)
+
+        if self.deadline is None or now < self.deadline:
+            return []
+
+        diffs = []
+        for room in self.dirty:
+            roster = self.rooms[room]
+            frame = roster.diff(room)
+            if frame is not None:
+                diffs.append((room, frame))
+            # Forget rooms once everyone has gone and that was announced
+            if not roster.members and not roster.published:
+                del self.rooms[room]
+
+        self.dirty = set()
+        self.deadline = None
+        return diffs
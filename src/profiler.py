@@ -0,0 +1,139 @@
+"""
+Sampling Profiler
+Low-overhead stack sampler that writes collapsed stacks for flamegraph
+tools. Nothing runs until it is switched on.
+"""
+
+import os
+import signal
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+PROFILE_DIR = os.getenv('CHAT_PROFILE_DIR', tempfile.gettempdir())
+SAMPLE_INTERVAL = 0.005
+MAX_DEPTH = 64
+# Distinct stacks kept per session; anything beyond lands in one bucket
+MAX_STACKS = 10000
+OVERFLOW_STACK = '[other stacks]'
+
+
+def frame_label(frame) -> str:
+
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def collapse_stack(frame, max_depth: int = MAX_DEPTH) -> str:
+    # Root first, separated by ';' as flamegraph.pl expects.
+
+    labels = []
+    while frame is not None and len(labels) < max_depth:
+        labels.append(frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return ';'.join(labels)
+
+
+def write_collapsed(path: str, counts: Counter):
+
+    with open(path, 'w', encoding='utf-8') as output:
+        for stack, count in counts.most_common():
+            output.write(f'{stack} {count}\n')
+
+
+class SamplingProfiler:
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL, output_dir: str = PROFILE_DIR, max_stacks: int = MAX_STACKS):
+        self.interval = interval
+        self.output_dir = output_dir
+        self.max_stacks = max_stacks
+        self.target_thread_id = None
+        self.counts = Counter()
+        self.samples = 0
+        self.sample_seconds = 0.0
+        self.started_at = None
+        self.last_path = None
+        self._stop = None
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, thread_id: int = None):
+        if self.running:
+            return
+        self.target_thread_id = thread_id or threading.main_thread().ident
+        self.counts = Counter()
+        self.samples = 0
+        self.sample_seconds = 0.0
+        self.started_at = time.monotonic()
+        self.last_path = os.path.join(self.output_dir, f'chat-profile-{os.getpid()}-{int(time.time() * 1000)}.folded')
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(self._stop, self.counts, self.last_path), daemon=True)
+        self._thread.start()
+
+    def stop(self, wait: bool = False) -> str:
+        # Returns the path the collapsed stacks are written to. The file is
+        # written by the sampler thread, so callers on the server loop
+        # need not wait for it.
+        if not self.running:
+            return None
+        self._stop.set()
+        thread = self._thread
+        self._thread = None
+        if wait:
+            thread.join()
+        return self.last_path
+
+    def toggle(self) -> str:
+        if self.running:
+            return self.stop()
+        self.start()
+        return None
+
+    def overhead(self) -> float:
+        # Fraction of wall time spent taking samples.
+        if self.started_at is None:
+            return 0.0
+        elapsed = time.monotonic() - self.started_at
+        return self.sample_seconds / elapsed if elapsed else 0.0
+
+    def _sample(self, counts: Counter):
+        frame = sys._current_frames().get(self.target_thread_id)
+        if frame is None:
+            return
+        stack = collapse_stack(frame)
+        del frame
+        if stack not in counts and len(counts) >= self.max_stacks:
+            stack = OVERFLOW_STACK
+        counts[stack] += 1
+        self.samples += 1
+
+    def _run(self, stop_event, counts, path):
+        while not stop_event.wait(self.interval):
+            started = time.perf_counter()
+            self._sample(counts)
+            self.sample_seconds += time.perf_counter() - started
+
+        try:
+            write_collapsed(path, counts)
+            print(f'Profile written to {path} '
+                  f'({self.samples} samples, {self.overhead():.2%} overhead)')
+        except OSError as e:
+            print(f'Profile write error: {e}')
+
+
+def install_signal_handler(profiler: SamplingProfiler, signum=None) -> bool:
+    # Toggle the profiler with `kill -USR1 <pid>`.
+
+    if signum is None:
+        signum = getattr(signal, 'SIGUSR1', None)
+    if signum is None:
+        return False
+
+    signal.signal(signum, lambda received, frame: profiler.toggle())
+    return True
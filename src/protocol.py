@@ -1,9 +1,15 @@
 HEADER_LENGTH = 10
+DEFAULT_ROOM = 'lobby'
+
+def encode_header(length: int) -> bytes:
+
+    return f'{length:<{HEADER_LENGTH}}'.encode('utf-8')
+
 
 def encode_message(message: str) -> tuple:
 
     encoded_msg = message.encode('utf-8')
-    header = f'{len(encoded_msg):<{HEADER_LENGTH}}'.encode('utf-8')
+    header = encode_header(len(encoded_msg))
     return header, encoded_msg
 
 
@@ -22,3 +28,21 @@ def create_full_message(username: str, message: str) -> bytes:
     user_header, user_encoded = encode_message(username)
     msg_header, msg_encoded = encode_message(message)
     return user_header + user_encoded + msg_header + msg_encoded
+
+
+def split_frames(buffer) -> tuple:
+    # Returns ([(header, data), ...], consumed) for every complete
+    # length-prefixed frame at the start of buffer.
+
+    frames = []
+    offset = 0
+    end = len(buffer)
+    while end - offset >= HEADER_LENGTH:
+        header = bytes(buffer[offset:offset + HEADER_LENGTH])
+        length = decode_header(header)
+        if end - offset - HEADER_LENGTH < length:
+            break
+        start = offset + HEADER_LENGTH
+        frames.append((header, bytes(buffer[start:start + length])))
+        offset = start + length
+    return frames, offset
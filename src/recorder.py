@@ -0,0 +1,106 @@
+"""
+Traffic Recorder
+Captures inbound connections and frames to a compact binary file. The
+server loop only queues records; a background thread does the writing.
+"""
+
+import os
+import queue
+import struct
+import threading
+import time
+
+CAPTURE_FILE = os.getenv('CHAT_CAPTURE_FILE')
+CAPTURE_MAGIC = b'CHATCAP1'
+
+CONNECT = 1
+MESSAGE = 2
+DISCONNECT = 3
+
+# Microseconds since capture start, connection id, kind, data length
+RECORD_HEADER = struct.Struct('<QIBI')
+WRITE_BUFFER_SIZE = 1 << 20
+
+
+def encode_record(offset_us: int, connection_id: int, kind: int, data: bytes = b'') -> bytes:
+
+    return RECORD_HEADER.pack(offset_us, connection_id, kind, len(data)) + data
+
+
+def read_capture(path: str):
+    # Yields (seconds since capture start, connection id, kind, data).
+
+    with open(path, 'rb') as capture:
+        if capture.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f'{path} is not a chat capture file')
+
+        while True:
+            header = capture.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            offset_us, connection_id, kind, length = RECORD_HEADER.unpack(header)
+            data = capture.read(length)
+            if len(data) < length:
+                # Truncated by a crash mid-write
+                return
+            yield offset_us / 1e6, connection_id, kind, data
+
+
+class TrafficRecorder:
+
+    def __init__(self, path: str, clock=time.monotonic):
+        self.path = path
+        self.clock = clock
+        self.started = clock()
+        self.records = queue.SimpleQueue()
+        self.ids = {}
+        self._next_id = 1
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._write_loop, name='traffic-recorder', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self.records.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def _put(self, client_socket, kind: int, data: bytes = b''):
+        offset_us = int((self.clock() - self.started) * 1e6)
+        self.records.put(encode_record(offset_us, self.ids[client_socket], kind, data))
+
+    def record_connect(self, client_socket, username: bytes):
+        self.ids[client_socket] = self._next_id
+        self._next_id += 1
+        self._put(client_socket, CONNECT, username)
+
+    def record_message(self, client_socket, data: bytes):
+        if client_socket in self.ids:
+            self._put(client_socket, MESSAGE, data)
+
+    def record_disconnect(self, client_socket):
+        if client_socket in self.ids:
+            self._put(client_socket, DISCONNECT)
+            del self.ids[client_socket]
+
+    def _write_loop(self):
+        # Blocks for one record, then takes whatever else is already queued
+        # so each write covers a whole burst.
+        with open(self.path, 'wb', buffering=WRITE_BUFFER_SIZE) as capture:
+            capture.write(CAPTURE_MAGIC)
+            while True:
+                batch = [self.records.get()]
+                while True:
+                    try:
+                        batch.append(self.records.get_nowait())
+                    except queue.Empty:
+                        break
+
+                done = batch[-1] is None
+                capture.write(b''.join(record for record in batch if record is not None))
+                capture.flush()
+                if done:
+                    return
@@ -0,0 +1,180 @@
+"""
+Traffic Replay
+Re-drives a capture from src.recorder against a running server, and
+reports throughput and the delivery latency seen by an observer client.
+
+Usage: python -m src.replay capture.bin [--speed 1x|10x|max] [--host H] [--port P] [--socket PATH]
+"""
+
+import argparse
+import select
+import socket
+import time
+from collections import defaultdict, deque
+from src.protocol import HEADER_LENGTH, encode_header, split_frames
+from src.recorder import CONNECT, MESSAGE, DISCONNECT, read_capture
+
+OBSERVER_NAME = 'replay-observer'
+# Time allowed for the last deliveries to reach the observer
+DRAIN_TIME = 1.0
+
+
+def parse_speed(value: str) -> float:
+    # '1x', '10x' or '2.5' -> multiplier; 'max' -> 0, meaning no delays
+
+    if value == 'max':
+        return 0.0
+    speed = float(value.rstrip('x'))
+    if speed <= 0:
+        raise ValueError('speed must be positive')
+    return speed
+
+
+def open_client(address, username: bytes):
+
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    client = socket.socket(family, socket.SOCK_STREAM)
+    client.connect(address)
+    if family == socket.AF_INET:
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    client.sendall(encode_header(len(username)) + username)
+    client.setblocking(False)
+    return client
+
+
+class Observer:
+    # Matches frames it receives to the times they were sent.
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = b''
+        self.pending = defaultdict(deque)
+        self.latencies = []
+
+    def sent(self, username: bytes, data: bytes, when: float):
+        self.pending[(username, data)].append(when)
+
+    def receive(self, now: float):
+        try:
+            chunk = self.sock.recv(65536)
+        except BlockingIOError:
+            return
+        self.buffer += chunk
+        frames, consumed = split_frames(self.buffer)
+
+        # Frames come in username/message pairs; a lone username waits
+        if len(frames) % 2:
+            consumed -= HEADER_LENGTH + len(frames.pop()[1])
+        self.buffer = self.buffer[consumed:]
+
+        for i in range(0, len(frames), 2):
+            sent_at = self.pending.get((frames[i][1], frames[i + 1][1]))
+            if sent_at:
+                self.latencies.append(now - sent_at.popleft())
+
+
+def drain(sockets):
+    # Replayed clients also receive broadcasts; discard them so the
+    # server never backs up on us.
+
+    for sock in sockets:
+        try:
+            while sock.recv(65536):
+                pass
+        except (BlockingIOError, ConnectionError):
+            pass
+
+
+def replay(path: str, address, speed: float = 1.0) -> dict:
+
+    records = list(read_capture(path))
+    observer = Observer(open_client(address, OBSERVER_NAME.encode('utf-8')))
+    clients = {}
+    usernames = {}
+    sent = 0
+    sent_bytes = 0
+
+    start = time.perf_counter()
+    for offset, connection_id, kind, data in records:
+        due = start + offset / speed if speed else start
+        while True:
+            now = time.perf_counter()
+            wait = due - now
+            readable, _, _ = select.select(
+                [observer.sock] + list(clients.values()), [], [], max(0.0, wait)
+            )
+            drain(sock for sock in readable if sock is not observer.sock)
+            if observer.sock in readable:
+                observer.receive(time.perf_counter())
+            if wait <= 0:
+                break
+
+        if kind == CONNECT:
+            clients[connection_id] = open_client(address, data)
+            usernames[connection_id] = data
+        elif kind == MESSAGE and connection_id in clients:
+            frame = encode_header(len(data)) + data
+            clients[connection_id].setblocking(True)
+            clients[connection_id].sendall(frame)
+            clients[connection_id].setblocking(False)
+            observer.sent(usernames[connection_id], data, time.perf_counter())
+            sent += 1
+            sent_bytes += len(frame)
+        elif kind == DISCONNECT and connection_id in clients:
+            clients.pop(connection_id).close()
+    elapsed = time.perf_counter() - start
+
+    deadline = time.perf_counter() + DRAIN_TIME
+    while time.perf_counter() < deadline:
+        readable, _, _ = select.select([observer.sock] + list(clients.values()), [], [], 0.05)
+        drain(sock for sock in readable if sock is not observer.sock)
+        if observer.sock in readable:
+            observer.receive(time.perf_counter())
+
+    for sock in [observer.sock] + list(clients.values()):
+        sock.close()
+
+    latencies = sorted(observer.latencies)
+    return {
+        'messages': sent,
+        'bytes': sent_bytes,
+        'elapsed': elapsed,
+        'throughput': sent / elapsed if elapsed else 0.0,
+        'observed': len(latencies),
+        'p50': latencies[len(latencies) // 2] if latencies else None,
+        'p99': latencies[int(len(latencies) * 0.99)] if latencies else None,
+        'max': latencies[-1] if latencies else None
+    }
+
+
+def format_report(stats: dict) -> str:
+
+    lines = [
+        f"messages   {stats['messages']} ({stats['bytes'] / 1e6:.1f} MB) in {stats['elapsed']:.2f}s",
+        f"throughput {stats['throughput']:.0f} msg/s",
+        f"observed   {stats['observed']} deliveries"
+    ]
+    if stats['observed']:
+        lines.append(
+            f"latency    p50 {stats['p50'] * 1e3:.2f} ms, p99 {stats['p99'] * 1e3:.2f} ms, "
+            f"max {stats['max'] * 1e3:.2f} ms"
+        )
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description='Replay a chat traffic capture against a server')
+    parser.add_argument('capture')
+    parser.add_argument('--speed', default='1x', help="1x, Nx or max")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1234)
+    parser.add_argument('--socket', help='connect over this Unix socket instead of TCP')
+    args = parser.parse_args(argv)
+
+    address = args.socket or (args.host, args.port)
+    print(format_report(replay(args.capture, address, parse_speed(args.speed))))
+
+
+if __name__ == '__main__':
+    main()
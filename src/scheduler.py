@@ -0,0 +1,86 @@
+"""
+Outbound Scheduler
+Strict-priority frame queues for one client, with a starvation guard.
+"""
+
+from collections import deque
+
+CONTROL = 0
+CHAT = 1
+BULK = 2
+LEVELS = 3
+
+# A waiting level is served after being passed over this many times
+STARVATION_LIMIT = 16
+
+CONTROL_USERS = ('@presence', '@ack', '@admin')
+# '@file' notices acknowledge uploads and announce downloads; only the
+# '@file:<id>' chunks that follow are bulk
+CONTROL_NAMES = frozenset(['@file'])
+BULK_USERS = ('@file:', '@search', '@history')
+
+
+def classify(username: str) -> int:
+    # Server-generated traffic is tagged by its '@...' sender.
+
+    if not username.startswith('@'):
+        return CHAT
+    if username in CONTROL_NAMES or username.startswith(CONTROL_USERS):
+        return CONTROL
+    if username.startswith(BULK_USERS):
+        return BULK
+    return CHAT
+
+
+class OutboundQueue:
+    # Only allocated while a connection has output waiting.
+
+    __slots__ = ('levels', 'skips', 'queued_bytes')
+
+    def __init__(self):
+        self.levels = [deque() for _ in range(LEVELS)]
+        self.skips = [0] * LEVELS
+        self.queued_bytes = 0
+
+    def __len__(self) -> int:
+        return sum(len(level) for level in self.levels)
+
+    def push(self, data: bytes, priority: int = CHAT):
+        self.levels[priority].append(data)
+        self.queued_bytes += len(data)
+
+    def next_level(self, bulk_waiting: bool = False):
+        # Returns the level to serve next, or None when nothing waits.
+        # bulk_waiting counts attachment streams as queued bulk output.
+        waiting = [bool(level) for level in self.levels]
+        waiting[BULK] = waiting[BULK] or bulk_waiting
+
+        # A starved level goes first, otherwise strict priority
+        chosen = None
+        for priority in range(LEVELS - 1, -1, -1):
+            if waiting[priority] and self.skips[priority] >= STARVATION_LIMIT:
+                chosen = priority
+                break
+        if chosen is None:
+            for priority in range(LEVELS):
+                if waiting[priority]:
+                    chosen = priority
+                    break
+        if chosen is None:
+            return None
+
+        for priority in range(LEVELS):
+            if priority == chosen or not waiting[priority]:
+                self.skips[priority] = 0
+            else:
+                self.skips[priority] += 1
+        return chosen
+
+    def pop(self, priority: int):
+        # Next frame at the given level, or None if only a stream waits.
+        level = self.levels[priority]
+        if not level:
+            return None
+        data = level.popleft()
+        self.queued_bytes -= len(data)
+        return data
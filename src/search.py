@@ -0,0 +1,373 @@
+"""
+Chat Search
+Incrementally maintained inverted index over chat history.
+"""
+
+import array
+import bisect
+import heapq
+import os
+import queue
+import re
+import threading
+import time
+from collections import deque
+from src.protocol import DEFAULT_ROOM
+
+TOKEN_PATTERN = re.compile(r'\w+')
+# Postings per skip entry; a lookup decodes at most one block
+BLOCK_SIZE = 128
+
+
+def tokenize(text: str) -> list:
+
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+def encode_varint(value: int, out: array.array):
+
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_postings(data: array.array, last: int = 0, start: int = 0, end: int = None) -> array.array:
+    # Decodes data[start:end], whose first delta is relative to last.
+
+    seqs = array.array('I')
+    value = 0
+    shift = 0
+    for index in range(start, len(data) if end is None else end):
+        byte = data[index]
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        last += value
+        seqs.append(last)
+        value = 0
+        shift = 0
+    return seqs
+
+
+class PostingList:
+    # Message sequence numbers stored as varint-encoded deltas. Every
+    # BLOCK_SIZE postings a skip entry records the byte offset and the
+    # preceding sequence number, so a block decodes on its own: queries
+    # walk the list newest block first and stop once they have a page.
+
+    __slots__ = ('data', 'last', 'count', 'block_offsets', 'block_bases')
+
+    def __init__(self):
+        self.data = array.array('B')
+        self.last = 0
+        self.count = 0
+        self.block_offsets = array.array('I')
+        self.block_bases = array.array('I')
+
+    def add(self, seq: int):
+        # Sequence numbers only ever grow, so deltas stay small.
+        if self.count and seq <= self.last:
+            return
+        if self.count % BLOCK_SIZE == 0:
+            self.block_offsets.append(len(self.data))
+            self.block_bases.append(self.last)
+        encode_varint(seq - self.last, self.data)
+        self.last = seq
+        self.count += 1
+
+    def seqs(self) -> array.array:
+        return decode_postings(self.data)
+
+    def block(self, index: int) -> array.array:
+        end = self.block_offsets[index + 1] if index + 1 < len(self.block_offsets) else len(self.data)
+        return decode_postings(self.data, self.block_bases[index], self.block_offsets[index], end)
+
+    def blocks_desc(self, below: int = None):
+        # Yields decoded blocks newest first, skipping blocks that hold
+        # only sequence numbers at or over `below`.
+        for index in range(len(self.block_offsets) - 1, -1, -1):
+            if below is not None and index and self.block_bases[index] >= below - 1:
+                continue
+            yield self.block(index)
+
+    def matching(self, seqs, cache: dict) -> set:
+        # Returns the given sequence numbers that are in this list. Only
+        # the blocks they fall in are decoded; cache keeps those blocks, as
+        # sets, for the rest of the query.
+        found = set()
+        for seq in seqs:
+            if not self.count or seq > self.last:
+                continue
+            index = max(0, bisect.bisect_left(self.block_bases, seq) - 1)
+            block = cache.get(index)
+            if block is None:
+                block = cache[index] = set(self.block(index))
+            if seq in block:
+                found.add(seq)
+        return found
+
+
+class TermPostings:
+    # One query term: a single posting list, or the union of every list a
+    # prefix term expands to.
+
+    __slots__ = ('lists', 'count', 'caches')
+
+    def __init__(self, lists: list):
+        self.lists = lists
+        self.count = sum(postings.count for postings in lists)
+        self.caches = [{} for _ in lists]
+
+    def chunks_desc(self, below: int = None):
+        # Yields runs of sequence numbers under `below`, newest run first.
+        if len(self.lists) == 1:
+            for block in self.lists[0].blocks_desc(below):
+                yield [seq for seq in block if seq < below] if below is not None and block[-1] >= below else block
+            return
+
+        runs = [(seq for block in postings.blocks_desc(below) for seq in reversed(block)) for postings in self.lists]
+        chunk = []
+        for seq in heapq.merge(*runs, reverse=True):
+            if below is not None and seq >= below:
+                continue
+            chunk.append(seq)
+            if len(chunk) == BLOCK_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def matching(self, seqs) -> set:
+        found = set()
+        for postings, cache in zip(self.lists, self.caches):
+            found |= postings.matching(seqs, cache)
+        return found
+
+
+class SearchIndex:
+    # Message bodies are kept in one bytearray, indexed by offset, with
+    # usernames interned, so a stored message costs its own bytes plus
+    # about 24 bytes of arrays.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = {}
+        self._sorted_terms = []
+        self._terms_dirty = False
+        self._rooms = {}
+        self._room_names = []
+        self._users = {}
+        self._user_names = []
+        self._doc_rooms = array.array('I')
+        self._doc_users = array.array('I')
+        self._doc_times = array.array('d')
+        self._doc_offsets = array.array('Q', [0])
+        self._text = bytearray()
+
+    def __len__(self):
+        return len(self._doc_times)
+
+    def add(self, username: bytes, message: bytes, room: str = DEFAULT_ROOM, timestamp: float = None) -> int:
+
+        if timestamp is None:
+            timestamp = time.time()
+        terms = set(tokenize(message.decode('utf-8', 'replace')))
+
+        with self._lock:
+            seq = len(self._doc_times)
+            room_id = self._rooms.get(room)
+            if room_id is None:
+                room_id = self._rooms[room] = len(self._room_names)
+                self._room_names.append(room)
+            user_id = self._users.get(username)
+            if user_id is None:
+                user_id = self._users[username] = len(self._user_names)
+                self._user_names.append(username)
+
+            self._text += message
+            self._doc_offsets.append(len(self._text))
+            self._doc_rooms.append(room_id)
+            self._doc_users.append(user_id)
+            self._doc_times.append(timestamp)
+
+            for term in terms:
+                postings = self._postings.get(term)
+                if postings is None:
+                    postings = self._postings[term] = PostingList()
+                    self._terms_dirty = True
+                postings.add(seq)
+
+        return seq
+
+    def _message(self, seq: int) -> bytes:
+        return bytes(self._text[self._doc_offsets[seq]:self._doc_offsets[seq + 1]])
+
+    def _expand(self, term: str) -> list:
+        # Returns the posting lists a single query term refers to.
+        if not term.endswith('*'):
+            postings = self._postings.get(term)
+            return [postings] if postings is not None else []
+
+        prefix = term[:-1]
+        if self._terms_dirty:
+            self._sorted_terms = sorted(self._postings)
+            self._terms_dirty = False
+        start = bisect.bisect_left(self._sorted_terms, prefix)
+        matches = []
+        for candidate in self._sorted_terms[start:]:
+            if not candidate.startswith(prefix):
+                break
+            matches.append(self._postings[candidate])
+        return matches
+
+    def _candidates(self, query: str, below: int = None):
+        # Yields the sequence numbers matching every term, newest first,
+        # or returns None for an empty query.
+        terms = []
+        for word in query.lower().split():
+            prefix = word.endswith('*')
+            for token in tokenize(word):
+                terms.append(token + '*' if prefix else token)
+        if not terms:
+            return None
+
+        lists = []
+        for term in terms:
+            postings = self._expand(term)
+            if not postings:
+                return iter(())
+            lists.append(TermPostings(postings))
+
+        lists.sort(key=lambda term_postings: term_postings.count)
+        return self._intersect(lists[0], lists[1:], below)
+
+    def _intersect(self, driver, others: list, below: int = None):
+        # Runs of the rarest term are checked against the other terms a
+        # block at a time, newest first, so a page of results decodes only
+        # the blocks it touches rather than whole posting lists.
+        for chunk in driver.chunks_desc(below):
+            matches = chunk
+            for other in others:
+                matches = other.matching(matches)
+                if not matches:
+                    break
+            yield from sorted(matches, reverse=True)
+
+    def search(self, query: str, room: str = None, since: float = None,
+               until: float = None, limit: int = 20, before: int = None) -> tuple:
+        # Returns (hits, next_cursor), newest first. Pass next_cursor back
+        # as `before` to fetch the following page.
+
+        with self._lock:
+            candidates = self._candidates(query, before)
+            if candidates is None:
+                return [], None
+
+            room_id = None
+            if room is not None:
+                room_id = self._rooms.get(room)
+                if room_id is None:
+                    return [], None
+
+            hits = []
+            next_cursor = None
+            for seq in candidates:
+                if room_id is not None and self._doc_rooms[seq] != room_id:
+                    continue
+                timestamp = self._doc_times[seq]
+                if since is not None and timestamp < since:
+                    continue
+                if until is not None and timestamp > until:
+                    continue
+                if len(hits) == limit:
+                    next_cursor = hits[-1]['seq']
+                    break
+
+                hits.append({
+                    'seq': seq,
+                    'room': self._room_names[self._doc_rooms[seq]],
+                    'timestamp': timestamp,
+                    'username': self._user_names[self._doc_users[seq]],
+                    'message': self._message(seq)
+                })
+
+        return hits, next_cursor
+
+
+class IndexWorker:
+    # Feeds accepted messages into a SearchIndex from a background thread
+    # so tokenizing never runs on the server loop. Queries run on the same
+    # thread, after everything submitted before them; their results come
+    # back through wakeup_fd and completed(), like the offload stage.
+
+    def __init__(self, index: SearchIndex):
+        self.index = index
+        self._queue = queue.Queue()
+        self._thread = None
+        self._results = deque()
+        self.wakeup_fd, self._wakeup_write = os.pipe()
+        os.set_blocking(self.wakeup_fd, False)
+        os.set_blocking(self._wakeup_write, False)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        os.close(self.wakeup_fd)
+        os.close(self._wakeup_write)
+
+    def submit(self, username: bytes, message: bytes, room: str = DEFAULT_ROOM, timestamp: float = None):
+        if timestamp is None:
+            timestamp = time.time()
+        self._queue.put((self.index.add, (username, message, room, timestamp)))
+
+    def search(self, query: str, context=None, **scope):
+        # scope takes SearchIndex.search's keyword arguments.
+        self._queue.put((self._search, (query, context, scope)))
+
+    def completed(self):
+        # Yields (context, query, hits, next_cursor) for finished queries.
+        try:
+            while os.read(self.wakeup_fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self._results:
+            yield self._results.popleft()
+
+    def wait(self):
+        # Block until everything submitted so far is searchable.
+        self._queue.join()
+
+    def _search(self, query: str, context, scope: dict):
+        try:
+            hits, next_cursor = self.index.search(query, **scope)
+        except Exception as e:
+            print(f'Search error: {e}')
+            hits, next_cursor = [], None
+        self._results.append((context, query, hits, next_cursor))
+        try:
+            os.write(self._wakeup_write, b'\0')
+        except BlockingIOError:
+            # The pipe already holds unread wakeups
+            pass
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                func, args = item
+                func(*args)
+            except Exception as e:
+                print(f'Indexing error: {e}')
+            finally:
+                self._queue.task_done()
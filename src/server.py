@@ -3,14 +3,49 @@ Chat Server
 Handles multiple client connections and message broadcasting.
 """
 
+import os
 import socket
 import select
-from src.message_handler import receive_message, broadcast_message
-from src.protocol import decode_message
+import stat
+import time
+from src.message_handler import receive_message, broadcast_message, broadcast_notice, send_notice
+from src.connection import Connection
+from src.protocol import DEFAULT_ROOM, decode_message, encode_message
+from src.websocket import WEBSOCKET, WebSocketHandshake
+from src.search import SearchIndex, IndexWorker
+from src.content_filter import FilterPipeline, PatternFilter, FilterReloader
+from src.cluster import ClusterNode, CLUSTER_PORT, CLUSTER_PEERS, CLUSTER_ADVERTISE, parse_peer_list
+from src.profiler import SamplingProfiler, install_signal_handler
+from src.attachments import AttachmentStore, ATTACH_COMMAND, FETCH_COMMAND, parse_attach_command, parse_upload_chunk
+from src.presence import PresenceTracker, PRESENCE_USER, TYPING_COMMAND
+from src.recorder import TrafficRecorder, CAPTURE_FILE
+from src.offload import OffloadStage
 
 # Server configuration
 HOST = '0.0.0.0'  # Listen on all interfaces 
-PORT = 1234
+PORT = int(os.getenv('CHAT_SERVER_PORT', '1234'))
+WS_PORT = int(os.getenv('CHAT_WS_PORT', '1235'))
+
+# Optional AF_UNIX listener for bots and sidecars on the same host
+UNIX_SOCKET = os.getenv('CHAT_SERVER_SOCKET')
+
+# Optional file of blocked terms, one per line
+FILTER_FILE = os.getenv('CHAT_FILTER_FILE')
+
+# Usernames allowed to send admin commands such as /profile. Names are
+# not authenticated, so these are only honoured on the Unix socket
+# listener, where the socket file's permissions decide who can connect.
+ADMIN_USERS = {name.strip() for name in os.getenv('CHAT_ADMIN_USERS', '').split(',') if name.strip()}
+
+# Usernames starting with this belong to server notices such as
+# @presence and @file:<id>, which clients act on
+RESERVED_PREFIX = b'@'
+
+SEARCH_COMMAND = '/search '
+JOIN_COMMAND = '/join '
+PROFILE_COMMAND = '/profile'
+STATS_COMMAND = '/stats'
+SEARCH_RESULT_LIMIT = 10
 
 
 def initialize_server():
@@ -23,7 +58,61 @@ def initialize_server():
     return server_socket
 
 
-def handle_new_connection(server_socket, socket_list, client_dict):
+def initialize_websocket_server():
+
+    ws_server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    ws_server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    ws_server_socket.bind((HOST, WS_PORT))
+    ws_server_socket.listen()
+    print(f'WebSocket gateway started on {HOST}:{WS_PORT}')
+    return ws_server_socket
+
+
+def initialize_unix_server(path: str):
+
+    # A socket file left behind by a previous run would make bind fail
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.unlink(path)
+
+    unix_server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    unix_server_socket.bind(path)
+    unix_server_socket.listen()
+    print(f'Unix socket listener started on {path}')
+    return unix_server_socket
+
+
+def format_address(client_address) -> str:
+    # Unix socket peers are usually unnamed, so accept() gives ''
+
+    if isinstance(client_address, tuple):
+        return f'{client_address[0]}:{client_address[1]}'
+    return client_address or 'unix socket'
+
+
+def check_username(data: bytes):
+    # Returns why a username is refused, or None when it is acceptable.
+
+    if data.startswith(RESERVED_PREFIX):
+        return 'names starting with @ are reserved'
+    try:
+        data.decode('utf-8')
+    except UnicodeDecodeError:
+        return 'not valid UTF-8'
+    return None
+
+
+def refuse_username(client_socket, user, reason: str, transport: str = None):
+    # Tells the client why before closing; it never joins client_dict.
+
+    print(f'Refused username: {reason}')
+    connection = Connection(client_socket, user['header'], user['data'], transport=transport)
+    send_notice(client_socket, connection, '@server', f'Username refused: {reason}')
+    connection.close()
+    client_socket.close()
+
+
+def handle_new_connection(server_socket, socket_list, client_dict, cluster=None, backlog=None, presence=None,
+                          recorder=None):
 
     client_socket, client_address = server_socket.accept()
     
@@ -32,73 +121,493 @@ def handle_new_connection(server_socket, socket_list, client_dict):
     
     if user is False:
         return
+
+    reason = check_username(user['data'])
+    if reason is not None:
+        refuse_username(client_socket, user, reason)
+        return
     
     # Add client to tracking structures
+    client_socket.setblocking(False)
     socket_list.append(client_socket)
-    client_dict[client_socket] = user
+    client_dict[client_socket] = Connection(client_socket, user['header'], user['data'], backlog=backlog)
+
+    if recorder is not None:
+        recorder.record_connect(client_socket, user['data'])
+
+    if cluster is not None:
+        cluster.member_joined(DEFAULT_ROOM)
     
     username = decode_message(user['data'])
-    print(f'New connection from {client_address[0]}:{client_address[1]}')
+    if presence is not None:
+        announce_presence(client_socket, client_dict[client_socket], presence, username)
+    print(f'New connection from {format_address(client_address)}')
     print(f'Username: {username}')
 
 
-def handle_client_message(client_socket, socket_list, client_dict):
+def handle_new_websocket_connection(ws_server_socket, handshakes):
+    # The upgrade and username are read as they arrive, by
+    # handle_websocket_handshake, so a silent client cannot stall the loop.
+
+    client_socket, client_address = ws_server_socket.accept()
+    client_socket.setblocking(False)
+    handshakes[client_socket] = WebSocketHandshake(client_socket, client_address)
+
+
+def handle_websocket_handshake(client_socket, handshakes, socket_list, client_dict, cluster=None, backlog=None,
+                               presence=None, recorder=None):
+
+    handshake = handshakes[client_socket]
+    user = handshake.read()
+    if user is None:
+        return
+
+    del handshakes[client_socket]
+    if user is False:
+        client_socket.close()
+        return
+
+    reason = check_username(user['data'])
+    if reason is not None:
+        refuse_username(client_socket, user, reason, WEBSOCKET)
+        return
+
+    socket_list.append(client_socket)
+    client_dict[client_socket] = Connection(
+        client_socket, user['header'], user['data'], transport=WEBSOCKET, backlog=backlog
+    )
+
+    if recorder is not None:
+        recorder.record_connect(client_socket, user['data'])
+
+    if cluster is not None:
+        cluster.member_joined(DEFAULT_ROOM)
+
+    username = decode_message(user['data'])
+    if presence is not None:
+        announce_presence(client_socket, client_dict[client_socket], presence, username)
+    print(f'New WebSocket connection from {format_address(handshake.address)}')
+    print(f'Username: {username}')
+
+
+def expire_handshakes(handshakes, now: float = None):
+    # Drops WebSocket clients that did not finish the handshake in time.
+
+    now = time.monotonic() if now is None else now
+    for client_socket, handshake in list(handshakes.items()):
+        if now >= handshake.deadline:
+            del handshakes[client_socket]
+            client_socket.close()
+
+
+def announce_presence(client_socket, client_info, presence, username: str):
+    # New room members get a roster snapshot; everyone else hears about
+    # them in the next diff.
+
+    snapshot = presence.joined(client_info.room, username)
+    send_notice(client_socket, client_info, PRESENCE_USER, snapshot)
+
+
+def handle_search(client_socket, client_info, indexer, query: str):
+    # The query runs on the index worker; send_search_results answers it.
+
+    indexer.search(query, client_socket, room=client_info.room, limit=SEARCH_RESULT_LIMIT)
+
+
+def send_search_results(client_dict, indexer):
+
+    for client_socket, query, hits, _ in indexer.completed():
+        # The client may have left while its query ran
+        client_info = client_dict.get(client_socket)
+        if client_info is None:
+            continue
+
+        if not hits:
+            send_notice(client_socket, client_info, '@search', f'No results for "{query}"')
+            continue
+
+        for hit in reversed(hits):
+            stamp = time.strftime('%H:%M', time.localtime(hit['timestamp']))
+            line = f"[{stamp}] {decode_message(hit['username'])} > {decode_message(hit['message'])}"
+            send_notice(client_socket, client_info, '@search', line)
+
+
+def handle_join(client_socket, client_info, cluster, room: str, presence=None):
+
+    previous = client_info.room
+    if not room or room == previous:
+        return
+
+    client_info.room = room
+    if cluster is not None:
+        cluster.member_joined(room)
+        cluster.member_left(previous)
+
+    send_notice(client_socket, client_info, '@room', f'Joined {room}')
+
+    if presence is not None:
+        username = decode_message(client_info.data)
+        presence.left(previous, username)
+        announce_presence(client_socket, client_info, presence, username)
+
+
+def is_admin(client_socket, username: str) -> bool:
+
+    return client_socket.family == socket.AF_UNIX and username in ADMIN_USERS
+
+
+def handle_profile(client_socket, client_info, profiler):
+
+    path = profiler.toggle()
+    if path is None:
+        send_notice(client_socket, client_info, '@admin', 'Profiler started')
+    else:
+        send_notice(client_socket, client_info, '@admin', f'Profiler stopped, writing {path}')
+
+
+def handle_stats(client_socket, client_info, offload):
+
+    stats = offload.stats()
+    send_notice(
+        client_socket, client_info, '@admin',
+        f"Offload depth {stats['depth']}, completed {stats['completed']}, "
+        f"latency p50 {stats['p50_ms']:.2f} ms p99 {stats['p99_ms']:.2f} ms max {stats['max_ms']:.2f} ms"
+    )
+
+
+def handle_attach(client_socket, client_info, attachments, content: str):
+
+    try:
+        size, name = parse_attach_command(content)
+        upload = attachments.begin_upload(client_socket, name, size, client_info.room)
+    except ValueError as e:
+        send_notice(client_socket, client_info, '@file', f'Upload refused: {e}')
+        return
+
+    send_notice(client_socket, client_info, '@file', f'Ready for {upload.name} as {upload.attachment_id}')
+
+
+def handle_upload_chunk(client_socket, client_dict, attachments, attachment_id: str, data: bytes):
+
+    upload = attachments.write_chunk(client_socket, attachment_id, data)
+    if upload is None:
+        return
+
+    # Announce the finished attachment like a chat message, in the room
+    # it was attached in
+    user = client_dict[client_socket]
+    msg_header, msg_data = encode_message(
+        f'shared {upload.name} ({upload.size} bytes), {FETCH_COMMAND}{upload.attachment_id}'
+    )
+    send_notice(client_socket, user, '@file', f'Uploaded {upload.name} as {upload.attachment_id}')
+    broadcast_message(client_socket, client_dict, user.header, user.data, msg_header, msg_data, upload.room)
+
+
+def handle_fetch(client_socket, client_info, attachments, attachment_id: str):
+
+    download = attachments.open_download(attachment_id, client_info.room, client_info.transport)
+    if download is None:
+        send_notice(client_socket, client_info, '@file', f'No attachment {attachment_id}')
+        return
+
+    upload = attachments.attachments[attachment_id]
+    send_notice(client_socket, client_info, '@file', f'Sending {attachment_id} {upload.size} {upload.name}')
+    client_info.add_stream(download)
+
+
+def remove_client(client_socket, socket_list, client_dict, cluster=None, attachments=None, presence=None,
+                  recorder=None):
+
+    user = client_dict.pop(client_socket)
+    socket_list.remove(client_socket)
+    print(f'Closed connection from {decode_message(user.data)}')
+
+    if cluster is not None:
+        cluster.member_left(user.room)
+
+    if attachments is not None:
+        attachments.abort_upload(client_socket)
+
+    if presence is not None:
+        presence.left(user.room, decode_message(user.data))
+
+    if recorder is not None:
+        recorder.record_disconnect(client_socket)
+
+    user.close()
+    client_socket.close()
 
-    message = receive_message(client_socket)
+
+def handle_client_message(client_socket, socket_list, client_dict, indexer=None, message_filter=None, cluster=None,
+                          profiler=None, attachments=None, presence=None, recorder=None, offload=None):
+
+    # One read may carry several messages, or only part of one
+    messages = client_dict[client_socket].read_messages()
     
     # Client disconnected
-    if message is False:
-        username = decode_message(client_dict[client_socket]['data'])
-        print(f'Closed connection from {username}')
-        
-        socket_list.remove(client_socket)
-        del client_dict[client_socket]
+    if messages is False:
+        remove_client(client_socket, socket_list, client_dict, cluster, attachments, presence, recorder)
         return
-    
-    # Get client info and broadcast message
-    user = client_dict[client_socket]
-    username = decode_message(user['data'])
+
+    for message in messages:
+        # Captured as received, before any command handling or filtering
+        if recorder is not None:
+            recorder.record_message(client_socket, message['data'])
+        process_message(
+            client_socket, client_dict, message, indexer, message_filter, cluster, profiler, attachments, presence,
+            offload
+        )
+
+
+def process_message(client_socket, client_dict, message, indexer=None, message_filter=None, cluster=None,
+                    profiler=None, attachments=None, presence=None, offload=None):
+
+    # Upload chunks are tagged, so chat can be sent while one is running
+    if attachments is not None:
+        chunk = parse_upload_chunk(message['data'])
+        if chunk is not None:
+            handle_upload_chunk(client_socket, client_dict, attachments, *chunk)
+            return
+
+    # With an offload stage every frame takes the pool, commands included,
+    # so a sender's commands never overtake its messages still being
+    # filtered. The loop dispatches each one with its verdict.
+    if offload is not None and message_filter is not None:
+        user = client_dict[client_socket]
+        offload.submit(client_socket, (user.data, message['data']), message)
+        return
+
+    dispatch_message(
+        client_socket, client_dict, message, None, indexer, message_filter, cluster, profiler, attachments, presence,
+        offload
+    )
+
+
+def dispatch_message(client_socket, client_dict, message, reason=None, indexer=None, message_filter=None,
+                     cluster=None, profiler=None, attachments=None, presence=None, offload=None):
+
+    # The sender may have left while the message was being filtered
+    user = client_dict.get(client_socket)
+    if user is None:
+        return
+
+    room = user.room
+    username = decode_message(user.data)
     msg_content = decode_message(message['data'])
     
     print(f'Received message from {username}: {msg_content}')
+
+    if profiler is not None and msg_content == PROFILE_COMMAND and is_admin(client_socket, username):
+        handle_profile(client_socket, user, profiler)
+        return
+
+    if offload is not None and msg_content == STATS_COMMAND and is_admin(client_socket, username):
+        handle_stats(client_socket, user, offload)
+        return
+
+    if msg_content.startswith(JOIN_COMMAND):
+        handle_join(client_socket, user, cluster, msg_content[len(JOIN_COMMAND):].strip(), presence)
+        return
+
+    if presence is not None and msg_content == TYPING_COMMAND:
+        presence.typing(room, username)
+        return
+
+    if attachments is not None and msg_content.startswith(ATTACH_COMMAND):
+        handle_attach(client_socket, user, attachments, msg_content)
+        return
+
+    if attachments is not None and msg_content.startswith(FETCH_COMMAND):
+        handle_fetch(client_socket, user, attachments, msg_content[len(FETCH_COMMAND):].strip())
+        return
+
+    # Search requests are answered to the sender only
+    if indexer is not None and msg_content.startswith(SEARCH_COMMAND):
+        handle_search(client_socket, user, indexer, msg_content[len(SEARCH_COMMAND):])
+        return
+
+    # Run filter stages before anything is broadcast, unless the offload
+    # stage already has
+    if message_filter is not None:
+        reason = message_filter.check(user.data, message['data'])
+    if reason:
+        print(f'Blocked message from {username}: {reason}')
+        send_notice(client_socket, user, '@filter', f'Message not delivered: {reason}')
+        return
     
-    # Broadcast to all other clients
+    # Sending a message ends the sender's typing indicator
+    if presence is not None:
+        presence.idle(room, username)
+
+    # Broadcast to all other clients in the room
     broadcast_message(
         client_socket,
         client_dict,
-        user['header'],
-        user['data'],
+        user.header,
+        user.data,
         message['header'],
-        message['data']
+        message['data'],
+        room
     )
 
+    # Relay to other nodes that have members in the room
+    if cluster is not None:
+        cluster.relay(room, user.header, user.data, message['header'], message['data'])
+
+    if indexer is not None:
+        indexer.submit(user.data, message['data'], room)
+
+
+def start_cluster(client_dict, indexer):
+
+    def deliver(room, user_header, user_data, msg_header, msg_data):
+        broadcast_message(None, client_dict, user_header, user_data, msg_header, msg_data, room)
+        indexer.submit(user_data, msg_data, room)
+
+    cluster = ClusterNode(deliver, HOST, CLUSTER_PORT, CLUSTER_ADVERTISE or None)
+    cluster.start()
+    for address in parse_peer_list(CLUSTER_PEERS):
+        cluster.add_peer(address)
+    return cluster
+
 
 def run_server():
     # Main server loop.
     server_socket = initialize_server()
-    socket_list = [server_socket]
+    ws_server_socket = initialize_websocket_server()
+    socket_list = [server_socket, ws_server_socket]
+    # Clients on the Unix socket share the TCP framing and broadcast path
+    unix_server_socket = initialize_unix_server(UNIX_SOCKET) if UNIX_SOCKET else None
+    if unix_server_socket is not None:
+        socket_list.append(unix_server_socket)
     client_dict = {}
+    # Connections with output the socket could not take yet
+    backlog = set()
+    # WebSocket clients still sending their upgrade request or username
+    handshakes = {}
+    indexer = IndexWorker(SearchIndex())
+    indexer.start()
+
+    message_filter = None
+    offload = None
+    if FILTER_FILE:
+        pattern_filter = PatternFilter()
+        FilterReloader(pattern_filter, FILTER_FILE).start()
+        message_filter = FilterPipeline([pattern_filter])
+        # Filter checks run off the loop; verdicts come back in order per sender
+        offload = OffloadStage(message_filter.check)
+
+    # Cluster mode is enabled by giving the node a cluster port
+    cluster = start_cluster(client_dict, indexer) if CLUSTER_PORT else None
+
+    # Idle until toggled by SIGUSR1 or an admin's /profile command
+    profiler = SamplingProfiler()
+    install_signal_handler(profiler)
+
+    attachments = AttachmentStore()
+    presence = PresenceTracker()
+
+    # Optional capture of inbound traffic for src.replay
+    recorder = None
+    if CAPTURE_FILE:
+        recorder = TrafficRecorder(CAPTURE_FILE)
+        recorder.start()
     
     print('Waiting for connections...')
     
     while True:
-        read_sockets, _, exception_sockets = select.select(
-            socket_list, [], socket_list
+        read_list = socket_list + [indexer.wakeup_fd]
+        # Wake for the next presence diff, cluster redial, handshake
+        # deadline or attachment expiry, whichever is first
+        timeouts = [presence.timeout(), attachments.timeout()]
+        if cluster is not None:
+            read_list = read_list + cluster.sockets()
+            timeouts.append(cluster.timeout())
+        if offload is not None:
+            read_list = read_list + [offload.wakeup_fd]
+        if handshakes:
+            read_list = read_list + list(handshakes)
+            deadline = min(handshake.deadline for handshake in handshakes.values())
+            timeouts.append(max(0.0, deadline - time.monotonic()))
+        timeouts = [timeout for timeout in timeouts if timeout is not None]
+        timeout = min(timeouts) if timeouts else None
+
+        write_list = [connection.sock for connection in backlog]
+        if cluster is not None:
+            write_list += cluster.write_sockets()
+        read_sockets, write_sockets, exception_sockets = select.select(
+            read_list, write_list, socket_list, timeout
         )
         
         for notified_socket in read_sockets:
             # New connection
-            if notified_socket == server_socket:
-                handle_new_connection(server_socket, socket_list, client_dict)
+            if notified_socket == server_socket or notified_socket == unix_server_socket:
+                handle_new_connection(
+                    notified_socket, socket_list, client_dict, cluster, backlog, presence, recorder
+                )
+
+            # New WebSocket connection
+            elif notified_socket == ws_server_socket:
+                handle_new_websocket_connection(ws_server_socket, handshakes)
+
+            # WebSocket client part way through its handshake
+            elif notified_socket in handshakes:
+                handle_websocket_handshake(
+                    notified_socket, handshakes, socket_list, client_dict, cluster, backlog, presence, recorder
+                )
+
+            # Peer node traffic
+            elif cluster is not None and cluster.owns(notified_socket):
+                cluster.handle_readable(notified_socket)
+
+            # Search results are ready
+            elif notified_socket == indexer.wakeup_fd:
+                send_search_results(client_dict, indexer)
+
+            # Offloaded filter verdicts are ready
+            elif offload is not None and notified_socket == offload.wakeup_fd:
+                for client_socket, message, reason, error in offload.completed():
+                    if error is not None:
+                        print(f'Filter error: {error}')
+                        reason = 'filter error'
+                    dispatch_message(
+                        client_socket, client_dict, message, reason, indexer, None, cluster, profiler, attachments,
+                        presence, offload
+                    )
             
             # Existing client message
-            else:
-                handle_client_message(notified_socket, socket_list, client_dict)
+            elif notified_socket in client_dict:
+                handle_client_message(
+                    notified_socket, socket_list, client_dict, indexer, message_filter, cluster, profiler,
+                    attachments, presence, recorder, offload
+                )
+
+        # Drain buffered output, then attachment chunks
+        for notified_socket in write_sockets:
+            if notified_socket in client_dict:
+                client_dict[notified_socket].flush()
+            elif cluster is not None and cluster.owns(notified_socket):
+                cluster.handle_writable(notified_socket)
         
         # Handle socket exceptions
         for notified_socket in exception_sockets:
-            socket_list.remove(notified_socket)
-            del client_dict[notified_socket]
+            if notified_socket in client_dict:
+                remove_client(
+                    notified_socket, socket_list, client_dict, cluster, attachments, presence, recorder
+                )
+
+        if handshakes:
+            expire_handshakes(handshakes)
+
+        attachments.expire()
+
+        # One coalesced presence diff per changed room
+        for room, diff in presence.flush():
+            broadcast_notice(client_dict, room, PRESENCE_USER, diff)
+
+        # Send this iteration's relay batches
+        if cluster is not None:
+            cluster.flush()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,265 @@
+"""
+WebSocket Transport
+Minimal RFC 6455 handshake and framing for browser clients.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import struct
+import time
+from src.protocol import encode_header
+
+WEBSOCKET = 'websocket'
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+MAX_HANDSHAKE_SIZE = 8192
+# Seconds a new client has to finish the upgrade and send its username
+HANDSHAKE_TIMEOUT = 5.0
+# Largest message a client may send, whole or across fragments
+MAX_PAYLOAD_SIZE = int(os.getenv('CHAT_WS_MAX_PAYLOAD', str(1024 * 1024)))
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+# Close status codes
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_TOO_BIG = 1009
+
+
+class FrameError(ValueError):
+    # A client frame the server must answer by closing the connection.
+
+    def __init__(self, code: int, reason: str):
+        super().__init__(reason)
+        self.code = code
+
+
+def build_accept_key(key: bytes) -> bytes:
+
+    return base64.b64encode(hashlib.sha1(key.strip() + WS_GUID).digest())
+
+
+def parse_handshake(request: bytes) -> dict:
+    # Returns the upgrade request's headers (lowercased), or None.
+
+    lines = request.split(b'\r\n\r\n', 1)[0].split(b'\r\n')
+    if not lines[0].startswith(b'GET '):
+        return None
+
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(b':')
+        headers[name.strip().lower()] = value.strip()
+    return headers
+
+
+def handshake_response(headers: dict) -> bytes:
+    # Returns the 101 response, or None when the request is not a valid
+    # WebSocket upgrade.
+
+    if (headers is None
+            or headers.get(b'upgrade', b'').lower() != b'websocket'
+            or b'sec-websocket-key' not in headers):
+        return None
+
+    return (
+        b'HTTP/1.1 101 Switching Protocols\r\n'
+        b'Upgrade: websocket\r\n'
+        b'Connection: Upgrade\r\n'
+        b'Sec-WebSocket-Accept: ' + build_accept_key(headers[b'sec-websocket-key']) + b'\r\n\r\n'
+    )
+
+
+def encode_frame_header(length: int, opcode: int = OP_TEXT) -> bytes:
+    # Server-to-client frames are never masked.
+
+    if length < 126:
+        return struct.pack('!BB', 0x80 | opcode, length)
+    if length < 0x10000:
+        return struct.pack('!BBH', 0x80 | opcode, 126, length)
+    return struct.pack('!BBQ', 0x80 | opcode, 127, length)
+
+
+def encode_frame(payload: bytes, opcode: int = OP_TEXT) -> bytes:
+
+    return encode_frame_header(len(payload), opcode) + payload
+
+
+def mask_payload(payload: bytes, mask: bytes) -> bytes:
+    # XOR a whole integer at a time rather than byte by byte.
+
+    repeated = (mask * (len(payload) // 4 + 1))[:len(payload)]
+    masked = int.from_bytes(payload, 'big') ^ int.from_bytes(repeated, 'big')
+    return masked.to_bytes(len(payload), 'big')
+
+
+def encode_close(code: int) -> bytes:
+
+    return encode_frame(struct.pack('!H', code), OP_CLOSE)
+
+
+def parse_frame(buffer: bytes, max_payload: int = None, require_mask: bool = False):
+    # Returns (fin, opcode, payload, consumed), or None if the buffer
+    # does not yet hold a complete frame. With require_mask, as for
+    # client frames, an unmasked frame raises FrameError; so does a
+    # length over max_payload, as soon as the header shows it.
+
+    if len(buffer) < 2:
+        return None
+
+    first, second = buffer[0], buffer[1]
+    if require_mask and not second & 0x80:
+        raise FrameError(CLOSE_PROTOCOL_ERROR, 'unmasked client frame')
+    length = second & 0x7F
+    offset = 2
+    if length == 126:
+        if len(buffer) < 4:
+            return None
+        length = struct.unpack_from('!H', buffer, 2)[0]
+        offset = 4
+    elif length == 127:
+        if len(buffer) < 10:
+            return None
+        length = struct.unpack_from('!Q', buffer, 2)[0]
+        offset = 10
+
+    if max_payload is not None and length > max_payload:
+        raise FrameError(CLOSE_TOO_BIG, f'frame of {length} bytes')
+
+    mask = None
+    if second & 0x80:
+        mask = bytes(buffer[offset:offset + 4])
+        offset += 4
+
+    if len(buffer) < offset + length:
+        return None
+
+    payload = bytes(buffer[offset:offset + length])
+    if mask is not None:
+        payload = mask_payload(payload, mask)
+    return bool(first & 0x80), first & 0x0F, payload, offset + length
+
+
+def frame_size(buffer) -> int:
+    # Bytes needed for the frame starting the buffer, as far as the buffer
+    # shows so far: the header first, then header and payload.
+
+    if len(buffer) < 2:
+        return 2
+    length = buffer[1] & 0x7F
+    offset = 2 + {126: 2, 127: 8}.get(length, 0) + (4 if buffer[1] & 0x80 else 0)
+    if len(buffer) < offset:
+        return offset
+    if length == 126:
+        length = struct.unpack_from('!H', buffer, 2)[0]
+    elif length == 127:
+        length = struct.unpack_from('!Q', buffer, 2)[0]
+    return offset + length
+
+
+class WebSocketHandshake:
+    # A WebSocket client that has connected but not yet sent its username.
+    # The server loop calls read() whenever the socket is readable, so a
+    # slow or silent client never blocks anyone else. Frames are read
+    # exactly, leaving whatever follows the username for the Connection.
+
+    __slots__ = ('sock', 'address', 'deadline', 'buffer', 'upgraded', 'fragments')
+
+    def __init__(self, sock, address, timeout: float = HANDSHAKE_TIMEOUT, clock=time.monotonic):
+        self.sock = sock
+        self.address = address
+        self.deadline = clock() + timeout
+        self.buffer = b''
+        self.upgraded = False
+        self.fragments = []
+
+    def read(self):
+        # Returns the username message in {'header', 'data'} form once it
+        # has arrived, None while more is needed, or False when the client
+        # should be dropped.
+        try:
+            if not self.upgraded:
+                return self._read_request()
+            return self._read_username()
+        except FrameError as e:
+            print(f'WebSocket protocol error: {e}')
+            self._send(encode_close(e.code))
+            return False
+        except BlockingIOError:
+            return None
+        except OSError as e:
+            print(f"Socket error: {e}")
+            return False
+
+    def _send(self, data: bytes) -> bool:
+        # A fresh socket's send buffer is empty, so these short replies fit.
+        try:
+            return self.sock.send(data) == len(data)
+        except OSError:
+            return False
+
+    def _read_request(self):
+        chunk = self.sock.recv(1024)
+        if not chunk:
+            return False
+        self.buffer += chunk
+        if b'\r\n\r\n' not in self.buffer:
+            return False if len(self.buffer) > MAX_HANDSHAKE_SIZE else None
+
+        # Clients must wait for the response before sending frames
+        request, _, rest = self.buffer.partition(b'\r\n\r\n')
+        response = None if rest else handshake_response(parse_handshake(request))
+        if response is None:
+            self._send(b'HTTP/1.1 400 Bad Request\r\nConnection: close\r\n\r\n')
+            return False
+        if not self._send(response):
+            return False
+
+        self.upgraded = True
+        self.buffer = b''
+        return None
+
+    def _read_username(self):
+        while True:
+            # Rejects oversized and unmasked frames from the header alone
+            parse_frame(self.buffer, MAX_PAYLOAD_SIZE, require_mask=True)
+            chunk = self.sock.recv(frame_size(self.buffer) - len(self.buffer))
+            if not chunk:
+                return False
+            self.buffer += chunk
+
+            frame = parse_frame(self.buffer, MAX_PAYLOAD_SIZE, require_mask=True)
+            if frame is None:
+                continue
+            self.buffer = b''
+
+            fin, opcode, payload, _ = frame
+            if opcode == OP_CLOSE:
+                self._send(encode_frame(payload[:2], OP_CLOSE))
+                return False
+            if opcode == OP_PING:
+                self._send(encode_frame(payload, OP_PONG))
+                continue
+            if opcode == OP_PONG:
+                continue
+
+            self.fragments.append(payload)
+            if sum(len(fragment) for fragment in self.fragments) > MAX_PAYLOAD_SIZE:
+                raise FrameError(CLOSE_TOO_BIG, 'message too big')
+            if fin:
+                data = b''.join(self.fragments)
+                return {'header': encode_header(len(data)), 'data': data}
+
+
+def encode_chat_frame(user_data: bytes, msg_data: bytes) -> bytes:
+
+    payload = json.dumps({
+        'username': user_data.decode('utf-8'),
+        'message': msg_data.decode('utf-8')
+    }, ensure_ascii=False).encode('utf-8')
+    return encode_frame(payload)
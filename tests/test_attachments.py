@@ -0,0 +1,330 @@
+"""
+Unit tests for attachments.py
+"""
+
+import os
+import socket
+import subprocess
+import sys
+from unittest.mock import Mock
+import pytest
+from src.attachments import (
+    AttachmentStore,
+    Download,
+    CHUNK_SIZE,
+    encode_upload_chunk,
+    parse_attach_command,
+    parse_upload_chunk
+)
+from src.server import handle_client_message
+from src.connection import Connection
+from src.protocol import DEFAULT_ROOM, encode_message, split_frames
+from src.websocket import WEBSOCKET, OP_BINARY, parse_frame
+
+
+def read_all(sock) -> bytes:
+
+    sock.setblocking(False)
+    data = b''
+    while True:
+        try:
+            chunk = sock.recv(1 << 20)
+        except BlockingIOError:
+            return data
+        if not chunk:
+            return data
+        data += chunk
+
+
+def split_messages(data: bytes) -> list:
+    # Server frames are user header + user + message header + message
+
+    frames, consumed = split_frames(data)
+    assert consumed == len(data)
+    return [(frames[i][1], frames[i + 1][1]) for i in range(0, len(frames), 2)]
+
+
+@pytest.fixture
+def store(tmp_path):
+
+    return AttachmentStore(str(tmp_path))
+
+
+@pytest.fixture
+def pair():
+
+    server_side, client_side = socket.socketpair()
+    server_side.setblocking(False)
+    yield server_side, client_side
+    server_side.close()
+    client_side.close()
+
+
+class TestUploads:
+
+    def test_chunks_spooled_to_disk(self, store):
+
+        sock = Mock()
+        upload = store.begin_upload(sock, 'notes.txt', 10)
+
+        assert store.write_chunk(sock, upload.attachment_id, b'hello') is None
+        assert store.write_chunk(sock, upload.attachment_id, b'world') is upload
+        assert sock not in store.uploads
+        with open(upload.path, 'rb') as spooled:
+            assert spooled.read() == b'helloworld'
+
+    def test_size_limits(self, store):
+
+        with pytest.raises(ValueError):
+            store.begin_upload(Mock(), 'empty', 0)
+
+    def test_abort_removes_spool_file(self, store):
+
+        sock = Mock()
+        upload = store.begin_upload(sock, 'big.bin', 100)
+        store.write_chunk(sock, upload.attachment_id, b'partial')
+
+        store.abort_upload(sock)
+
+        assert not os.path.exists(upload.path)
+        assert store.open_download(upload.attachment_id, DEFAULT_ROOM) is None
+
+    def test_finished_attachment_expires(self, tmp_path):
+
+        now = [0.0]
+        store = AttachmentStore(str(tmp_path), ttl=60, clock=lambda: now[0])
+        sock = Mock()
+        upload = store.begin_upload(sock, 'notes.txt', 5)
+        store.write_chunk(sock, upload.attachment_id, b'hello')
+        assert store.timeout() == 60
+
+        now[0] = 59
+        store.expire()
+        assert os.path.exists(upload.path)
+
+        now[0] = 60
+        store.expire()
+        assert not os.path.exists(upload.path)
+        assert store.open_download(upload.attachment_id, DEFAULT_ROOM) is None
+        assert store.timeout() is None
+
+    def test_stale_spool_files_removed(self, tmp_path):
+
+        exited = subprocess.Popen([sys.executable, '-c', 'pass'])
+        exited.wait()
+        stale = tmp_path / f'{exited.pid}-1'
+        live = tmp_path / f'{os.getpid()}-1'
+        stale.write_bytes(b'old')
+        live.write_bytes(b'current')
+
+        AttachmentStore(str(tmp_path))
+
+        assert not stale.exists()
+        assert live.exists()
+
+    def test_upload_chunk_tag(self):
+
+        frames, _ = split_frames(encode_upload_chunk('7', b'\n\x00data'))
+
+        assert parse_upload_chunk(frames[0][1]) == ('7', b'\n\x00data')
+        assert parse_upload_chunk('@file:7 is not a chunk'.encode('utf-8')) is None
+        assert parse_upload_chunk(b'hello') is None
+
+    def test_parse_attach_command(self):
+
+        assert parse_attach_command('/attach 42 my file.txt') == (42, 'my file.txt')
+        assert parse_attach_command('/attach 42') == (42, 'attachment')
+        with pytest.raises(ValueError):
+            parse_attach_command('/attach lots file.txt')
+
+
+class TestDownloads:
+
+    def test_stream_in_chunk_frames(self, store, pair):
+
+        server_side, client_side = pair
+        sock = Mock()
+        content = os.urandom(CHUNK_SIZE * 2 + 100)
+        upload = store.begin_upload(sock, 'data.bin', len(content))
+        store.write_chunk(sock, upload.attachment_id, content)
+
+        connection = Connection(server_side, b'5         ', b'Alice')
+        connection.add_stream(store.open_download(upload.attachment_id, DEFAULT_ROOM))
+        while not connection.flush():
+            pass
+
+        messages = split_messages(read_all(client_side))
+        assert len(messages) == 3
+        assert {username for username, _ in messages} == {b'@file:' + upload.attachment_id.encode()}
+        assert b''.join(data for _, data in messages) == content
+        assert connection.streams is None
+
+    def test_websocket_chunks_are_binary_frames(self, store, pair):
+
+        server_side, client_side = pair
+        sock = Mock()
+        upload = store.begin_upload(sock, 'data.bin', 5)
+        store.write_chunk(sock, upload.attachment_id, b'abcde')
+
+        connection = Connection(server_side, b'5         ', b'Alice', transport=WEBSOCKET)
+        connection.add_stream(store.open_download(upload.attachment_id, DEFAULT_ROOM, WEBSOCKET))
+        connection.flush()
+
+        assert parse_frame(read_all(client_side))[1:3] == (OP_BINARY, b'abcde')
+
+    def test_chat_never_splits_a_chunk(self, tmp_path, pair):
+
+        server_side, client_side = pair
+        path = tmp_path / 'large.bin'
+        content = os.urandom(CHUNK_SIZE * 64)
+        path.write_bytes(content)
+
+        backlog = set()
+        connection = Connection(server_side, b'5         ', b'Alice', backlog=backlog)
+        connection.add_stream(Download('1', str(path), len(content)))
+        chat = b''.join(encode_message('Bob')) + b''.join(encode_message('still here'))
+
+        # Fill the socket until a chunk is left half written, then queue chat
+        while not connection.streams[0].in_frame:
+            connection.flush()
+        connection.send(chat)
+        assert connection.queue.queued_bytes == len(chat)
+
+        received = b''
+        while connection in backlog:
+            connection.flush()
+            received += read_all(client_side)
+        received += read_all(client_side)
+
+        messages = split_messages(received)
+        chunks = b''.join(data for username, data in messages if username == b'@file:1')
+        assert chunks == content
+        assert (b'Bob', b'still here') in messages
+        # Chat jumps ahead of every chunk not yet started
+        assert messages.index((b'Bob', b'still here')) < len(messages) - 1
+
+    def test_close_releases_file(self, tmp_path):
+
+        path = tmp_path / 'data.bin'
+        path.write_bytes(b'abc')
+        download = Download('1', str(path), 3)
+        connection = Connection(Mock(), b'5         ', b'Alice')
+        connection.add_stream(download)
+
+        connection.close()
+
+        assert download.fd is None
+        assert connection.streams is None
+
+
+class TestServerAttachments:
+
+    def test_upload_announce_and_fetch(self, store):
+
+        sender = Mock()
+        receiver = Mock()
+        sender.send.side_effect = len
+        receiver.send.side_effect = len
+        client_dict = {
+            sender: Connection(sender, b'5         ', b'Alice'),
+            receiver: Connection(receiver, b'3         ', b'Bob')
+        }
+        socket_list = [sender, receiver]
+
+        sender.recv.return_value = b''.join(encode_message('/attach 6 photo.png'))
+        handle_client_message(sender, socket_list, client_dict, attachments=store)
+        assert sender.send.call_args[0][0].endswith(b'Ready for photo.png as 1')
+        receiver.send.assert_not_called()
+
+        # Binary chunk data is not decoded or broadcast as chat
+        sender.recv.return_value = encode_upload_chunk('1', b'\xff\xfe\x00') + encode_upload_chunk('1', b'png')
+        handle_client_message(sender, socket_list, client_dict, attachments=store)
+
+        assert receiver.send.call_args[0][0].endswith(b'shared photo.png (6 bytes), /fetch 1')
+
+        receiver.recv.return_value = b''.join(encode_message('/fetch 1'))
+        handle_client_message(receiver, socket_list, client_dict, attachments=store)
+
+        assert receiver.send.call_args[0][0].endswith(b'Sending 1 6 photo.png')
+        assert len(client_dict[receiver].streams) == 1
+        client_dict[receiver].close()
+
+    def test_chat_during_upload(self, store):
+
+        sender = Mock()
+        receiver = Mock()
+        sender.send.side_effect = len
+        receiver.send.side_effect = len
+        client_dict = {
+            sender: Connection(sender, b'5         ', b'Alice'),
+            receiver: Connection(receiver, b'3         ', b'Bob')
+        }
+        socket_list = [sender, receiver]
+
+        sender.recv.return_value = b''.join(encode_message('/attach 6 photo.png'))
+        handle_client_message(sender, socket_list, client_dict, attachments=store)
+
+        sender.recv.return_value = (
+            encode_upload_chunk('1', b'abc')
+            + b''.join(encode_message('still chatting'))
+            + encode_upload_chunk('1', b'def')
+        )
+        handle_client_message(sender, socket_list, client_dict, attachments=store)
+
+        sent = [split_messages(call[0][0])[0] for call in receiver.send.call_args_list]
+        assert sent[0] == (b'Alice', b'still chatting')
+        assert sent[1][1].endswith(b'shared photo.png (6 bytes), /fetch 1')
+        with open(store.attachments['1'].path, 'rb') as spooled:
+            assert spooled.read() == b'abcdef'
+
+    def test_fetch_from_other_room_refused(self, store):
+
+        sender = Mock()
+        outsider = Mock()
+        sender.send.side_effect = len
+        outsider.send.side_effect = len
+        client_dict = {
+            sender: Connection(sender, b'5         ', b'Alice'),
+            outsider: Connection(outsider, b'3         ', b'Eve')
+        }
+        client_dict[outsider].room = 'elsewhere'
+        socket_list = [sender, outsider]
+
+        sender.recv.return_value = b''.join(encode_message('/attach 3 secret.txt'))
+        handle_client_message(sender, socket_list, client_dict, attachments=store)
+        sender.recv.return_value = encode_upload_chunk('1', b'abc')
+        handle_client_message(sender, socket_list, client_dict, attachments=store)
+        outsider.send.assert_not_called()
+
+        outsider.recv.return_value = b''.join(encode_message('/fetch 1'))
+        handle_client_message(outsider, socket_list, client_dict, attachments=store)
+
+        assert outsider.send.call_args[0][0].endswith(b'No attachment 1')
+        assert client_dict[outsider].streams is None
+
+    def test_fetch_unknown_attachment(self, store):
+
+        sender = Mock()
+        sender.send.side_effect = len
+        client_dict = {sender: Connection(sender, b'5         ', b'Alice')}
+
+        sender.recv.return_value = b''.join(encode_message('/fetch 99'))
+        handle_client_message(sender, [sender], client_dict, attachments=store)
+
+        assert sender.send.call_args[0][0].endswith(b'No attachment 99')
+
+    def test_disconnect_aborts_upload(self, store):
+
+        sender = Mock()
+        sender.send.side_effect = len
+        client_dict = {sender: Connection(sender, b'5         ', b'Alice')}
+
+        sender.recv.return_value = b''.join(encode_message('/attach 100 big.bin'))
+        handle_client_message(sender, [sender], client_dict, attachments=store)
+        path = store.uploads[sender].path
+
+        sender.recv.return_value = b''
+        handle_client_message(sender, [sender], client_dict, attachments=store)
+
+        assert not os.path.exists(path)
+        assert store.uploads == {}
@@ -0,0 +1,197 @@
+"""
+Unit tests for client.py
+"""
+
+import io
+import os
+import socket
+import threading
+from unittest.mock import Mock
+from src.client import (
+    FrameReader,
+    Renderer,
+    handle_file_notice,
+    receive_messages,
+    send_attachment,
+    send_message_to_server
+)
+from src.attachments import CHUNK_SIZE, parse_upload_chunk
+from src.protocol import HEADER_LENGTH, encode_message, split_frames
+
+
+def frame(username: str, message: str) -> bytes:
+
+    return b''.join(encode_message(username)) + b''.join(encode_message(message))
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestFrameReader:
+
+    def test_splits_several_frames(self):
+
+        reader = FrameReader()
+        frames = reader.feed(frame('Alice', 'hi') + frame('Bob', '世界'))
+        assert frames == [(b'Alice', b'hi'), (b'Bob', '世界'.encode('utf-8'))]
+        assert reader.buffer == b''
+
+    def test_keeps_partial_frame(self):
+
+        data = frame('Alice', 'hello') + frame('Bob', 'hey')
+        reader = FrameReader()
+        assert reader.feed(data[:5]) == []
+        assert reader.feed(data[5:31]) == [(b'Alice', b'hello')]
+        assert reader.feed(data[31:]) == [(b'Bob', b'hey')]
+
+
+class TestRenderer:
+
+    def test_lines_written_in_one_write(self):
+
+        out = Mock()
+        renderer = Renderer(out=out, clock=FakeClock())
+        for i in range(100):
+            renderer.add(f'Alice > {i}')
+
+        assert renderer.render()
+        out.write.assert_called_once()
+        assert out.write.call_args[0][0].count('Alice >') == 100
+
+    def test_redraws_rate_limited(self):
+
+        out = io.StringIO()
+        clock = FakeClock()
+        renderer = Renderer(out=out, rate=30, clock=clock)
+
+        renderer.add('first')
+        assert renderer.render()
+        renderer.add('second')
+        assert not renderer.render()
+        assert 0 < renderer.timeout() <= 1 / 30
+
+        clock.now += 1 / 30
+        assert renderer.render()
+        assert out.getvalue() == '\nfirst\n\nsecond\n'
+        assert renderer.timeout() is None
+
+    def test_scrollback_bounded(self):
+
+        out = io.StringIO()
+        renderer = Renderer(out=out, scrollback=10, clock=FakeClock())
+        for i in range(25):
+            renderer.add(f'line {i}')
+
+        assert len(renderer.lines) == 10
+        renderer.render()
+        assert '15 earlier messages not shown' in out.getvalue()
+        assert 'line 14\n' not in out.getvalue()
+        assert out.getvalue().endswith('\nline 24\n')
+
+
+class TestReceiveMessages:
+
+    def test_burst_rendered_in_few_writes(self):
+
+        server_side, client_side = socket.socketpair()
+        client_side.setblocking(False)
+        out = Mock()
+        thread = threading.Thread(
+            target=receive_messages, args=(client_side, Renderer(out=out, scrollback=5000)), daemon=True
+        )
+        try:
+            server_side.sendall(b''.join(frame('Alice', f'message {i}') for i in range(2000)))
+            thread.start()
+            server_side.close()
+            thread.join(5)
+            assert not thread.is_alive()
+        finally:
+            client_side.close()
+
+        written = ''.join(call[0][0] for call in out.write.call_args_list)
+        assert written.count('Alice > message') == 2000
+        assert written.endswith('Connection closed by server\n')
+        assert out.write.call_count < 20
+
+    def test_closed_connection_returns(self):
+
+        server_side, client_side = socket.socketpair()
+        client_side.setblocking(False)
+        server_side.close()
+        out = io.StringIO()
+        try:
+            receive_messages(client_side, Renderer(out=out))
+        finally:
+            client_side.close()
+
+        assert 'Connection closed by server' in out.getvalue()
+
+    def test_malformed_notice_does_not_stop_thread(self):
+
+        server_side, client_side = socket.socketpair()
+        client_side.setblocking(False)
+        out = io.StringIO()
+        try:
+            server_side.sendall(frame('@presence', 'not json') + frame('Alice', 'still here'))
+            server_side.close()
+            receive_messages(client_side, Renderer(out=out))
+        finally:
+            client_side.close()
+
+        assert 'Could not display message' in out.getvalue()
+        assert 'Alice > still here' in out.getvalue()
+
+
+class TestSendAttachment:
+
+    def test_missing_file_reported(self, tmp_path, capsys):
+
+        sock = Mock()
+        send_attachment(sock, str(tmp_path / 'missing.txt'))
+
+        assert 'Cannot attach' in capsys.readouterr().out
+        sock.sendall.assert_not_called()
+        sock.send.assert_not_called()
+
+    def test_chunks_tagged_and_chat_interleaves(self, tmp_path):
+
+        path = tmp_path / 'photo.png'
+        content = os.urandom(CHUNK_SIZE * 20 + 5)
+        path.write_bytes(content)
+        server_side, client_side = socket.socketpair()
+        client_side.setblocking(False)
+        server_side.settimeout(5)
+        upload = threading.Thread(target=send_attachment, args=(client_side, str(path)))
+        chat = threading.Thread(target=send_message_to_server, args=(client_side, 'hello while uploading'))
+        try:
+            upload.start()
+            received = server_side.recv(65536)
+            handle_file_notice('Ready for photo.png as 7')
+            chat.start()
+
+            # The server side reads everything both threads send
+            chunk_overhead = HEADER_LENGTH + len(b'@file:7\n')
+            expected = (len(received) + len(content) + 21 * chunk_overhead
+                        + len(b''.join(encode_message('hello while uploading'))))
+            while len(received) < expected:
+                received += server_side.recv(65536)
+            upload.join(5)
+            chat.join(5)
+        finally:
+            server_side.close()
+            client_side.close()
+
+        frames, consumed = split_frames(received)
+        assert consumed == len(received)
+        assert frames[0][1] == f'/attach {len(content)} photo.png'.encode('utf-8')
+        chunks = [parse_upload_chunk(data) for _, data in frames[1:]]
+        assert chunks.count(None) == 1
+        assert frames[1 + chunks.index(None)][1] == b'hello while uploading'
+        assert {chunk[0] for chunk in chunks if chunk} == {'7'}
+        assert b''.join(chunk[1] for chunk in chunks if chunk) == content
@@ -0,0 +1,339 @@
+"""
+Unit and multi-process tests for cluster.py
+"""
+
+import os
+import select
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+import pytest
+import src.cluster
+from src.cluster import (
+    ClusterNode,
+    KIND_INTEREST,
+    encode_peer_frame,
+    parse_peer_list,
+    encode_relay_record,
+    decode_relay_records
+)
+from src.protocol import encode_message, decode_header, decode_message, HEADER_LENGTH
+
+PROJECT_ROOT = Path(__file__).parent.parent
+
+
+def pump(nodes, duration=0.2):
+    # Run the nodes' loop steps until traffic settles.
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        sockets = {}
+        for node in nodes:
+            for sock in node.sockets():
+                sockets[sock] = node
+        writers = {}
+        for node in nodes:
+            for sock in node.write_sockets():
+                writers[sock] = node
+        readable, writable, _ = select.select(list(sockets), list(writers), [], 0.02)
+        for sock in readable:
+            sockets[sock].handle_readable(sock)
+        for sock in writable:
+            writers[sock].handle_writable(sock)
+        for node in nodes:
+            node.flush()
+
+
+def make_nodes(count, host='127.0.0.1'):
+
+    nodes = []
+    for _ in range(count):
+        delivered = []
+        node = ClusterNode(
+            lambda *record, delivered=delivered: delivered.append(record),
+            host=host,
+            port=0
+        )
+        node.start()
+        node.delivered = delivered
+        nodes.append(node)
+
+    for node in nodes:
+        for peer in nodes:
+            if peer is not node:
+                node.add_peer(('127.0.0.1', peer.port))
+    pump(nodes)
+    return nodes
+
+
+def message_parts(username, message):
+
+    user_header, user_data = encode_message(username)
+    msg_header, msg_data = encode_message(message)
+    return user_header, user_data, msg_header, msg_data
+
+
+class TestRelayEncoding:
+
+    def test_parse_peer_list(self):
+
+        assert parse_peer_list(' 10.0.0.1:7000, node-b:7001 ,') == [('10.0.0.1', 7000), ('node-b', 7001)]
+        assert parse_peer_list('') == []
+
+    def test_records_roundtrip(self):
+
+        batch = (encode_relay_record('lobby', *message_parts('Alice', 'Hi'))
+                 + encode_relay_record('дом', *message_parts('Bob', 'Привет')))
+
+        records = list(decode_relay_records(batch))
+
+        assert records == [
+            ('lobby', *message_parts('Alice', 'Hi')),
+            ('дом', *message_parts('Bob', 'Привет'))
+        ]
+
+
+class TestClusterNode:
+
+    def test_relay_only_to_interested_nodes(self):
+
+        nodes = make_nodes(3)
+        try:
+            a, b, c = nodes
+            b.member_joined('lobby')
+            c.member_joined('ops')
+            pump(nodes)
+
+            a.relay('lobby', *message_parts('Alice', 'to lobby'))
+            a.relay('ops', *message_parts('Alice', 'to ops'))
+            a.relay('empty', *message_parts('Alice', 'to nobody'))
+            pump(nodes)
+
+            assert b.delivered == [('lobby', *message_parts('Alice', 'to lobby'))]
+            assert c.delivered == [('ops', *message_parts('Alice', 'to ops'))]
+            assert a.delivered == []
+        finally:
+            for node in nodes:
+                node.stop()
+
+    def test_messages_batched_per_flush(self):
+
+        nodes = make_nodes(2)
+        try:
+            a, b = nodes
+            b.member_joined('lobby')
+            pump(nodes)
+
+            for i in range(50):
+                a.relay('lobby', *message_parts('Alice', f'message {i}'))
+            link = a.links[f'127.0.0.1:{b.port}']
+            assert len(link.pending) == 50
+
+            pump(nodes)
+
+            assert link.pending == []
+            assert [decode_message(record[4]) for record in b.delivered] == [f'message {i}' for i in range(50)]
+        finally:
+            for node in nodes:
+                node.stop()
+
+    def test_interest_withdrawn_when_room_empties(self):
+
+        nodes = make_nodes(2)
+        try:
+            a, b = nodes
+            b.member_joined('lobby')
+            b.member_joined('lobby')
+            b.member_left('lobby')
+            pump(nodes)
+
+            a.relay('lobby', *message_parts('Alice', 'still here'))
+            pump(nodes)
+            assert len(b.delivered) == 1
+
+            b.member_left('lobby')
+            pump(nodes)
+            a.relay('lobby', *message_parts('Alice', 'gone'))
+            pump(nodes)
+            assert len(b.delivered) == 1
+        finally:
+            for node in nodes:
+                node.stop()
+
+    def test_relay_with_default_wildcard_host(self):
+        # Server defaults: listen on 0.0.0.0, no advertised address, peers
+        # listed by their loopback address
+
+        nodes = make_nodes(2, host='0.0.0.0')
+        try:
+            a, b = nodes
+            b.member_joined('lobby')
+            pump(nodes)
+
+            a.relay('lobby', *message_parts('Alice', 'across'))
+            pump(nodes)
+
+            assert b.delivered == [('lobby', *message_parts('Alice', 'across'))]
+        finally:
+            for node in nodes:
+                node.stop()
+
+    def test_stalled_peer_does_not_block(self, monkeypatch):
+
+        monkeypatch.setattr(src.cluster, 'MAX_PEER_BUFFER', 1024 * 1024)
+        stalled = socket.socket()
+        stalled.bind(('127.0.0.1', 0))
+        stalled.listen()
+        a = ClusterNode(lambda *record: None, host='127.0.0.1', port=0)
+        a.start()
+        try:
+            a.add_peer(stalled.getsockname())
+            link = a.links[f'127.0.0.1:{stalled.getsockname()[1]}']
+            peer, _ = stalled.accept()
+            # Ask for the room, then never read again
+            peer.sendall(encode_peer_frame(KIND_INTEREST, b'lobby'))
+            pump([a])
+            assert link.interest == {'lobby'}
+
+            started = time.monotonic()
+            while link.sock is not None and time.monotonic() - started < 5:
+                for _ in range(10):
+                    a.relay('lobby', *message_parts('Alice', 'x' * 100000))
+                a.flush()
+
+            # The link is dropped once it falls too far behind
+            assert link.sock is None
+            assert time.monotonic() - started < 5
+            peer.close()
+        finally:
+            a.stop()
+            stalled.close()
+
+    def test_unreachable_peer_does_not_block(self):
+
+        a = ClusterNode(lambda *record: None, host='127.0.0.1', port=0)
+        a.start()
+        try:
+            started = time.monotonic()
+            # Non-routable address: a blocking connect would hang here
+            a.add_peer(('10.255.255.1', 7000))
+            a.flush()
+            assert time.monotonic() - started < 0.1
+        finally:
+            a.stop()
+
+    def test_peer_reconnects_after_restart(self):
+
+        nodes = make_nodes(2)
+        a, b = nodes
+        port = b.port
+        try:
+            b.stop()
+            pump([a])
+            assert a.links[f'127.0.0.1:{port}'].sock is None
+
+            restarted = ClusterNode(lambda *record: restarted_delivered.append(record), host='127.0.0.1', port=port)
+            restarted_delivered = []
+            restarted.start()
+            restarted.add_peer(('127.0.0.1', a.port))
+            restarted.member_joined('lobby')
+            a.links[f'127.0.0.1:{port}'].next_attempt = 0.0
+            pump([a, restarted])
+
+            a.relay('lobby', *message_parts('Alice', 'welcome back'))
+            pump([a, restarted])
+
+            assert len(restarted_delivered) == 1
+            restarted.stop()
+        finally:
+            a.stop()
+
+
+def free_port():
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def read_frame(sock):
+
+    user_length = decode_header(sock.recv(HEADER_LENGTH))
+    username = sock.recv(user_length)
+    msg_length = decode_header(sock.recv(HEADER_LENGTH))
+    return decode_message(username), decode_message(sock.recv(msg_length))
+
+
+def read_chat_frame(sock):
+    # Skips the roster snapshot and presence diffs
+
+    while True:
+        frame = read_frame(sock)
+        if frame[0] != '@presence':
+            return frame
+
+
+def connect_client(port, username):
+
+    for _ in range(50):
+        try:
+            client = socket.create_connection(('127.0.0.1', port), timeout=5)
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.1)
+    header, data = encode_message(username)
+    client.sendall(header + data)
+    return client
+
+
+@pytest.mark.timeout(30)
+class TestClusterProcesses:
+
+    def test_broadcast_crosses_nodes(self):
+
+        chat_ports = [free_port(), free_port()]
+        cluster_ports = [free_port(), free_port()]
+        processes = []
+        try:
+            for i in range(2):
+                env = dict(
+                    os.environ,
+                    PYTHONPATH=str(PROJECT_ROOT),
+                    CHAT_SERVER_PORT=str(chat_ports[i]),
+                    CHAT_WS_PORT=str(free_port()),
+                    CHAT_CLUSTER_PORT=str(cluster_ports[i]),
+                    CHAT_CLUSTER_PEERS=f'127.0.0.1:{cluster_ports[1 - i]}'
+                )
+                processes.append(subprocess.Popen(
+                    [sys.executable, '-m', 'src.server'],
+                    env=env,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL
+                ))
+
+            alice = connect_client(chat_ports[0], 'Alice')
+            bob = connect_client(chat_ports[1], 'Bob')
+
+            # Peers redial every couple of seconds until both links are up
+            bob.settimeout(0.5)
+            received = None
+            for attempt in range(20):
+                header, data = encode_message(f'hello {attempt}')
+                alice.sendall(header + data)
+                try:
+                    received = read_chat_frame(bob)
+                    break
+                except socket.timeout:
+                    continue
+
+            assert received is not None
+            assert received[0] == 'Alice'
+            assert received[1].startswith('hello')
+
+            alice.close()
+            bob.close()
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
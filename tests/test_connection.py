@@ -0,0 +1,244 @@
+"""
+Unit tests for connection.py
+"""
+
+import os
+import socket
+from unittest.mock import Mock
+import pytest
+import src.connection
+from src.connection import Connection, intern_username, release_username
+from src.protocol import encode_message, split_frames
+from src.websocket import WEBSOCKET, OP_TEXT, OP_PING, OP_PONG, OP_CLOSE, mask_payload, parse_frame
+
+
+def masked_frame(payload: bytes, opcode: int = OP_TEXT, fin: bool = True) -> bytes:
+    mask = os.urandom(4)
+    first = (0x80 if fin else 0) | opcode
+    return bytes([first, 0x80 | len(payload)]) + mask + mask_payload(payload, mask)
+
+
+@pytest.fixture
+def pair():
+
+    server_side, client_side = socket.socketpair()
+    server_side.setblocking(False)
+    yield server_side, client_side
+    server_side.close()
+    client_side.close()
+
+
+class TestInterning:
+
+    def test_equal_usernames_share_one_object(self):
+
+        first = Connection(Mock(), b'5         ', bytes(bytearray(b'Alice')))
+        second = Connection(Mock(), b'5         ', bytes(bytearray(b'Alice')))
+
+        assert first.data is second.data
+        assert first.header is second.header
+
+        first.close()
+        second.close()
+
+    def test_released_when_unused(self):
+
+        value = bytes(bytearray(b'unique-name'))
+        assert intern_username(value) is value
+        assert intern_username(bytes(bytearray(b'unique-name'))) is value
+        release_username(value)
+        release_username(value)
+
+        other = bytes(bytearray(b'unique-name'))
+        assert intern_username(other) is other
+        release_username(other)
+
+    def test_header_derived_from_username(self):
+
+        connection = Connection(Mock(), b'ignored   ', '用户'.encode('utf-8'))
+
+        assert connection.header == encode_message('用户')[0]
+        connection.close()
+
+
+class TestConnectionState:
+
+    def test_slots(self):
+
+        connection = Connection(Mock(), b'5         ', b'Alice')
+
+        assert not hasattr(connection, '__dict__')
+        assert connection.data == b'Alice'
+        assert connection.room == 'lobby'
+        assert connection.transport is None
+        with pytest.raises(AttributeError):
+            connection.extra = True
+
+    def test_idle_connection_has_no_buffers(self):
+
+        connection = Connection(Mock(), b'5         ', b'Alice')
+
+        assert connection.recv_buffer is None
+        assert connection.send_buffer is None
+
+
+class TestReadMessages:
+
+    def test_several_messages_in_one_read(self, pair):
+
+        server_side, client_side = pair
+        connection = Connection(server_side, b'5         ', b'Alice')
+        client_side.sendall(b''.join(encode_message('one')) + b''.join(encode_message('two')))
+
+        messages = connection.read_messages()
+
+        assert [message['data'] for message in messages] == [b'one', b'two']
+        assert connection.recv_buffer is None
+
+    def test_partial_frame_buffered_then_released(self, pair):
+
+        server_side, client_side = pair
+        connection = Connection(server_side, b'5         ', b'Alice')
+        frame = b''.join(encode_message('Hello 世界'))
+
+        client_side.sendall(frame[:7])
+        assert connection.read_messages() == []
+        assert bytes(connection.recv_buffer) == frame[:7]
+
+        client_side.sendall(frame[7:])
+        messages = connection.read_messages()
+        assert messages[0]['data'] == 'Hello 世界'.encode('utf-8')
+        assert connection.recv_buffer is None
+
+    def test_nothing_to_read(self, pair):
+
+        server_side, _ = pair
+        connection = Connection(server_side, b'5         ', b'Alice')
+
+        assert connection.read_messages() == []
+
+    def test_peer_closed(self, pair):
+
+        server_side, client_side = pair
+        connection = Connection(server_side, b'5         ', b'Alice')
+        client_side.close()
+
+        assert connection.read_messages() is False
+
+    def test_websocket_messages(self, pair):
+
+        server_side, client_side = pair
+        connection = Connection(server_side, b'5         ', b'Alice', transport=WEBSOCKET)
+        client_side.sendall(
+            masked_frame(b'Hel', fin=False)
+            + masked_frame(b'probe', OP_PING)
+            + masked_frame(b'lo', 0x0)
+        )
+
+        messages = connection.read_messages()
+
+        assert messages == [{'header': b'5         ', 'data': b'Hello'}]
+        assert parse_frame(client_side.recv(1024))[1:3] == (OP_PONG, b'probe')
+
+    def test_websocket_close(self, pair):
+
+        server_side, client_side = pair
+        connection = Connection(server_side, b'5         ', b'Alice', transport=WEBSOCKET)
+        client_side.sendall(masked_frame(b'\x03\xe8', OP_CLOSE))
+
+        assert connection.read_messages() is False
+
+
+class TestSendBuffer:
+
+    def test_unsent_data_buffered_until_writable(self):
+
+        sock = Mock()
+        sock.send.side_effect = [3, 2, 2, 3]
+        backlog = set()
+        connection = Connection(sock, b'5         ', b'Alice', backlog=backlog)
+
+        connection.send(b'hello')
+        assert bytes(connection.send_buffer) == b'lo'
+        assert connection in backlog
+
+        connection.send(b'world')
+        assert bytes(connection.send_buffer) == b'lo'
+        assert connection.queue.queued_bytes == 5
+        assert sock.send.call_count == 1
+
+        assert connection.flush() is False
+        assert bytes(connection.send_buffer) == b'rld'
+        assert connection.queue is None
+        assert connection.flush() is True
+        assert connection.send_buffer is None
+        assert connection not in backlog
+
+    def test_would_block_buffers_everything(self):
+
+        sock = Mock()
+        sock.send.side_effect = BlockingIOError
+        connection = Connection(sock, b'5         ', b'Alice')
+
+        connection.send(b'hello')
+
+        assert bytes(connection.send_buffer) == b'hello'
+
+    def test_slow_reader_disconnected(self, monkeypatch):
+
+        monkeypatch.setattr(src.connection, 'MAX_QUEUED_BYTES', 1000)
+        sock = Mock()
+        sock.send.side_effect = BlockingIOError
+        backlog = set()
+        connection = Connection(sock, b'5         ', b'Alice', backlog=backlog)
+
+        for _ in range(10):
+            connection.send(b'x' * 100)
+        assert connection.dropped is False
+        connection.send(b'x' * 100)
+
+        assert connection.dropped is True
+        assert connection.queue is None
+        assert connection.send_buffer is None
+        assert connection not in backlog
+        sock.shutdown.assert_called_once_with(socket.SHUT_RDWR)
+
+        connection.send(b'more')
+        assert connection.queue is None
+
+    def test_dropped_client_reads_as_closed(self, pair, monkeypatch):
+
+        monkeypatch.setattr(src.connection, 'MAX_QUEUED_BYTES', 1024 * 1024)
+        server_side, client_side = pair
+        connection = Connection(server_side, b'5         ', b'Alice')
+
+        # The client never reads
+        while not connection.dropped:
+            connection.send(b'x' * 65536)
+
+        assert connection.read_messages() is False
+
+    def test_close_releases_buffers(self):
+
+        sock = Mock()
+        sock.send.return_value = 0
+        backlog = set()
+        connection = Connection(sock, b'5         ', b'Alice', backlog=backlog)
+        connection.send(b'hello')
+
+        connection.close()
+
+        assert connection.send_buffer is None
+        assert connection not in backlog
+
+
+class TestSplitFrames:
+
+    def test_incomplete_tail_not_consumed(self):
+
+        data = b''.join(encode_message('abc')) + b'5    '
+
+        frames, consumed = split_frames(data)
+
+        assert frames == [(b'3         ', b'abc')]
+        assert consumed == 13
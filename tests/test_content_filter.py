@@ -0,0 +1,131 @@
+"""
+Unit tests for content_filter.py
+"""
+
+import os
+from unittest.mock import Mock
+from src.content_filter import (
+    AhoCorasick,
+    PatternFilter,
+    FilterPipeline,
+    FilterReloader,
+    load_patterns
+)
+from src.server import handle_client_message
+from src.connection import Connection
+from src.protocol import encode_message
+
+
+class TestAhoCorasick:
+
+    def test_finds_pattern(self):
+
+        matcher = AhoCorasick(['spam', 'scam'])
+
+        assert matcher.search(b'this is a scam!') == b'scam'
+        assert matcher.search(b'all good here') is None
+
+    def test_case_insensitive(self):
+
+        matcher = AhoCorasick(['badword'])
+
+        assert matcher.search(b'A BadWord appears') == b'badword'
+
+    def test_overlapping_patterns_use_failure_links(self):
+
+        matcher = AhoCorasick(['he', 'she', 'hers'])
+
+        assert matcher.search(b'ushers') == b'she'
+        assert AhoCorasick(['abcd', 'bc']).search(b'xabcx') == b'bc'
+
+    def test_url_patterns(self):
+
+        matcher = AhoCorasick(['evil.example/path'])
+
+        assert matcher.search(b'visit http://evil.example/path now') == b'evil.example/path'
+        assert matcher.search(b'visit http://evil.example/other') is None
+
+    def test_unicode_patterns(self):
+
+        matcher = AhoCorasick(['禁止'])
+
+        assert matcher.search('这是禁止的'.encode('utf-8')) == '禁止'.encode('utf-8')
+
+    def test_empty_and_duplicate_patterns(self):
+
+        matcher = AhoCorasick(['', 'dup', 'dup'])
+
+        assert len(matcher) == 1
+        assert AhoCorasick([]).search(b'anything') is None
+
+
+class TestFilterPipeline:
+
+    def test_first_rejecting_stage_wins(self):
+
+        pipeline = FilterPipeline([PatternFilter(['spam'])])
+        pipeline.add_stage(lambda username, data: 'too long' if len(data) > 10 else None)
+
+        assert pipeline.check(b'Alice', b'spam') == 'blocked term "spam"'
+        assert pipeline.check(b'Alice', b'a long message') == 'too long'
+        assert pipeline.check(b'Alice', b'ok') is None
+
+    def test_blocked_message_not_broadcast(self):
+
+        sender = Mock()
+        receiver = Mock()
+        sender.send.side_effect = len
+        receiver.send.side_effect = len
+        client_dict = {
+            sender: Connection(sender, b'5         ', b'Alice'),
+            receiver: Connection(receiver, b'3         ', b'Bob')
+        }
+        pipeline = FilterPipeline([PatternFilter(['spam'])])
+
+        sender.recv.return_value = b''.join(encode_message('buy spam now'))
+        handle_client_message(sender, [sender, receiver], client_dict, message_filter=pipeline)
+
+        receiver.send.assert_not_called()
+        assert b'Message not delivered' in sender.send.call_args[0][0]
+
+        sender.recv.return_value = b''.join(encode_message('hello'))
+        handle_client_message(sender, [sender, receiver], client_dict, message_filter=pipeline)
+
+        receiver.send.assert_called_once()
+
+
+class TestFilterReloader:
+
+    def test_load_patterns_skips_comments(self, tmp_path):
+
+        path = tmp_path / 'patterns.txt'
+        path.write_bytes(b'# comment\nspam\n\n  scam  \n')
+
+        assert load_patterns(str(path)) == [b'spam', b'scam']
+
+    def test_reload_on_change(self, tmp_path):
+
+        path = tmp_path / 'patterns.txt'
+        path.write_bytes(b'spam\n')
+        pattern_filter = PatternFilter()
+        reloader = FilterReloader(pattern_filter, str(path))
+
+        assert reloader.check_for_changes() is True
+        assert reloader.check_for_changes() is False
+        assert pattern_filter(b'Alice', b'spam') is not None
+
+        path.write_bytes(b'scam\n')
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+
+        assert reloader.check_for_changes() is True
+        assert pattern_filter(b'Alice', b'spam') is None
+        assert pattern_filter(b'Alice', b'scam') is not None
+
+    def test_missing_file_keeps_current_patterns(self, tmp_path):
+
+        pattern_filter = PatternFilter(['spam'])
+        reloader = FilterReloader(pattern_filter, str(tmp_path / 'missing.txt'))
+
+        assert reloader.check_for_changes() is False
+        assert pattern_filter(b'Alice', b'spam') is not None
@@ -7,7 +7,16 @@ import socket
 import threading
 import time
 from src.protocol import encode_message, decode_header, decode_message, HEADER_LENGTH
-from src.server import initialize_server, handle_new_connection, handle_client_message
+from src.server import (
+    initialize_server,
+    initialize_unix_server,
+    handle_new_connection,
+    handle_client_message,
+    dispatch_message,
+    format_address
+)
+from unittest.mock import Mock
+from src.client import connect_to_server
 from src.message_handler import receive_message, send_message
 
 
@@ -268,3 +277,119 @@ class TestConnectionTimeout:
                 client.connect(('127.0.0.1', 9999))
         finally:
             client.close()
+
+
+class TestUnixSocketIntegration:
+
+    @pytest.fixture
+    def unix_server(self, tmp_path):
+
+        path = str(tmp_path / 'chat.sock')
+        server_socket = initialize_unix_server(path)
+        yield server_socket, path
+        server_socket.close()
+
+    def test_stale_socket_file_replaced(self, unix_server):
+
+        server_socket, path = unix_server
+        server_socket.close()
+
+        replacement = initialize_unix_server(path)
+        replacement.close()
+
+    def test_unix_client_shares_broadcast_path(self, unix_server):
+
+        server_socket, path = unix_server
+        tcp_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tcp_server.bind(('127.0.0.1', 0))
+        tcp_server.listen()
+        socket_list = [server_socket, tcp_server]
+        client_dict = {}
+
+        bot = connect_to_server('Bot', path)
+        handle_new_connection(server_socket, socket_list, client_dict)
+        human = socket.create_connection(tcp_server.getsockname())
+        human.sendall(b''.join(encode_message('Human')))
+        handle_new_connection(tcp_server, socket_list, client_dict)
+
+        try:
+            bot.setblocking(True)
+            bot.sendall(b''.join(encode_message('beep from the sidecar')))
+            bot_socket = next(sock for sock, info in client_dict.items() if info.data == b'Bot')
+            handle_client_message(bot_socket, socket_list, client_dict)
+
+            human.settimeout(2)
+            user_length = decode_header(human.recv(HEADER_LENGTH))
+            assert decode_message(human.recv(user_length)) == 'Bot'
+            msg_length = decode_header(human.recv(HEADER_LENGTH))
+            assert decode_message(human.recv(msg_length)) == 'beep from the sidecar'
+        finally:
+            bot.close()
+            human.close()
+            for client_socket in client_dict:
+                client_socket.close()
+            tcp_server.close()
+
+    def test_admin_commands_only_on_unix_socket(self, unix_server, monkeypatch):
+
+        monkeypatch.setattr('src.server.ADMIN_USERS', {'Ops'})
+        server_socket, path = unix_server
+        tcp_server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        tcp_server.bind(('127.0.0.1', 0))
+        tcp_server.listen()
+        socket_list = [server_socket, tcp_server]
+        client_dict = {}
+        offload = Mock()
+        offload.stats.return_value = {'depth': 0, 'completed': 0, 'p50_ms': 0.0, 'p99_ms': 0.0, 'max_ms': 0.0}
+
+        local = connect_to_server('Ops', path)
+        handle_new_connection(server_socket, socket_list, client_dict)
+        remote = socket.create_connection(tcp_server.getsockname())
+        remote.sendall(b''.join(encode_message('Ops')))
+        handle_new_connection(tcp_server, socket_list, client_dict)
+
+        try:
+            stats = {'header': encode_message('/stats')[0], 'data': b'/stats'}
+            for client_socket in list(client_dict):
+                dispatch_message(client_socket, client_dict, stats, offload=offload)
+
+            # Only the Unix socket client is answered; the TCP one claiming
+            # the same name is treated as an ordinary chatter
+            assert offload.stats.call_count == 1
+            local.setblocking(True)
+            local.settimeout(2)
+            user_length = decode_header(local.recv(HEADER_LENGTH))
+            assert decode_message(local.recv(user_length)) == '@admin'
+        finally:
+            local.close()
+            remote.close()
+            for client_socket in client_dict:
+                client_socket.close()
+            tcp_server.close()
+
+    def test_reserved_username_refused(self, unix_server):
+
+        server_socket, path = unix_server
+        socket_list = [server_socket]
+        client_dict = {}
+
+        spoof = connect_to_server('@presence', path)
+        handle_new_connection(server_socket, socket_list, client_dict)
+        try:
+            assert client_dict == {}
+            assert socket_list == [server_socket]
+
+            spoof.setblocking(True)
+            spoof.settimeout(2)
+            user_length = decode_header(spoof.recv(HEADER_LENGTH))
+            assert decode_message(spoof.recv(user_length)) == '@server'
+            msg_length = decode_header(spoof.recv(HEADER_LENGTH))
+            assert 'reserved' in decode_message(spoof.recv(msg_length))
+            assert spoof.recv(1) == b''
+        finally:
+            spoof.close()
+
+    def test_format_address(self):
+
+        assert format_address(('127.0.0.1', 5000)) == '127.0.0.1:5000'
+        assert format_address('') == 'unix socket'
@@ -11,6 +11,17 @@ from src.message_handler import (
     broadcast_message
 )
 from src.protocol import encode_message
+from src.connection import Connection
+
+
+def connection(sock, header: bytes, data: bytes, room: str = None) -> Connection:
+    # Mock sockets accept every byte, like an idle TCP socket
+
+    sock.send.side_effect = len
+    conn = Connection(sock, header, data)
+    if room is not None:
+        conn.room = room
+    return conn
 
 
 class TestReceiveMessage:
@@ -112,10 +123,10 @@ class TestBroadcastMessage:
         client3 = Mock()
         
         client_dict = {
-            sender: {'header': b'6         ', 'data': b'Sender'},
-            client1: {'header': b'7         ', 'data': b'Client1'},
-            client2: {'header': b'7         ', 'data': b'Client2'},
-            client3: {'header': b'7         ', 'data': b'Client3'}
+            sender: connection(sender, b'6         ', b'Sender'),
+            client1: connection(client1, b'7         ', b'Client1'),
+            client2: connection(client2, b'7         ', b'Client2'),
+            client3: connection(client3, b'7         ', b'Client3')
         }
         
         user_header = b'6         '
@@ -144,7 +155,7 @@ class TestBroadcastMessage:
     def test_broadcast_with_single_client(self):
 
         sender = Mock()
-        client_dict = {sender: {'header': b'6         ', 'data': b'Sender'}}
+        client_dict = {sender: connection(sender, b'6         ', b'Sender')}
         
         broadcast_message(
             sender,
@@ -164,8 +175,8 @@ class TestBroadcastMessage:
         receiver = Mock()
         
         client_dict = {
-            sender: {'header': b'6         ', 'data': b'Sender'},
-            receiver: {'header': b'8         ', 'data': b'Receiver'}
+            sender: connection(sender, b'6         ', b'Sender'),
+            receiver: connection(receiver, b'8         ', b'Receiver')
         }
         
         broadcast_message(
@@ -187,8 +198,8 @@ class TestBroadcastMessage:
         client1 = Mock()
         
         client_dict = {
-            sender: {'header': b'5         ', 'data': 'Alice'.encode('utf-8')},
-            client1: {'header': b'3         ', 'data': 'Bob'.encode('utf-8')}
+            sender: connection(sender, b'5         ', 'Alice'.encode('utf-8')),
+            client1: connection(client1, b'3         ', 'Bob'.encode('utf-8'))
         }
         
         msg = "Hello 世界"
@@ -208,6 +219,32 @@ class TestBroadcastMessage:
         client1.send.assert_called_once()
 
 
+    def test_broadcast_scoped_to_room(self):
+
+        sender = Mock()
+        lobby_client = Mock()
+        ops_client = Mock()
+
+        client_dict = {
+            sender: connection(sender, b'6         ', b'Sender', 'ops'),
+            lobby_client: connection(lobby_client, b'5         ', b'Lobby'),
+            ops_client: connection(ops_client, b'3         ', b'Ops', 'ops')
+        }
+
+        broadcast_message(
+            sender,
+            client_dict,
+            b'6         ',
+            b'Sender',
+            b'5         ',
+            b'Hello',
+            'ops'
+        )
+
+        ops_client.send.assert_called_once()
+        lobby_client.send.assert_not_called()
+
+
 class TestMessageHandlerIntegration:
 
     
@@ -0,0 +1,182 @@
+"""
+Unit tests for offload.py
+"""
+
+import select
+import threading
+from unittest.mock import Mock
+from src.offload import OffloadStage
+from src.content_filter import FilterPipeline, PatternFilter
+from src.server import handle_client_message, dispatch_message
+from src.presence import PresenceTracker
+from src.connection import Connection
+from src.protocol import encode_message
+
+
+def wait_completed(stage, count: int) -> list:
+    # Collects count results, waiting on the wakeup fd like the server loop
+
+    results = []
+    while len(results) < count:
+        readable, _, _ = select.select([stage.wakeup_fd], [], [], 5)
+        assert readable, 'offload stage never woke the loop'
+        results.extend(stage.completed())
+    return results
+
+
+class TestOffloadStage:
+
+    def test_results_return_through_wakeup_fd(self):
+
+        stage = OffloadStage(lambda data: data.upper(), workers=2)
+        try:
+            stage.submit('alice', (b'hello',), 'context')
+            assert wait_completed(stage, 1) == [('alice', 'context', b'HELLO', None)]
+        finally:
+            stage.close()
+
+    def test_per_key_order_kept_when_later_task_finishes_first(self):
+
+        release = threading.Event()
+
+        def handler(data):
+            if data == b'slow':
+                release.wait(5)
+            return data
+
+        stage = OffloadStage(handler, workers=2)
+        try:
+            stage.submit('alice', (b'slow',))
+            stage.submit('alice', (b'fast',))
+            stage.submit('bob', (b'other',))
+
+            # Bob is not held back by Alice's slow message
+            assert [result for _, _, result, _ in wait_completed(stage, 1)] == [b'other']
+            assert stage.stats()['depth'] == 2
+
+            release.set()
+            assert [result for _, _, result, _ in wait_completed(stage, 2)] == [b'slow', b'fast']
+            assert stage.stats()['depth'] == 0
+        finally:
+            stage.close()
+
+    def test_handler_errors_are_returned(self):
+
+        def handler(data):
+            raise ValueError('bad frame')
+
+        stage = OffloadStage(handler, workers=1)
+        try:
+            stage.submit('alice', (b'x',))
+            [(_, _, result, error)] = wait_completed(stage, 1)
+            assert result is None
+            assert isinstance(error, ValueError)
+        finally:
+            stage.close()
+
+    def test_submit_waits_when_full(self):
+
+        stage = OffloadStage(lambda data: data, workers=1, max_pending=2)
+        try:
+            for i in range(5):
+                stage.submit('alice', (i,))
+                assert len(stage.in_flight) <= 2
+            results = wait_completed(stage, 5)
+            assert stage.stats()['completed'] == 5
+            assert [result for _, _, result, _ in results] == [0, 1, 2, 3, 4]
+        finally:
+            stage.close()
+
+    def test_stats_report_latency(self):
+
+        stage = OffloadStage(lambda data: data, workers=1)
+        try:
+            for i in range(10):
+                stage.submit('alice', (i,))
+            wait_completed(stage, 10)
+            stats = stage.stats()
+            assert stats['completed'] == 10
+            assert 0 <= stats['p50_ms'] <= stats['p99_ms'] <= stats['max_ms']
+        finally:
+            stage.close()
+
+
+class TestOffloadedFilter:
+
+    def test_message_delivered_after_verdict(self):
+
+        sender = Mock()
+        receiver = Mock()
+        sender.send.side_effect = len
+        receiver.send.side_effect = len
+        client_dict = {
+            sender: Connection(sender, b'5         ', b'Alice'),
+            receiver: Connection(receiver, b'3         ', b'Bob')
+        }
+        pipeline = FilterPipeline([PatternFilter(['spam'])])
+        stage = OffloadStage(pipeline.check, workers=2)
+        try:
+            sender.recv.return_value = b''.join(encode_message('buy spam now'))
+            handle_client_message(sender, [sender, receiver], client_dict, message_filter=pipeline, offload=stage)
+            sender.recv.return_value = b''.join(encode_message('hello'))
+            handle_client_message(sender, [sender, receiver], client_dict, message_filter=pipeline, offload=stage)
+
+            # Nothing is delivered until the loop collects the verdicts
+            receiver.send.assert_not_called()
+
+            for client_socket, message, reason, _ in wait_completed(stage, 2):
+                dispatch_message(client_socket, client_dict, message, reason)
+
+            assert b'Message not delivered' in sender.send.call_args[0][0]
+            receiver.send.assert_called_once()
+            assert b'hello' in receiver.send.call_args[0][0]
+        finally:
+            stage.close()
+
+    def test_verdict_for_departed_sender_is_dropped(self):
+
+        receiver = Mock()
+        client_dict = {receiver: Connection(receiver, b'3         ', b'Bob')}
+        header, data = encode_message('hello')
+
+        dispatch_message(Mock(), client_dict, {'header': header, 'data': data})
+
+        receiver.send.assert_not_called()
+
+    def test_commands_keep_order_behind_pending_messages(self):
+
+        sender = Mock()
+        sender.send.side_effect = len
+        client_dict = {sender: Connection(sender, b'5         ', b'Alice')}
+        presence = PresenceTracker(interval=0)
+        presence.joined('lobby', 'Alice')
+        presence.flush()
+        release = threading.Event()
+
+        def check(username, data):
+            if data == b'slow message':
+                release.wait(5)
+            return None
+
+        stage = OffloadStage(check, workers=2)
+        try:
+            for text in ('slow message', '/typing'):
+                sender.recv.return_value = b''.join(encode_message(text))
+                handle_client_message(
+                    sender, [sender], client_dict, message_filter=FilterPipeline([check]), presence=presence,
+                    offload=stage
+                )
+
+            # /typing finishes first but waits behind the slow message
+            readable, _, _ = select.select([stage.wakeup_fd], [], [], 5)
+            assert readable
+            assert list(stage.completed()) == []
+
+            release.set()
+            for client_socket, message, reason, _ in wait_completed(stage, 2):
+                dispatch_message(client_socket, client_dict, message, reason, presence=presence)
+
+            # The chat message cleared typing before /typing set it again
+            assert 'Alice' in presence.rooms['lobby'].typing
+        finally:
+            stage.close()
@@ -0,0 +1,202 @@
+"""
+Unit tests for presence.py
+"""
+
+import json
+from unittest.mock import Mock
+from src.presence import PresenceTracker, TYPING_TTL
+from src.server import handle_client_message, remove_client, announce_presence
+from src.connection import Connection
+from src.message_handler import broadcast_notice
+from src.protocol import encode_message, split_frames
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def flushed_raw(tracker, clock, delay: float = 1.0) -> list:
+
+    clock.now += delay
+    return tracker.flush()
+
+
+def flushed(tracker, clock, delay: float = 1.0) -> dict:
+
+    return {room: json.loads(diff) for room, diff in flushed_raw(tracker, clock, delay)}
+
+
+def notices(sock) -> list:
+
+    data = b''.join(call[0][0] for call in sock.send.call_args_list)
+    frames, _ = split_frames(data)
+    return [(frames[i][1], frames[i + 1][1]) for i in range(0, len(frames), 2)]
+
+
+class TestPresenceTracker:
+
+    def test_snapshot_then_diff(self):
+
+        clock = FakeClock()
+        tracker = PresenceTracker(interval=0.25, clock=clock)
+
+        tracker.joined('lobby', 'Alice')
+        assert flushed(tracker, clock)['lobby']['joined'] == ['Alice']
+
+        snapshot = json.loads(tracker.joined('lobby', 'Bob'))
+        assert snapshot == {'room': 'lobby', 'version': 1, 'members': ['Alice'], 'typing': []}
+
+        diff = flushed(tracker, clock)['lobby']
+        assert diff['version'] == 2
+        assert diff['joined'] == ['Bob']
+
+    def test_snapshot_excludes_unpublished_members(self):
+        # Someone who joins and leaves between two flushes must not stay
+        # in a newcomer's roster for ever
+
+        clock = FakeClock()
+        tracker = PresenceTracker(interval=0.25, clock=clock)
+
+        tracker.joined('lobby', 'Alice')
+        flushed(tracker, clock)
+        tracker.joined('lobby', 'Carol')
+        tracker.typing('lobby', 'Carol')
+        snapshot = json.loads(tracker.joined('lobby', 'Bob'))
+        tracker.left('lobby', 'Carol')
+
+        roster = set(snapshot['members'])
+        diff = flushed(tracker, clock)['lobby']
+        roster |= set(diff['joined'])
+        roster -= set(diff['left'])
+        assert snapshot['typing'] == []
+        assert diff['version'] == snapshot['version'] + 1
+        assert roster == {'Alice', 'Bob'}
+
+    def test_debounce_coalesces_changes(self):
+
+        clock = FakeClock()
+        tracker = PresenceTracker(interval=0.25, clock=clock)
+
+        for i in range(100):
+            tracker.joined('lobby', f'user{i}')
+        clock.now += 0.1
+        assert tracker.flush() == []
+        assert 0 < tracker.timeout() <= 0.15
+
+        diffs = flushed(tracker, clock)
+        assert len(diffs['lobby']['joined']) == 100
+        assert tracker.timeout() is None
+
+    def test_join_and_leave_in_one_window_cancel_out(self):
+
+        clock = FakeClock()
+        tracker = PresenceTracker(clock=clock)
+        tracker.joined('lobby', 'Alice')
+        flushed(tracker, clock)
+
+        tracker.joined('lobby', 'Bob')
+        tracker.left('lobby', 'Bob')
+
+        assert flushed(tracker, clock) == {}
+
+    def test_same_name_connected_twice(self):
+
+        clock = FakeClock()
+        tracker = PresenceTracker(clock=clock)
+        tracker.joined('lobby', 'Alice')
+        tracker.joined('lobby', 'Alice')
+        flushed(tracker, clock)
+
+        tracker.left('lobby', 'Alice')
+        assert flushed(tracker, clock) == {}
+
+        tracker.left('lobby', 'Alice')
+        assert flushed(tracker, clock)['lobby']['left'] == ['Alice']
+        assert 'lobby' not in tracker.rooms
+
+    def test_typing_expires(self):
+
+        clock = FakeClock()
+        tracker = PresenceTracker(clock=clock)
+        tracker.joined('lobby', 'Alice')
+        flushed(tracker, clock)
+
+        tracker.typing('lobby', 'Alice')
+        assert flushed(tracker, clock)['lobby']['typing'] == ['Alice']
+
+        assert tracker.timeout() == TYPING_TTL - 1.0
+        # Expiry is itself a change, published after the debounce
+        assert flushed(tracker, clock, TYPING_TTL) == {}
+        assert flushed(tracker, clock)['lobby']['idle'] == ['Alice']
+
+    def test_rooms_are_separate(self):
+
+        clock = FakeClock()
+        tracker = PresenceTracker(clock=clock)
+        tracker.joined('lobby', 'Alice')
+        tracker.joined('dev', 'Bob')
+
+        diffs = flushed(tracker, clock)
+
+        assert diffs['lobby']['joined'] == ['Alice']
+        assert diffs['dev']['joined'] == ['Bob']
+
+
+class TestServerPresence:
+
+    def test_join_typing_and_leave(self):
+
+        alice = Mock()
+        bob = Mock()
+        alice.send.side_effect = len
+        bob.send.side_effect = len
+        clock = FakeClock()
+        presence = PresenceTracker(clock=clock)
+        client_dict = {
+            alice: Connection(alice, b'5         ', b'Alice'),
+            bob: Connection(bob, b'3         ', b'Bob')
+        }
+        socket_list = [alice, bob]
+
+        announce_presence(alice, client_dict[alice], presence, 'Alice')
+        announce_presence(bob, client_dict[bob], presence, 'Bob')
+        # Neither join is published yet; both arrive with the next diff
+        assert json.loads(notices(bob)[0][1])['members'] == []
+
+        alice.recv.return_value = b''.join(encode_message('/typing'))
+        handle_client_message(alice, socket_list, client_dict, presence=presence)
+        bob.send.assert_called_once()
+
+        for room, diff in flushed_raw(presence, clock):
+            broadcast_notice(client_dict, room, '@presence', diff)
+        update = json.loads(notices(bob)[-1][1])
+        assert update['joined'] == ['Alice', 'Bob']
+        assert update['typing'] == ['Alice']
+
+        remove_client(alice, socket_list, client_dict, presence=presence)
+        for room, diff in flushed_raw(presence, clock):
+            broadcast_notice(client_dict, room, '@presence', diff)
+        update = json.loads(notices(bob)[-1][1])
+        assert update['left'] == ['Alice']
+        assert update['idle'] == ['Alice']
+
+    def test_room_change_sends_new_snapshot(self):
+
+        alice = Mock()
+        alice.send.side_effect = len
+        presence = PresenceTracker()
+        client_dict = {alice: Connection(alice, b'5         ', b'Alice')}
+        announce_presence(alice, client_dict[alice], presence, 'Alice')
+
+        alice.recv.return_value = b''.join(encode_message('/join dev'))
+        handle_client_message(alice, [alice], client_dict, presence=presence)
+
+        username, snapshot = notices(alice)[-1]
+        assert username == b'@presence'
+        assert json.loads(snapshot)['room'] == 'dev'
+        assert 'Alice' not in presence.rooms['lobby'].members
@@ -0,0 +1,117 @@
+"""
+Unit tests for profiler.py
+"""
+
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+import pytest
+from src.profiler import (
+    SamplingProfiler,
+    collapse_stack,
+    write_collapsed,
+    install_signal_handler,
+    OVERFLOW_STACK
+)
+
+
+def busy_wait(seconds):
+
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        pass
+
+
+class TestCollapseStack:
+
+    def test_root_first(self):
+
+        def inner():
+            return collapse_stack(sys._getframe())
+
+        stack = inner().split(';')
+
+        assert stack[-1].startswith('inner (test_profiler.py:')
+        assert stack[-2].startswith('test_root_first (test_profiler.py:')
+
+    def test_depth_limited(self):
+
+        assert len(collapse_stack(sys._getframe(), max_depth=2).split(';')) == 2
+
+    def test_write_collapsed_format(self, tmp_path):
+
+        path = tmp_path / 'out.folded'
+        write_collapsed(str(path), Counter({'a;b': 3, 'a;c': 1}))
+
+        assert path.read_text().splitlines() == ['a;b 3', 'a;c 1']
+
+
+class TestSamplingProfiler:
+
+    def test_idle_profiler_has_no_thread(self):
+
+        threads_before = threading.active_count()
+        profiler = SamplingProfiler()
+
+        assert profiler.running is False
+        assert profiler.stop() is None
+        assert threading.active_count() == threads_before
+
+    def test_samples_target_thread(self, tmp_path):
+
+        profiler = SamplingProfiler(interval=0.001, output_dir=str(tmp_path))
+        profiler.start(threading.get_ident())
+        busy_wait(0.2)
+        path = profiler.stop(wait=True)
+
+        assert profiler.samples > 0
+        assert any('busy_wait' in stack for stack in profiler.counts)
+        assert os.path.exists(path)
+        lines = open(path, encoding='utf-8').read().splitlines()
+        assert sum(int(line.rsplit(' ', 1)[1]) for line in lines) == profiler.samples
+        assert 0.0 < profiler.overhead() < 1.0
+
+    def test_distinct_stacks_bounded(self, tmp_path):
+
+        profiler = SamplingProfiler(interval=0.001, output_dir=str(tmp_path), max_stacks=1)
+        profiler.start(threading.get_ident())
+        for i in range(20):
+            exec(compile('busy_wait(0.005)', f'<generated {i}>', 'exec'))
+        profiler.stop(wait=True)
+
+        assert len(profiler.counts) <= 2
+        assert OVERFLOW_STACK in profiler.counts
+
+    def test_toggle(self, tmp_path):
+
+        profiler = SamplingProfiler(output_dir=str(tmp_path))
+
+        assert profiler.toggle() is None
+        assert profiler.running is True
+        path = profiler.toggle()
+        assert profiler.running is False
+        assert path.endswith('.folded')
+
+
+@pytest.mark.skipif(not hasattr(signal, 'SIGUSR1'), reason='SIGUSR1 not available')
+class TestSignalToggle:
+
+    def test_sigusr1_toggles(self, tmp_path):
+
+        profiler = SamplingProfiler(output_dir=str(tmp_path))
+        previous = signal.getsignal(signal.SIGUSR1)
+        try:
+            assert install_signal_handler(profiler) is True
+
+            os.kill(os.getpid(), signal.SIGUSR1)
+            time.sleep(0.05)
+            assert profiler.running is True
+
+            os.kill(os.getpid(), signal.SIGUSR1)
+            time.sleep(0.05)
+            assert profiler.running is False
+        finally:
+            signal.signal(signal.SIGUSR1, previous)
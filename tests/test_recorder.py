@@ -0,0 +1,102 @@
+"""
+Unit tests for recorder.py
+"""
+
+from unittest.mock import Mock
+import pytest
+from src.recorder import (
+    TrafficRecorder,
+    CAPTURE_MAGIC,
+    CONNECT,
+    MESSAGE,
+    DISCONNECT,
+    encode_record,
+    read_capture
+)
+from src.server import handle_client_message
+from src.connection import Connection
+from src.protocol import encode_message
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestCaptureFormat:
+
+    def test_roundtrip(self, tmp_path):
+
+        path = tmp_path / 'capture.bin'
+        clock = FakeClock()
+        recorder = TrafficRecorder(str(path), clock)
+        alice = Mock()
+        recorder.start()
+
+        recorder.record_connect(alice, b'Alice')
+        clock.now += 0.5
+        recorder.record_message(alice, '你好'.encode('utf-8'))
+        clock.now += 0.25
+        recorder.record_disconnect(alice)
+        recorder.stop()
+
+        assert list(read_capture(str(path))) == [
+            (0.0, 1, CONNECT, b'Alice'),
+            (0.5, 1, MESSAGE, '你好'.encode('utf-8')),
+            (0.75, 1, DISCONNECT, b'')
+        ]
+
+    def test_connection_ids_are_unique(self, tmp_path):
+
+        path = tmp_path / 'capture.bin'
+        recorder = TrafficRecorder(str(path))
+        recorder.start()
+        first, second = Mock(), Mock()
+
+        recorder.record_connect(first, b'Alice')
+        recorder.record_connect(second, b'Alice')
+        recorder.record_message(Mock(), b'unknown connection')
+        recorder.stop()
+
+        assert [record[1] for record in read_capture(str(path))] == [1, 2]
+
+    def test_truncated_record_ignored(self, tmp_path):
+
+        path = tmp_path / 'capture.bin'
+        path.write_bytes(CAPTURE_MAGIC + encode_record(0, 1, CONNECT, b'Alice') + encode_record(5, 1, MESSAGE, b'hi')[:-1])
+
+        assert len(list(read_capture(str(path)))) == 1
+
+    def test_rejects_other_files(self, tmp_path):
+
+        path = tmp_path / 'capture.bin'
+        path.write_bytes(b'not a capture')
+
+        with pytest.raises(ValueError):
+            list(read_capture(str(path)))
+
+
+class TestServerRecording:
+
+    def test_inbound_messages_recorded(self, tmp_path):
+
+        path = tmp_path / 'capture.bin'
+        recorder = TrafficRecorder(str(path))
+        recorder.start()
+        sender = Mock()
+        sender.send.side_effect = len
+        client_dict = {sender: Connection(sender, b'5         ', b'Alice')}
+        recorder.record_connect(sender, b'Alice')
+
+        sender.recv.return_value = b''.join(encode_message('one')) + b''.join(encode_message('two'))
+        handle_client_message(sender, [sender], client_dict, recorder=recorder)
+        sender.recv.return_value = b''
+        handle_client_message(sender, [sender], client_dict, recorder=recorder)
+        recorder.stop()
+
+        kinds = [(kind, data) for _, _, kind, data in read_capture(str(path))]
+        assert kinds == [(CONNECT, b'Alice'), (MESSAGE, b'one'), (MESSAGE, b'two'), (DISCONNECT, b'')]
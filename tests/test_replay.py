@@ -0,0 +1,109 @@
+"""
+Unit tests for replay.py
+"""
+
+import os
+import subprocess
+import sys
+import time
+import socket
+from pathlib import Path
+import pytest
+from src.replay import Observer, parse_speed, replay, format_report
+from src.recorder import CAPTURE_MAGIC, CONNECT, MESSAGE, DISCONNECT, encode_record
+from src.protocol import encode_message
+
+PROJECT_ROOT = Path(__file__).resolve().parent.parent
+
+
+def free_port():
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def write_capture(path, records):
+
+    with open(path, 'wb') as capture:
+        capture.write(CAPTURE_MAGIC)
+        for record in records:
+            capture.write(encode_record(*record))
+
+
+class TestReplayHelpers:
+
+    def test_parse_speed(self):
+
+        assert parse_speed('1x') == 1.0
+        assert parse_speed('10x') == 10.0
+        assert parse_speed('2.5') == 2.5
+        assert parse_speed('max') == 0.0
+        with pytest.raises(ValueError):
+            parse_speed('0x')
+
+    def test_observer_matches_split_frames(self):
+
+        server_side, client_side = socket.socketpair()
+        try:
+            client_side.setblocking(False)
+            observer = Observer(client_side)
+            observer.sent(b'Alice', b'hello', 1.0)
+            frame = b''.join(encode_message('Alice')) + b''.join(encode_message('hello'))
+
+            server_side.sendall(frame[:17])
+            observer.receive(1.5)
+            assert observer.latencies == []
+
+            server_side.sendall(frame[17:])
+            observer.receive(1.5)
+            assert observer.latencies == [0.5]
+        finally:
+            server_side.close()
+            client_side.close()
+
+
+@pytest.mark.timeout(30)
+class TestReplayAgainstServer:
+
+    def test_replay_at_max_speed(self, tmp_path):
+
+        capture = tmp_path / 'capture.bin'
+        write_capture(capture, [
+            (0, 1, CONNECT, b'Alice'),
+            (1000, 2, CONNECT, b'Bob'),
+            (2000, 1, MESSAGE, b'hello'),
+            (3000, 2, MESSAGE, b'hi Alice'),
+            (4000, 1, MESSAGE, b'/join dev'),
+            (5000, 1, MESSAGE, b'only in dev'),
+            (6000, 2, DISCONNECT, b''),
+            (7000, 1, DISCONNECT, b'')
+        ])
+
+        port = free_port()
+        env = dict(
+            os.environ,
+            PYTHONPATH=str(PROJECT_ROOT),
+            CHAT_SERVER_PORT=str(port),
+            CHAT_WS_PORT=str(free_port())
+        )
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'src.server'], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            for _ in range(50):
+                try:
+                    socket.create_connection(('127.0.0.1', port)).close()
+                    break
+                except ConnectionRefusedError:
+                    time.sleep(0.1)
+
+            stats = replay(str(capture), ('127.0.0.1', port), speed=0.0)
+        finally:
+            server.terminate()
+            server.wait()
+
+        assert stats['messages'] == 4
+        # The observer stays in the lobby, so it sees the first two only
+        assert stats['observed'] == 2
+        assert 'latency' in format_report(stats)
@@ -0,0 +1,126 @@
+"""
+Unit tests for scheduler.py
+"""
+
+from unittest.mock import Mock
+from src.scheduler import CONTROL, CHAT, BULK, STARVATION_LIMIT, OutboundQueue, classify
+from src.connection import Connection
+from src.message_handler import send_notice
+
+
+def drain(queue: OutboundQueue, bulk_waiting: bool = False) -> list:
+
+    order = []
+    while True:
+        priority = queue.next_level(bulk_waiting)
+        if priority is None:
+            return order
+        order.append(queue.pop(priority))
+
+
+class TestClassify:
+
+    def test_by_sender(self):
+
+        assert classify('Alice') == CHAT
+        assert classify('@presence') == CONTROL
+        assert classify('@ack') == CONTROL
+        assert classify('@search') == BULK
+        assert classify('@file:12') == BULK
+        assert classify('@file') == CONTROL
+        assert classify('@room') == CHAT
+
+
+class TestOutboundQueue:
+
+    def test_strict_priority(self):
+
+        queue = OutboundQueue()
+        queue.push(b'bulk', BULK)
+        queue.push(b'chat', CHAT)
+        queue.push(b'control', CONTROL)
+
+        assert drain(queue) == [b'control', b'chat', b'bulk']
+        assert queue.queued_bytes == 0
+
+    def test_fifo_within_a_level(self):
+
+        queue = OutboundQueue()
+        for i in range(5):
+            queue.push(bytes([i]), CHAT)
+
+        assert drain(queue) == [bytes([i]) for i in range(5)]
+
+    def test_starvation_guard(self):
+
+        queue = OutboundQueue()
+        queue.push(b'bulk', BULK)
+        for _ in range(STARVATION_LIMIT * 2):
+            queue.push(b'chat', CHAT)
+
+        order = drain(queue)
+
+        assert order.index(b'bulk') == STARVATION_LIMIT
+
+    def test_stream_counts_as_bulk(self):
+
+        queue = OutboundQueue()
+
+        assert queue.next_level() is None
+        assert queue.next_level(bulk_waiting=True) == BULK
+        assert queue.pop(BULK) is None
+
+
+class TestConnectionScheduling:
+
+    def test_control_overtakes_queued_bulk(self):
+
+        sock = Mock()
+        sent = []
+        sock.send.side_effect = [0]
+        backlog = set()
+        connection = Connection(sock, b'5         ', b'Alice', backlog=backlog)
+
+        # The first frame finds the socket full, so everything after it queues
+        connection.send(b'first')
+        send_notice(sock, connection, '@search', 'result one')
+        send_notice(sock, connection, '@search', 'result two')
+        send_notice(sock, connection, '@presence', 'Bob joined')
+        connection.send(b'chat')
+
+        sock.send.side_effect = lambda data: sent.append(bytes(data)) or len(data)
+        assert connection.flush() is True
+
+        written = b''.join(sent)
+        assert written.startswith(b'first')
+        assert written.index(b'Bob joined') < written.index(b'chat') < written.index(b'result one')
+        assert written.index(b'result one') < written.index(b'result two')
+        assert connection not in backlog
+
+    def test_file_ack_overtakes_queued_bulk(self):
+
+        sock = Mock()
+        sent = []
+        sock.send.side_effect = [0]
+        connection = Connection(sock, b'5         ', b'Alice')
+
+        connection.send(b'first')
+        send_notice(sock, connection, '@search', 'many results')
+        send_notice(sock, connection, '@file', 'Ready for photo.png as 1')
+
+        sock.send.side_effect = lambda data: sent.append(bytes(data)) or len(data)
+        connection.flush()
+
+        written = b''.join(sent)
+        assert written.index(b'Ready for photo.png') < written.index(b'many results')
+
+    def test_idle_send_is_direct(self):
+
+        sock = Mock()
+        sock.send.side_effect = len
+        connection = Connection(sock, b'5         ', b'Alice')
+
+        connection.send(b'hello', BULK)
+
+        sock.send.assert_called_once_with(b'hello')
+        assert connection.queue is None
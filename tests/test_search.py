@@ -0,0 +1,246 @@
+"""
+Unit tests for search.py
+"""
+
+import array
+import select
+from unittest.mock import Mock
+from src.search import (
+    BLOCK_SIZE,
+    SearchIndex,
+    IndexWorker,
+    PostingList,
+    tokenize,
+    decode_postings
+)
+from src.server import handle_client_message, send_search_results
+from src.connection import Connection
+from src.protocol import encode_message, decode_header, HEADER_LENGTH
+
+
+class TestPostingList:
+
+    def test_roundtrip_large_gaps(self):
+
+        postings = PostingList()
+        seqs = [0, 1, 127, 128, 300, 70000, 5000000]
+        for seq in seqs:
+            postings.add(seq)
+
+        assert list(postings.seqs()) == seqs
+        assert postings.count == len(seqs)
+
+    def test_small_deltas_take_one_byte(self):
+
+        postings = PostingList()
+        for seq in range(1000):
+            postings.add(seq)
+
+        assert len(postings.data) == 1000
+
+    def test_duplicate_seq_ignored(self):
+
+        postings = PostingList()
+        postings.add(5)
+        postings.add(5)
+
+        assert list(postings.seqs()) == [5]
+
+    def test_decode_empty(self):
+
+        assert list(decode_postings(array.array('B'))) == []
+
+    def test_blocks_decode_independently(self):
+
+        postings = PostingList()
+        seqs = list(range(0, BLOCK_SIZE * 7, 3))
+        for seq in seqs:
+            postings.add(seq)
+
+        assert len(postings.block_offsets) == -(-len(seqs) // BLOCK_SIZE)
+        assert [seq for block in postings.blocks_desc() for seq in reversed(block)] == seqs[::-1]
+        below = [seq for block in postings.blocks_desc(below=500) for seq in block]
+        assert min(below) == 0 and max(below) >= 497 and max(below) < 500 + BLOCK_SIZE * 3
+        cache = {}
+        assert postings.matching(seqs, cache) == set(seqs)
+        assert postings.matching([seq + 1 for seq in seqs], cache) == set()
+
+
+class TestSearchIndex:
+
+    def test_tokenize_lowercases(self):
+
+        assert tokenize("Hello, World! 世界") == ['hello', 'world', '世界']
+
+    def test_term_query(self):
+
+        index = SearchIndex()
+        index.add(b'Alice', b'hello world')
+        index.add(b'Bob', b'goodbye world')
+
+        hits, cursor = index.search('hello')
+
+        assert [hit['username'] for hit in hits] == [b'Alice']
+        assert cursor is None
+
+    def test_and_query(self):
+
+        index = SearchIndex()
+        index.add(b'Alice', b'deploy the server')
+        index.add(b'Bob', b'deploy the client')
+        index.add(b'Carol', b'restart the server')
+
+        hits, _ = index.search('deploy server')
+
+        assert [hit['message'] for hit in hits] == [b'deploy the server']
+
+    def test_prefix_query(self):
+
+        index = SearchIndex()
+        index.add(b'Alice', b'deploying now')
+        index.add(b'Bob', b'deployed yesterday')
+        index.add(b'Carol', b'nothing here')
+
+        hits, _ = index.search('deploy*')
+
+        assert [hit['username'] for hit in hits] == [b'Bob', b'Alice']
+
+    def test_missing_term_returns_nothing(self):
+
+        index = SearchIndex()
+        index.add(b'Alice', b'hello world')
+
+        assert index.search('hello missing') == ([], None)
+        assert index.search('') == ([], None)
+
+    def test_room_and_time_scope(self):
+
+        index = SearchIndex()
+        index.add(b'Alice', b'status update', room='ops', timestamp=100.0)
+        index.add(b'Bob', b'status update', room='dev', timestamp=200.0)
+        index.add(b'Carol', b'status update', room='ops', timestamp=300.0)
+
+        ops_hits, _ = index.search('status', room='ops')
+        recent_hits, _ = index.search('status', since=150.0, until=250.0)
+
+        assert [hit['username'] for hit in ops_hits] == [b'Carol', b'Alice']
+        assert [hit['username'] for hit in recent_hits] == [b'Bob']
+        assert index.search('status', room='unknown') == ([], None)
+
+    def test_paging(self):
+
+        index = SearchIndex()
+        for i in range(25):
+            index.add(b'Alice', f'message {i}'.encode('utf-8'))
+
+        first, cursor = index.search('message', limit=10)
+        second, cursor = index.search('message', limit=10, before=cursor)
+        third, cursor = index.search('message', limit=10, before=cursor)
+
+        seqs = [hit['seq'] for hit in first + second + third]
+        assert seqs == list(range(24, -1, -1))
+        assert cursor is None
+
+
+    def test_and_and_prefix_queries_across_blocks(self):
+
+        index = SearchIndex()
+        for i in range(BLOCK_SIZE * 10):
+            words = ['common']
+            if i % 3 == 0:
+                words.append('fizz')
+            if i % 5 == 0:
+                words.append(f'buzz{i % 2}')
+            index.add(b'Alice', ' '.join(words).encode('utf-8'))
+
+        hits, _ = index.search('fizz buzz*', limit=1000)
+
+        assert [hit['seq'] for hit in hits] == [i for i in range(BLOCK_SIZE * 10 - 1, -1, -1) if i % 15 == 0]
+
+    def test_first_page_decodes_few_blocks(self, monkeypatch):
+
+        index = SearchIndex()
+        for i in range(BLOCK_SIZE * 100):
+            index.add(b'Alice', b'hello world')
+
+        decoded = []
+        original = PostingList.block
+        monkeypatch.setattr(PostingList, 'block', lambda self, i: decoded.append(i) or original(self, i))
+        hits, cursor = index.search('hello world', limit=10)
+
+        assert len(hits) == 10
+        assert cursor == BLOCK_SIZE * 100 - 10
+        assert len(decoded) <= 2
+
+    def test_messages_stored_compactly(self):
+
+        index = SearchIndex()
+        index.add(b'Alice', 'first 世界'.encode('utf-8'))
+        index.add(b'Alice', b'second')
+        index.add(b'Bob', b'')
+
+        assert index._text == 'first 世界'.encode('utf-8') + b'second'
+        assert index._user_names == [b'Alice', b'Bob']
+        assert [hit['message'] for hit in index.search('first')[0]] == ['first 世界'.encode('utf-8')]
+
+
+class TestIndexWorker:
+
+    def test_worker_indexes_in_background(self):
+
+        worker = IndexWorker(SearchIndex())
+        worker.start()
+        try:
+            worker.submit(b'Alice', b'background indexing')
+            worker.wait()
+
+            hits, _ = worker.index.search('indexing')
+            assert len(hits) == 1
+        finally:
+            worker.stop()
+
+    def test_queries_run_on_worker_after_earlier_submits(self):
+
+        worker = IndexWorker(SearchIndex())
+        worker.start()
+        try:
+            worker.submit(b'Alice', b'queued before the query')
+            worker.search('queued', 'context', limit=5)
+
+            readable, _, _ = select.select([worker.wakeup_fd], [], [], 5)
+            assert readable
+            [(context, query, hits, cursor)] = list(worker.completed())
+            assert (context, query, cursor) == ('context', 'queued', None)
+            assert [hit['username'] for hit in hits] == [b'Alice']
+        finally:
+            worker.stop()
+
+
+class TestServerSearch:
+
+    def test_message_is_indexed_and_searchable(self):
+
+        worker = IndexWorker(SearchIndex())
+        worker.start()
+        try:
+            sender = Mock()
+            sender.send.side_effect = len
+            client_dict = {sender: Connection(sender, b'5         ', b'Alice')}
+
+            sender.recv.return_value = b''.join(encode_message('ship it today'))
+            handle_client_message(sender, [sender], client_dict, worker)
+            worker.wait()
+
+            sender.recv.return_value = b''.join(encode_message('/search ship'))
+            handle_client_message(sender, [sender], client_dict, worker)
+            readable, _, _ = select.select([worker.wakeup_fd], [], [], 5)
+            assert readable
+            send_search_results(client_dict, worker)
+
+            frame = sender.send.call_args[0][0]
+            user_length = decode_header(frame[:HEADER_LENGTH])
+            assert frame[HEADER_LENGTH:HEADER_LENGTH + user_length] == b'@search'
+            assert frame.endswith(b'Alice > ship it today')
+            assert len(worker.index) == 1
+        finally:
+            worker.stop()
@@ -0,0 +1,371 @@
+"""
+Unit tests for websocket.py
+"""
+
+import json
+import os
+import socket
+from unittest.mock import Mock
+import pytest
+from src.websocket import (
+    WEBSOCKET,
+    OP_TEXT,
+    OP_PING,
+    OP_PONG,
+    OP_CLOSE,
+    OP_CONTINUATION,
+    CLOSE_PROTOCOL_ERROR,
+    CLOSE_TOO_BIG,
+    MAX_PAYLOAD_SIZE,
+    FrameError,
+    WebSocketHandshake,
+    build_accept_key,
+    encode_frame,
+    parse_frame,
+    mask_payload,
+    encode_chat_frame
+)
+from src.connection import Connection
+from src.message_handler import broadcast_message
+from src.protocol import encode_message
+from src.server import handle_new_websocket_connection, handle_websocket_handshake, expire_handshakes
+
+
+def client_frame(payload: bytes, opcode: int = OP_TEXT, fin: bool = True) -> bytes:
+    # Browsers always mask client-to-server frames
+    mask = os.urandom(4)
+    length = len(payload)
+    first = (0x80 if fin else 0) | opcode
+    if length < 126:
+        header = bytes([first, 0x80 | length])
+    elif length < 0x10000:
+        header = bytes([first, 0x80 | 126]) + length.to_bytes(2, 'big')
+    else:
+        header = bytes([first, 0x80 | 127]) + length.to_bytes(8, 'big')
+    return header + mask + mask_payload(payload, mask)
+
+
+UPGRADE_REQUEST = (
+    b'GET /chat HTTP/1.1\r\n'
+    b'Host: localhost\r\n'
+    b'Upgrade: websocket\r\n'
+    b'Connection: Upgrade\r\n'
+    b'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+    b'Sec-WebSocket-Version: 13\r\n\r\n'
+)
+
+
+def handshake_pair():
+    # (handshake, client) over a socketpair, with the upgrade already done
+
+    server, client = socket.socketpair()
+    server.setblocking(False)
+    handshake = WebSocketHandshake(server, '')
+    client.sendall(UPGRADE_REQUEST)
+    assert handshake.read() is None
+    assert client.recv(1024).startswith(b'HTTP/1.1 101')
+    return handshake, client
+
+
+def close_code(data: bytes) -> int:
+
+    fin, opcode, payload, _ = parse_frame(data)
+    assert opcode == OP_CLOSE
+    return int.from_bytes(payload[:2], 'big')
+
+
+class TestHandshake:
+
+    def test_accept_key_matches_rfc_example(self):
+
+        assert build_accept_key(b'dGhlIHNhbXBsZSBub25jZQ==') == b's3pPLMBiTxaQ9kYGzzhZRbK+xOo='
+
+    def test_handshake_switches_protocols(self):
+
+        server, client = socket.socketpair()
+        server.setblocking(False)
+        try:
+            handshake = WebSocketHandshake(server, '')
+            # The request may arrive in pieces
+            client.sendall(UPGRADE_REQUEST[:20])
+            assert handshake.read() is None
+            client.sendall(UPGRADE_REQUEST[20:])
+            assert handshake.read() is None
+
+            response = client.recv(1024)
+            assert response.startswith(b'HTTP/1.1 101')
+            assert b's3pPLMBiTxaQ9kYGzzhZRbK+xOo=' in response
+        finally:
+            server.close()
+            client.close()
+
+    def test_plain_http_rejected(self):
+
+        server, client = socket.socketpair()
+        server.setblocking(False)
+        try:
+            client.sendall(b'GET / HTTP/1.1\r\nHost: localhost\r\n\r\n')
+
+            assert WebSocketHandshake(server, '').read() is False
+            assert client.recv(1024).startswith(b'HTTP/1.1 400')
+        finally:
+            server.close()
+            client.close()
+
+    def test_silent_client_does_not_block(self):
+
+        server, client = socket.socketpair()
+        server.setblocking(False)
+        try:
+            handshake = WebSocketHandshake(server, '')
+            assert handshake.read() is None
+        finally:
+            server.close()
+            client.close()
+
+
+class TestFraming:
+
+    def test_frame_lengths_roundtrip(self):
+
+        for size in [0, 125, 126, 65535, 65536]:
+            payload = b'x' * size
+            fin, opcode, parsed, consumed = parse_frame(client_frame(payload))
+
+            assert fin is True
+            assert opcode == OP_TEXT
+            assert parsed == payload
+
+    def test_server_frames_unmasked(self):
+
+        frame = encode_frame(b'hello')
+
+        assert frame == b'\x81\x05hello'
+        assert parse_frame(frame) == (True, OP_TEXT, b'hello', 7)
+
+    def test_incomplete_frame(self):
+
+        frame = client_frame(b'hello world')
+
+        assert parse_frame(frame[:1]) is None
+        assert parse_frame(frame[:-1]) is None
+
+
+class TestUsernameFrame:
+
+    def test_text_message_in_tcp_form(self):
+
+        handshake, client = handshake_pair()
+        try:
+            client.sendall(client_frame('Hello 世界'.encode('utf-8')))
+            message = handshake.read()
+
+            header, data = encode_message('Hello 世界')
+            assert message == {'header': header, 'data': data}
+        finally:
+            handshake.sock.close()
+            client.close()
+
+    def test_fragmented_message(self):
+
+        handshake, client = handshake_pair()
+        try:
+            client.sendall(client_frame(b'Hello ', fin=False))
+            assert handshake.read() is None
+            client.sendall(client_frame(b'World', OP_CONTINUATION))
+
+            assert handshake.read()['data'] == b'Hello World'
+        finally:
+            handshake.sock.close()
+            client.close()
+
+    def test_frames_after_username_left_unread(self):
+
+        handshake, client = handshake_pair()
+        try:
+            client.sendall(client_frame(b'Alice') + client_frame(b'first message'))
+
+            assert handshake.read()['data'] == b'Alice'
+            assert parse_frame(handshake.sock.recv(1024))[2] == b'first message'
+        finally:
+            handshake.sock.close()
+            client.close()
+
+    def test_ping_answered_with_pong(self):
+
+        handshake, client = handshake_pair()
+        try:
+            client.sendall(client_frame(b'probe', OP_PING))
+
+            assert handshake.read() is None
+            assert parse_frame(client.recv(1024))[1:3] == (OP_PONG, b'probe')
+        finally:
+            handshake.sock.close()
+            client.close()
+
+    def test_close_frame_disconnects(self):
+
+        handshake, client = handshake_pair()
+        try:
+            client.sendall(client_frame(b'\x03\xe8', OP_CLOSE))
+
+            assert handshake.read() is False
+            assert close_code(client.recv(1024)) == 1000
+        finally:
+            handshake.sock.close()
+            client.close()
+
+    def test_unmasked_frame_closed_with_1002(self):
+
+        handshake, client = handshake_pair()
+        try:
+            client.sendall(encode_frame(b'Alice'))
+
+            assert handshake.read() is False
+            assert close_code(client.recv(1024)) == CLOSE_PROTOCOL_ERROR
+        finally:
+            handshake.sock.close()
+            client.close()
+
+
+class TestFrameLimits:
+
+    def test_oversized_length_rejected_from_header(self):
+
+        header = bytes([0x81, 0x80 | 127]) + (1 << 40).to_bytes(8, 'big')
+
+        with pytest.raises(FrameError) as error:
+            parse_frame(header, MAX_PAYLOAD_SIZE, require_mask=True)
+        assert error.value.code == CLOSE_TOO_BIG
+
+    def test_connection_closes_on_oversized_frame(self):
+
+        sock = Mock()
+        sock.send.side_effect = len
+        sock.recv.return_value = bytes([0x81, 0x80 | 127]) + (1 << 40).to_bytes(8, 'big')
+        connection = Connection(sock, b'5         ', b'Alice', transport=WEBSOCKET)
+
+        assert connection.read_messages() is False
+        assert close_code(sock.send.call_args[0][0]) == CLOSE_TOO_BIG
+        assert connection.recv_buffer is None
+
+    def test_connection_closes_on_oversized_fragments(self):
+
+        sock = Mock()
+        sock.send.side_effect = len
+        half = b'x' * (MAX_PAYLOAD_SIZE // 2 + 1)
+        sock.recv.return_value = client_frame(half, fin=False) + client_frame(half, OP_CONTINUATION)
+        connection = Connection(sock, b'5         ', b'Alice', transport=WEBSOCKET)
+
+        assert connection.read_messages() is False
+        assert close_code(sock.send.call_args[0][0]) == CLOSE_TOO_BIG
+
+    def test_connection_closes_on_unmasked_frame(self):
+
+        sock = Mock()
+        sock.send.side_effect = len
+        sock.recv.return_value = encode_frame(b'hello')
+        connection = Connection(sock, b'5         ', b'Alice', transport=WEBSOCKET)
+
+        assert connection.read_messages() is False
+        assert close_code(sock.send.call_args[0][0]) == CLOSE_PROTOCOL_ERROR
+
+
+class TestServerHandshakes:
+
+    def test_silent_client_does_not_stall_others(self):
+
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen()
+        handshakes = {}
+        socket_list = []
+        client_dict = {}
+        silent = socket.create_connection(listener.getsockname())
+        browser = socket.create_connection(listener.getsockname())
+        try:
+            handle_new_websocket_connection(listener, handshakes)
+            handle_new_websocket_connection(listener, handshakes)
+            silent_side, browser_side = list(handshakes)
+
+            browser.sendall(UPGRADE_REQUEST)
+            handle_websocket_handshake(browser_side, handshakes, socket_list, client_dict)
+            browser.recv(1024)
+            browser.sendall(client_frame(b'Alice'))
+            handle_websocket_handshake(browser_side, handshakes, socket_list, client_dict)
+
+            assert client_dict[browser_side].data == b'Alice'
+            assert list(handshakes) == [silent_side]
+
+            expire_handshakes(handshakes, now=handshakes[silent_side].deadline)
+            assert handshakes == {}
+            assert silent.recv(1024) == b''
+        finally:
+            silent.close()
+            browser.close()
+            for client_socket in client_dict:
+                client_socket.close()
+            listener.close()
+
+    def test_reserved_username_refused(self):
+
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen()
+        handshakes = {}
+        socket_list = []
+        client_dict = {}
+        browser = socket.create_connection(listener.getsockname())
+        try:
+            handle_new_websocket_connection(listener, handshakes)
+            browser_side = next(iter(handshakes))
+            browser.sendall(UPGRADE_REQUEST)
+            handle_websocket_handshake(browser_side, handshakes, socket_list, client_dict)
+            browser.recv(1024)
+            browser.sendall(client_frame(b'@file:1'))
+            handle_websocket_handshake(browser_side, handshakes, socket_list, client_dict)
+
+            assert client_dict == {}
+            assert handshakes == {}
+            browser.settimeout(2)
+            assert b'reserved' in browser.recv(1024)
+        finally:
+            browser.close()
+            listener.close()
+
+
+class TestMixedBroadcast:
+
+    def test_each_format_encoded_once(self):
+
+        sender = Mock()
+        tcp_clients = [Mock() for _ in range(3)]
+        ws_clients = [Mock() for _ in range(3)]
+        for client in tcp_clients + ws_clients:
+            client.send.side_effect = len
+
+        client_dict = {sender: Connection(sender, b'5         ', b'Alice')}
+        for client in tcp_clients:
+            client_dict[client] = Connection(client, b'3         ', b'Bob')
+        for client in ws_clients:
+            client_dict[client] = Connection(client, b'5         ', b'Carol', transport=WEBSOCKET)
+
+        user_header, user_data = encode_message('Alice')
+        msg_header, msg_data = encode_message('Hi')
+        broadcast_message(sender, client_dict, user_header, user_data, msg_header, msg_data)
+
+        tcp_frames = [client.send.call_args[0][0] for client in tcp_clients]
+        ws_frames = [client.send.call_args[0][0] for client in ws_clients]
+
+        assert tcp_frames[0] == user_header + user_data + msg_header + msg_data
+        assert all(frame == tcp_frames[0] for frame in tcp_frames)
+        assert all(frame == ws_frames[0] for frame in ws_frames)
+        assert json.loads(parse_frame(ws_frames[0])[2]) == {'username': 'Alice', 'message': 'Hi'}
+        sender.send.assert_not_called()
+
+    def test_chat_frame_is_json_text(self):
+
+        fin, opcode, payload, _ = parse_frame(encode_chat_frame('用户'.encode('utf-8'), b'hey'))
+
+        assert opcode == OP_TEXT
+        assert json.loads(payload) == {'username': '用户', 'message': 'hey'}